@@ -0,0 +1,80 @@
+# Copyright (c) 2020 Autodrop3D and Aldo Hoeben / fieldOfView
+# BeltEngine is released under the terms of the AGPLv3 or higher.
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+import logging
+logger = logging.getLogger("BeltEngine")
+
+# Stores the files produced by the stages of a slice, keyed on a hash of everything the stage reads.
+# A key includes the keys of the stages it depends on, so changing a setting invalidates only the
+# stages that read it and the stages after them.
+class ArtifactCache():
+    # increase when a stage produces different output for the same inputs
+    CACHE_VERSION = 3
+
+    def __init__(self, cache_folder):
+        self._cache_folder = os.path.abspath(cache_folder)
+        os.makedirs(self._cache_folder, exist_ok=True)
+
+        # keys of the stages that were reused or had to run again
+        self._hits = set()
+        self._misses = set()
+
+    def getKey(self, stage, inputs):
+        key_data = json.dumps([self.CACHE_VERSION, stage, inputs], sort_keys=True, default=str)
+        return "%s-%s" % (stage, hashlib.sha256(key_data.encode()).hexdigest()[:32])
+
+    def getHits(self):
+        return self._hits
+
+    # an index file can be missing for a stage whose gcode was reused
+    def getMisses(self):
+        return self._misses - self._hits
+
+    def getArtifactPath(self, key, suffix):
+        return os.path.join(self._cache_folder, key + suffix)
+
+    # Copy a cached artifact to file_path. Returns False if the artifact is not in the cache.
+    def fetch(self, key, suffix, file_path):
+        artifact_path = self.getArtifactPath(key, suffix)
+        try:
+            shutil.copyfile(artifact_path, file_path)
+        except FileNotFoundError:
+            logger.debug("Cache miss for %s" % key)
+            self._misses.add(key)
+            return False
+        logger.debug("Cache hit for %s" % key)
+        self._hits.add(key)
+        return True
+
+    # Copy a file into the cache. The copy is renamed into place, so concurrent slices never
+    # see a partial artifact.
+    def store(self, key, suffix, file_path):
+        (file_descriptor, temp_file_path) = tempfile.mkstemp(dir=self._cache_folder, suffix=".tmp")
+        os.close(file_descriptor)
+        try:
+            shutil.copyfile(file_path, temp_file_path)
+            os.replace(temp_file_path, self.getArtifactPath(key, suffix))
+        except OSError as e:
+            logger.warning("Could not store %s in the cache: %s" % (key, e))
+            if os.path.exists(temp_file_path):
+                os.remove(temp_file_path)
+
+    @staticmethod
+    def hashFile(file_path):
+        file_hash = hashlib.sha256()
+        with open(file_path, "rb") as file_pointer:
+            for block in iter(lambda: file_pointer.read(2**20), b""):
+                file_hash.update(block)
+        return file_hash.hexdigest()
+
+    # Identifies an executable without hashing it; a rebuilt engine gets a new size or timestamp
+    @staticmethod
+    def getExecutableIdentity(file_path):
+        file_stat = os.stat(file_path)
+        return [os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime]
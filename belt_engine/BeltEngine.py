@@ -6,9 +6,16 @@
 import sys
 import os
 import argparse
-import math
 import tempfile
-import subprocess
+import json
+import time
+
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 import logging
 logger = logging.getLogger("BeltEngine")
@@ -28,11 +35,31 @@ stream_handler.setFormatter(logging_formatter)
 logger.addHandler(stream_handler)
 
 
-def flipYZ(tri_mesh):
-    tri_mesh.vertices[:,[2,1]] = tri_mesh.vertices[:,[1,2]]
+def tempFileName(suffix = ".stl"):
+    return os.path.join(tempfile.gettempdir(), next(tempfile._get_candidate_names())) + suffix
+
+# Write the settings for CuraEngine as a definition file that is loaded on top of fdmprinter.def.json.
+# Values are written as strings so CuraEngine receives exactly what it would get from -s key=value.
+def writeEngineSettingsFile(file_path, engine_settings):
+    settings_data = {
+        "version": 2,
+        "name": "BeltEngine job settings",
+        "metadata": {
+            "type": "machine",
+            "visible": False
+        },
+        "settings": {key: {"default_value": "%s" % value} for (key, value) in engine_settings.items()}
+    }
+    with open(file_path, "w") as file_pointer:
+        json.dump(settings_data, file_pointer, indent=1)
 
-def tempFileName():
-    return os.path.join(tempfile.gettempdir(), next(tempfile._get_candidate_names())) + ".stl"
+# Peak resident set size of this process in bytes, where supported
+def getPeakMemoryUsage():
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
 
 def check_dependencies():
     posible_solutions = []
@@ -55,12 +82,10 @@ def main():
         return 1
 
     # Import
-    import trimesh
-
-    from .SettingsParser import SettingsParser
-    from .MeshCreator import createSupportMesh, createRaftMesh
-    from .MeshPretransformer import MeshPretransformer
-    from .GcodePostProcessor import GcodePostProcessor
+    from .SliceJob import SliceJob
+    from .ArtifactCache import ArtifactCache
+    from .SettingsProfiler import SettingsProfiler
+    from .GcodeStatistics import getStatisticsFilePath
 
     parser = argparse.ArgumentParser(description="Belt-style printer pre- and postprocessor for CuraEngine.")
     parser.add_argument("-v", action="store_true", help="show verbose messages")
@@ -68,12 +93,28 @@ def main():
     parser.add_argument("-c", type=str, nargs=1, action="append", help="config file")
     parser.add_argument("-s", type=str, nargs=1, action="append", help="settings")
     parser.add_argument("-o", type=str, nargs=1, help="gcode output file")
+    parser.add_argument("-i", action="store_true", help="write a layer index file next to the gcode output file")
+    parser.add_argument("--stats", action="store_true", help="write bounds, extrusion, time estimates and feedrates of the gcode to a json file next to the gcode output file")
+    parser.add_argument("-p", type=int, nargs=1, help="number of parallel processes to use, or variants to slice at the same time in a sweep (defaults to the number of cores)")
+    parser.add_argument("--low-memory", action="store_true", help="release meshes as soon as possible and stream the gcode during post-processing")
+    parser.add_argument("--engine-timeout", type=float, help="stop CuraEngine if it runs longer than this many seconds")
+    parser.add_argument("--engine-max-memory", type=float, help="stop CuraEngine if it uses more than this many MB of memory")
+    parser.add_argument("--engine-threads", type=int, help="number of cores to reserve for CuraEngine (defaults to half of the cores)")
+    parser.add_argument("--engine-processes", type=int, default=1, help="slice long models as this many ranges of layers in parallel CuraEngine processes")
+    parser.add_argument("--sweep", type=str, action="append", metavar="KEY=VALUE,VALUE,...", help="slice every combination of these setting values into numbered output files")
+    parser.add_argument("--orient", action="store_true", help="turn belt models about the vertical axis to the rotation that needs the least support and belt")
+    parser.add_argument("--orient-refinements", type=int, default=5, help="number of passes that refine the best rotations with --orient (default 5)")
+    parser.add_argument("--cache-dir", type=str, help="reuse meshes and gcode from earlier slices with the same settings, stored in this folder")
+    parser.add_argument("--profile-settings", action="store_true", help="log how often and how long every setting formula is evaluated")
+    parser.add_argument("--profile-settings-trace", type=str, help="write the setting evaluations to this file as folded stacks for a flame graph")
     parser.add_argument("model.stl", type=str, nargs=1, help="stl model file to slice")
 
     known_args = vars(parser.parse_known_args()[0])
     if (known_args["v"]):
         logger.setLevel(logging.DEBUG)
 
+    jobs = known_args["p"][0] if known_args["p"] else (os.cpu_count() or 1)
+
     # get CuraEngine executable
     lib_path = ""
     if (known_args["x"]):
@@ -105,204 +146,316 @@ def main():
     else:
         logger.info("Using CuraEngine from %s" % engine_path)
 
-    settings_parser = SettingsParser(known_args["c"], known_args["s"])
-    settings = settings_parser.getNonDefaultValues()
-    logger.debug("Settings: %s" % ", ".join(["%s:%s" % (s, settings[s]) for s in settings]))
-
-    # get belt slicing settings
-    blackbelt_gantry_angle = math.radians(float(settings_parser.getSettingValue("blackbelt_gantry_angle")))
-
-    #if this is not set within the config it seems to default to 45 deg
-    raw_gantry_angle = float(settings_parser.getSettingValue("blackbelt_gantry_angle"))
-
-    logger.info("Gantry Angle: %s" % raw_gantry_angle)
-
-    #if its not set lets go with 90
-    if not raw_gantry_angle:
-        raw_gantry_angle = 90
-
-    #this is the next area for specifics for belt
-
-    if raw_gantry_angle < 90:
-        blackbelt_raft = settings_parser.getSettingValue("blackbelt_raft")
-        blackbelt_raft_margin = settings_parser.getSettingValue("blackbelt_raft_margin")
-        blackbelt_raft_thickness = settings_parser.getSettingValue("blackbelt_raft_thickness")
-        blackbelt_raft_gap = settings_parser.getSettingValue("blackbelt_raft_gap")
-        blackbelt_raft_speed = settings_parser.getSettingValue("blackbelt_raft_speed")
-        blackbelt_raft_flow = settings_parser.getSettingValue("blackbelt_raft_flow") * math.sin(blackbelt_gantry_angle)
-
-        blackbelt_belt_wall_enabled = settings_parser.getSettingValue("blackbelt_belt_wall_enabled")
-        blackbelt_belt_wall_speed = settings_parser.getSettingValue("blackbelt_belt_wall_speed")
-        blackbelt_belt_wall_flow = settings_parser.getSettingValue("blackbelt_belt_wall_flow") * math.sin(blackbelt_gantry_angle)
-
-        support_enable = settings_parser.getSettingValue("support_enable")
-        blackbelt_support_gantry_angle_bias = math.radians(settings_parser.getSettingValue("blackbelt_support_gantry_angle_bias"))
-        blackbelt_support_minimum_island_area = settings_parser.getSettingValue("blackbelt_support_minimum_island_area")
-
-        settings_parser.setSettingValue("support_enable", "False")
-        settings_parser.setSettingValue("adhesion_type", "\"none\"")
-        for key in ["layer_height", "layer_height_0"]:
-            settings_parser.setSettingValue(key, str(settings_parser.getSettingValue(key) / math.sin(blackbelt_gantry_angle)))
-        for key in ["material_flow", "prime_tower_flow"]:
-            settings_parser.setSettingValue(key, str(settings_parser.getSettingValue(key) * math.sin(blackbelt_gantry_angle)))
-
-        mesh_pretransformer = MeshPretransformer(
-            gantry_angle=blackbelt_gantry_angle,
-            machine_depth=settings_parser.getSettingValue("machine_depth")
-        )
-
-    settings_parser.evaluateLeafValues()
-    settings = settings_parser.getNonDefaultValues()
-
     mesh_file_path = os.path.abspath(known_args["model.stl"][0])
     if not os.path.exists(mesh_file_path):
         logger.error("Specified model file not found: %s" % mesh_file_path)
         return 1
 
-    logger.info("Loading mesh %s" % mesh_file_path)
-
-    input_mesh = trimesh.load(mesh_file_path)
-
-    #this is the next area for specifics for belt
-    if raw_gantry_angle < 90:
-        flipYZ(input_mesh)
-        input_mesh.vertices[:,[2]] = -input_mesh.vertices[:,[2]]
-        input_bounds = input_mesh.bounds
-        input_mesh.visual.vertex_colors = [[255,201,36,255]] * len(input_mesh.vertices)
-
-        logger.info("Moving mesh to the start of the belt")
-        input_mesh.apply_transform(trimesh.transformations.translation_matrix([
-            (input_bounds[0][0] + input_bounds[1][0]) / -2,
-            -input_bounds[0][1],
-            -input_bounds[0][2]
-        ]))
-
-        input_mesh.fix_normals()
-
-        support_mesh = None
-        if support_enable:
-            logger.info("Create support mesh")
-
-            support_mesh = createSupportMesh(
-                input_mesh,
-                support_angle=settings_parser.getSettingValue("support_angle"),
-                filter_upwards_facing_faces=True,
-                down_vector=[0, -math.cos(math.radians(blackbelt_support_gantry_angle_bias)), -math.sin(blackbelt_support_gantry_angle_bias)],
-                bottom_cut_off=settings_parser.getSettingValue("wall_line_width_0"),
-                minimum_island_area=blackbelt_support_minimum_island_area
-            )
-            support_mesh.visual.vertex_colors = [[0,255,255,255]] * len(support_mesh.vertices)
-
-        raft_mesh = None
-        if blackbelt_raft:
-            logger.info("Create raft mesh")
-            raft_mesh = createRaftMesh(
-                input_mesh,
-                raft_thickness=blackbelt_raft_thickness,
-                raft_margin=blackbelt_raft_margin
-            )
-            raft_mesh.visual.vertex_colors = [[128,128,128,255]] * len(raft_mesh.vertices)
-
-            translation_for_raft = trimesh.transformations.translation_matrix([
-                0, blackbelt_raft_thickness + blackbelt_raft_gap, 0
-            ])
-            input_mesh.apply_transform(translation_for_raft)
-            if support_mesh:
-                support_mesh.apply_transform(translation_for_raft)
-
-        if (known_args["v"]):
-            show_mesh = input_mesh.copy()
-            if support_enable:
-                show_mesh += support_mesh
-            if raft_mesh:
-                show_mesh += raft_mesh
-
-            show_mesh.show(smooth=False, flags={"axis": True, "grid": True})
-
-        logger.info("Creating temporary pretransformed mesh")
-        mesh_pretransformer.pretransformMesh(input_mesh)
-        flipYZ(input_mesh)
-        input_mesh.invert()
-    temp_mesh_file_path = tempFileName()
-    input_mesh.export(temp_mesh_file_path)
-
-    #end of belt specifics
+    if known_args["sweep"]:
+        if known_args["v"]:
+            logger.error("Meshes can't be shown for a sweep")
+            return 1
+        return runSweep(known_args, engine_path, lib_path, mesh_file_path, jobs)
+
+    settings_profiler = None
+    if known_args["profile_settings"] or known_args["profile_settings_trace"]:
+        settings_profiler = SettingsProfiler()
+    slice_job = SliceJob(known_args["c"], known_args["s"], settings_profiler=settings_profiler)
+    if known_args["orient"]:
+        if not slice_job.isBelt():
+            logger.warning("Only models for belt printers are rotated")
+        slice_job.setOrientationRefinements(known_args["orient_refinements"], jobs=jobs)
+    if settings_profiler:
+        settings_profiler.logReport()
+        if known_args["profile_settings_trace"]:
+            settings_profiler.writeFoldedStacks(known_args["profile_settings_trace"])
+
+    output_file_path = known_args["o"][0]
+    statistics_file_path = getStatisticsFilePath(output_file_path) if known_args["stats"] else None
+    artifact_cache = ArtifactCache(known_args["cache_dir"]) if known_args["cache_dir"] else None
+
+    result = runSliceJob(slice_job, known_args, engine_path, lib_path, mesh_file_path, output_file_path, statistics_file_path, artifact_cache, jobs)
+    if result:
+        return result
+
+    if artifact_cache:
+        logger.info("Reused %d cached stages, ran %d" % (len(artifact_cache.getHits()), len(artifact_cache.getMisses())))
+
+    peak_memory_usage = getPeakMemoryUsage()
+    if peak_memory_usage:
+        logger.info("Peak memory use of BeltEngine: %d MB" % (peak_memory_usage / 2**20))
+
+# Every stage is keyed on the settings it reads and the keys of the stages it uses the output of
+def getStageKeys(slice_job, known_args, artifact_cache, model_hash, engine_path, statistics_file_path):
+    from .ArtifactCache import ArtifactCache
+
+    stage_keys = {}
+    for stage in slice_job.getMeshStages():
+        stage_keys[stage] = artifact_cache.getKey(stage, [model_hash, slice_job.getStageInputs(stage)])
+    stage_keys["engine"] = artifact_cache.getKey("engine", [
+        ArtifactCache.getExecutableIdentity(engine_path),
+        [stage_keys[stage] for stage in slice_job.getMeshStages()],
+        slice_job.getStageInputs("engine")
+    ] + ([known_args["engine_processes"]] if known_args["engine_processes"] > 1 else []))
+    stage_keys["postprocess"] = artifact_cache.getKey("postprocess", [
+        stage_keys["engine"],
+        slice_job.getStageInputs("postprocess"),
+        statistics_file_path is not None
+    ])
+    return stage_keys
+
+# Slice and post-process one job into output_file_path, reusing the stages that are in the cache.
+# Returns 0 on success.
+def runSliceJob(slice_job, known_args, engine_path, lib_path, mesh_file_path, output_file_path, statistics_file_path, artifact_cache, jobs):
+    from .ArtifactCache import ArtifactCache
+    from .GcodeLayerIndex import GcodeLayerIndex, getLayerIndexFilePath
+
+    layer_index_file_path = getLayerIndexFilePath(output_file_path) if known_args["i"] else None
+
+    stage_keys = {}
+    if artifact_cache:
+        stage_keys = getStageKeys(slice_job, known_args, artifact_cache, ArtifactCache.hashFile(mesh_file_path), engine_path, statistics_file_path)
+    postprocess_artifacts = [(".gcode", output_file_path)]
+    if statistics_file_path:
+        postprocess_artifacts.append((".stats.json", statistics_file_path))
+
+    if artifact_cache and not known_args["v"] and all([artifact_cache.fetch(stage_keys["postprocess"], suffix, file_path) for (suffix, file_path) in postprocess_artifacts]):
+        logger.info("Using cached post-processed gcode")
+        if layer_index_file_path and not artifact_cache.fetch(stage_keys["postprocess"], ".index.json", layer_index_file_path):
+            logger.info("Indexing gcode layers")
+            GcodeLayerIndex.fromGcodeFile(output_file_path).save(layer_index_file_path)
+        return 0
+
+    if artifact_cache and not known_args["v"] and artifact_cache.fetch(stage_keys["engine"], ".gcode", output_file_path):
+        logger.info("Using cached CuraEngine gcode")
+    else:
+        result = sliceModel(slice_job, known_args, engine_path, lib_path, mesh_file_path, output_file_path, artifact_cache, stage_keys)
+        if result:
+            return result
+        if artifact_cache:
+            artifact_cache.store(stage_keys["engine"], ".gcode", output_file_path)
+
+    gcode_pipeline = slice_job.createGcodePipeline(jobs=jobs, low_memory=known_args["low_memory"], statistics_file_path=statistics_file_path)
+    if gcode_pipeline.getStages():
+        logger.info("Post processing gcode: %s" % ", ".join([stage.getName() for stage in gcode_pipeline.getStages()]))
+        gcode_pipeline.processGcodeFile(output_file_path, layer_index_file_path)
+    elif layer_index_file_path:
+        logger.info("Indexing gcode layers")
+        GcodeLayerIndex.fromGcodeFile(output_file_path).save(layer_index_file_path)
+
+    if artifact_cache:
+        for (suffix, file_path) in postprocess_artifacts:
+            artifact_cache.store(stage_keys["postprocess"], suffix, file_path)
+        if layer_index_file_path:
+            artifact_cache.store(stage_keys["postprocess"], ".index.json", layer_index_file_path)
+    return 0
+
+# Slice every variant of a sweep into its own output file. Meshes are prepared up front, once for
+# all variants that read the same mesh settings, then the variants are sliced by a pool of workers.
+def runSweep(known_args, engine_path, lib_path, mesh_file_path, jobs):
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+    from .SliceSweep import SliceSweep
+    from .ArtifactCache import ArtifactCache
+    from .GcodeStatistics import getStatisticsFilePath
+
+    try:
+        sweep_settings = SliceSweep.parseSweepArguments(known_args["sweep"])
+    except ValueError as e:
+        logger.error(str(e))
+        return 1
+    slice_sweep = SliceSweep(known_args["c"], known_args["s"], sweep_settings)
+    variants = slice_sweep.getVariants()
+    if known_args["orient"]:
+        for variant in variants:
+            variant.slice_job.setOrientationRefinements(known_args["orient_refinements"], jobs=jobs)
+    logger.info("Sweeping %d variants of %s" % (len(variants), ", ".join([key for (key, values) in sweep_settings])))
+
+    # the variants share their meshes and gcode through the cache
+    temp_cache_folder = None
+    if not known_args["cache_dir"]:
+        temp_cache_folder = tempfile.mkdtemp(prefix="beltengine-sweep-")
+    artifact_cache = ArtifactCache(known_args["cache_dir"] or temp_cache_folder)
+
+    output_file_paths = [slice_sweep.getOutputFilePath(known_args["o"][0], index) for index in range(len(variants))]
+    statistics_file_paths = [getStatisticsFilePath(output_file_path) for output_file_path in output_file_paths]
+    model_hash = ArtifactCache.hashFile(mesh_file_path)
+    variant_stage_keys = [
+        getStageKeys(variant.slice_job, known_args, artifact_cache, model_hash, engine_path, statistics_file_path)
+        for (variant, statistics_file_path) in zip(variants, statistics_file_paths)
+    ]
+
+    slice_sweep.prepareMeshes(mesh_file_path, artifact_cache, variant_stage_keys, low_memory=known_args["low_memory"])
+
+    # variants with the same CuraEngine gcode are sliced one after another, so only the first runs CuraEngine
+    variant_groups = OrderedDict()
+    for (index, stage_keys) in enumerate(variant_stage_keys):
+        variant_groups.setdefault(stage_keys["engine"], []).append(index)
+    worker_count = max(1, min(jobs, len(variant_groups)))
+    worker_args = dict(known_args)
+    worker_args["engine_threads"] = known_args["engine_threads"] or max(1, (os.cpu_count() or 1) // worker_count)
+    logger.info("Slicing %d distinct CuraEngine jobs with %d workers" % (len(variant_groups), worker_count))
+
+    results = [None] * len(variants)
+    def sliceVariants(variant_indices):
+        for index in variant_indices:
+            start_time = time.monotonic()
+            try:
+                result = runSliceJob(
+                    variants[index].slice_job, worker_args, engine_path, lib_path, mesh_file_path,
+                    output_file_paths[index], statistics_file_paths[index], artifact_cache, 1
+                )
+            except Exception as e:
+                logger.error("Variant %d failed: %s" % (index + 1, e))
+                result = 1
+            results[index] = (result, time.monotonic() - start_time)
+
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        list(executor.map(sliceVariants, variant_groups.values()))
+
+    summary = slice_sweep.getSummary(output_file_paths, statistics_file_paths, results)
+    slice_sweep.logSummary(summary)
+    slice_sweep.writeSummary(slice_sweep.getSummaryFilePath(known_args["o"][0]), summary)
+
+    logger.info("Reused %d cached stages, ran %d" % (len(artifact_cache.getHits()), len(artifact_cache.getMisses())))
+    if temp_cache_folder:
+        shutil.rmtree(temp_cache_folder, ignore_errors=True)
+
+    return 1 if any([result[0] for result in results]) else 0
+
+# Create the meshes that are not cached yet and slice them with CuraEngine
+def sliceModel(slice_job, known_args, engine_path, lib_path, mesh_file_path, output_file_path, artifact_cache, stage_keys):
+    from .EngineSupervisor import EngineSupervisor
+
+    mesh_file_paths = OrderedDict()
+    missing_mesh_file_paths = OrderedDict()
+    for stage in slice_job.getMeshStages():
+        mesh_file_paths[stage] = tempFileName()
+        if known_args["v"] or not artifact_cache or not artifact_cache.fetch(stage_keys[stage], ".stl", mesh_file_paths[stage]):
+            missing_mesh_file_paths[stage] = mesh_file_paths[stage]
+
+    if missing_mesh_file_paths or known_args["v"]:
+        slice_job.prepareMeshes(mesh_file_path, missing_mesh_file_paths, preview=known_args["v"], low_memory=known_args["low_memory"])
+        if artifact_cache:
+            for stage, stage_mesh_file_path in missing_mesh_file_paths.items():
+                artifact_cache.store(stage_keys[stage], ".stl", stage_mesh_file_path)
+    else:
+        logger.info("Using cached meshes")
 
     logger.info("Launching CuraEngine")
-    engine_args = [
-        engine_path,
-        "slice",
-        "-v",
-        "-j", os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources","definitions","fdmprinter.def.json"),
-        "-o", known_args["o"][0],
-    ]
-    for (key, value) in settings.items():
-        if not key.startswith("blackbelt_"):
-            engine_args.extend(["-s", "%s=%s" % (key, value)])
-
-    engine_args.extend(["-l", temp_mesh_file_path])
-
-
-    # I would say here would be the start of specifics for belt that i would need to go around
-    if raw_gantry_angle < 90:
-        if support_enable:
-            logger.info("Creating temporary pretransformed support-mesh")
-            mesh_pretransformer.pretransformMesh(support_mesh)
-            flipYZ(support_mesh)
-            support_mesh.invert()
-            temp_support_mesh_file_path = tempFileName()
-            support_mesh.export(temp_support_mesh_file_path)
-
-            engine_args.extend(["-l", temp_support_mesh_file_path])
-            engine_args.extend(["-s",  "support_mesh=true"])
-            engine_args.extend(["-s",  "support_mesh_drop_down=false"])
-
-        if blackbelt_raft:
-            logger.info("Creating temporary pretransformed raft-mesh")
-            mesh_pretransformer.pretransformMesh(raft_mesh)
-            flipYZ(raft_mesh)
-            raft_mesh.invert()
-            temp_raft_mesh_file_path = tempFileName()
-            raft_mesh.export(temp_raft_mesh_file_path)
-
-            engine_args.extend(["-l", temp_raft_mesh_file_path])
-            engine_args.extend(["-s", "wall_line_count=99999999"])
-            engine_args.extend(["-s", "speed_wall_0=%f" % blackbelt_raft_speed])
-            engine_args.extend(["-s", "speed_wall_x=%f" % blackbelt_raft_speed])
-            engine_args.extend(["-s", "material_flow=%f" % blackbelt_raft_flow])
-
-    # i would say this would be the end
+    engine_settings = slice_job.getEngineSettings()
+    temp_settings_file_path = tempFileName(".def.json")
+    writeEngineSettingsFile(temp_settings_file_path, engine_settings)
+
+    engine_args = slice_job.getEngineArgs(engine_path, temp_settings_file_path, output_file_path, mesh_file_paths)
     logger.debug(engine_args)
 
+    # compare with passing every leaf value as a separate -s argument
+    settings = slice_job.getSettingsParser().getNonDefaultValues()
+    engine_args_length = sum([len(arg) + 1 for arg in engine_args])
+    settings_args_length = sum([len("-s %s=%s " % (key, value)) for (key, value) in settings.items() if not key.startswith("blackbelt_")])
+    logger.info("Passing %d changed settings through a settings file; engine command line is %d bytes instead of %d" % (
+        len(engine_settings), engine_args_length, engine_args_length - len("-j %s " % temp_settings_file_path) + settings_args_length
+    ))
+
     env = os.environ.copy()
     if lib_path:
         env["LD_LIBRARY_PATH"] = lib_path
         logger.info("Adding lib path %s to env" % env["LD_LIBRARY_PATH"])
-    process = subprocess.Popen(engine_args, stdout=subprocess.PIPE, env=env)
-    for line in process.stdout:
-        logger.debug(line)
+
+    layer_range_slicer = None
+    if known_args["engine_processes"] > 1:
+        layer_range_slicer = slice_job.createLayerRangeSlicer(known_args["engine_processes"])
+        if layer_range_slicer and not layer_range_slicer.splitMeshes(mesh_file_paths):
+            layer_range_slicer = None
+
+    if layer_range_slicer:
+        engine_error = sliceLayerRanges(slice_job, known_args, engine_path, env, engine_settings, layer_range_slicer, output_file_path)
+    else:
+        engine_supervisor = EngineSupervisor(
+            timeout=known_args["engine_timeout"],
+            max_rss=known_args["engine_max_memory"] * 2**20 if known_args["engine_max_memory"] else None,
+            threads=known_args["engine_threads"]
+        )
+        engine_result = engine_supervisor.run(engine_args, env)
+        if engine_result.peak_rss:
+            logger.info("CuraEngine finished in %.2fs using at most %d MB of memory" % (engine_result.wall_time, engine_result.peak_rss / 2**20))
+        else:
+            logger.info("CuraEngine finished in %.2fs" % engine_result.wall_time)
+        engine_error = engine_result.error
 
     logger.info("Removing temporary meshes")
-    os.remove(temp_mesh_file_path)
-
-    # I would say here would be the start of specifics for belt that i would need to go around
-    if raw_gantry_angle < 90:
-
-        if support_enable:
-            os.remove(temp_support_mesh_file_path)
-        if blackbelt_raft:
-            os.remove(temp_raft_mesh_file_path)
-
-        if blackbelt_belt_wall_enabled:
-            logger.info("Post processing gcode for belt wall")
-
-            post_processor = GcodePostProcessor(
-                belt_wall_enable=blackbelt_belt_wall_enabled,
-                belt_wall_flow=blackbelt_belt_wall_flow,
-                belt_wall_speed=blackbelt_belt_wall_speed,
-                wall_line_width_0=settings_parser.getSettingValue("wall_line_width_0")
-            )
-            post_processor.processGcodeFile(known_args["o"][0])
+    for stage_mesh_file_path in mesh_file_paths.values():
+        os.remove(stage_mesh_file_path)
+    os.remove(temp_settings_file_path)
+
+    if engine_error:
+        logger.error("Slicing failed: %s" % engine_error)
+        return 1
+
+    return 0
+
+# Slice the layer ranges of the meshes in parallel CuraEngine processes and stitch their gcode
+# into the output file. Returns an error message if a range could not be sliced.
+def sliceLayerRanges(slice_job, known_args, engine_path, env, engine_settings, layer_range_slicer, output_file_path):
+    from concurrent.futures import ThreadPoolExecutor
+    from .EngineSupervisor import EngineSupervisor
+
+    layer_ranges = layer_range_slicer.getRanges()
+    threads = known_args["engine_threads"] or max(1, (os.cpu_count() or 1) // len(layer_ranges))
+    range_gcode_file_paths = [tempFileName(".gcode") if layer_range.mesh_file_paths else None for layer_range in layer_ranges]
+
+    def sliceRange(range_index):
+        if range_gcode_file_paths[range_index] is None:
+            return None
+        range_settings = OrderedDict(engine_settings)
+        range_settings.update(layer_range_slicer.getRangeEngineSettings(range_index))
+        settings_file_path = tempFileName(".def.json")
+        writeEngineSettingsFile(settings_file_path, range_settings)
+
+        engine_args = slice_job.getEngineArgs(engine_path, settings_file_path, range_gcode_file_paths[range_index], layer_ranges[range_index].mesh_file_paths)
+        logger.debug(engine_args)
+        engine_supervisor = EngineSupervisor(
+            timeout=known_args["engine_timeout"],
+            max_rss=known_args["engine_max_memory"] * 2**20 if known_args["engine_max_memory"] else None,
+            threads=threads
+        )
+        try:
+            return engine_supervisor.run(engine_args, env)
+        finally:
+            os.remove(settings_file_path)
+
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(layer_ranges)) as executor:
+        engine_results = list(executor.map(sliceRange, range(len(layer_ranges))))
+    wall_time = time.monotonic() - start_time
+
+    engine_error = None
+    for (range_index, engine_result) in enumerate(engine_results):
+        if engine_result is None:
+            logger.info("Layer range %d has no geometry" % range_index)
+            continue
+        logger.info("CuraEngine finished layer range %d in %.2fs%s" % (
+            range_index, engine_result.wall_time,
+            " using at most %d MB of memory" % (engine_result.peak_rss / 2**20) if engine_result.peak_rss else ""
+        ))
+        if engine_result.error and not engine_error:
+            engine_error = "layer range %d: %s" % (range_index, engine_result.error)
+
+    engine_times = [engine_result.wall_time for engine_result in engine_results if engine_result]
+    logger.info("Sliced %d layer ranges in %.2fs; slicing them one after another takes %.2fs (%.1fx)" % (
+        len(layer_ranges), wall_time, sum(engine_times), sum(engine_times) / wall_time if wall_time else 1
+    ))
+
+    if not engine_error:
+        layer_range_slicer.stitchGcode(range_gcode_file_paths, output_file_path)
+
+    for range_gcode_file_path in range_gcode_file_paths:
+        if range_gcode_file_path and os.path.exists(range_gcode_file_path):
+            os.remove(range_gcode_file_path)
+    layer_range_slicer.removeTemporaryFiles()
+
+    return engine_error
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,200 @@
+# Copyright (c) 2020 Autodrop3D and Aldo Hoeben / fieldOfView
+# BeltEngine is released under the terms of the AGPLv3 or higher.
+
+import os
+import sys
+import time
+import tempfile
+import threading
+import subprocess
+from typing import NamedTuple, Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import logging
+logger = logging.getLogger("BeltEngine")
+
+# fraction of the cores that is reserved for an engine if no number of threads is given, so
+# concurrent jobs on one machine don't have to wait until the first one is done
+DEFAULT_CORE_SHARE = 0.5
+# seconds to wait for free cores if the engine has no timeout
+DEFAULT_RESERVE_TIMEOUT = 600
+
+EngineResult = NamedTuple("EngineResult", [
+    ("return_code", Optional[int]),
+    ("wall_time", float),
+    ("peak_rss", Optional[int]),  # bytes, if it could be measured
+    ("cores", list),
+    ("error", Optional[str])
+])
+
+# Runs CuraEngine (or any other engine executable) with a wall-clock timeout and a memory limit.
+# Cores are reserved with lock files that are shared by all BeltEngine processes on the machine,
+# so concurrent slices each get their own cores and a matching number of OpenMP threads.
+class EngineSupervisor():
+    def __init__(self,
+                timeout = None,
+                max_rss = None,
+                threads = None,
+                poll_interval = 0.2,
+                lock_folder = None
+        ):
+
+        self._timeout = timeout
+        self._max_rss = max_rss
+        self._threads = threads
+        self._poll_interval = poll_interval
+        self._lock_folder = lock_folder if lock_folder else tempfile.gettempdir()
+
+        self._core_locks = []
+
+    def run(self, engine_args, env = None):
+        env = dict(env if env is not None else os.environ)
+        cores = self._reserveCores()
+        try:
+            if cores:
+                env["OMP_NUM_THREADS"] = str(len(cores))
+                logger.info("Running engine on cores %s" % ", ".join([str(core) for core in cores]))
+            elif self._threads:
+                env["OMP_NUM_THREADS"] = str(self._threads)
+
+            return self._runProcess(engine_args, env, cores)
+        finally:
+            self._releaseCores()
+
+    def _runProcess(self, engine_args, env, cores):
+        start_time = time.monotonic()
+        process = subprocess.Popen(engine_args, stdout=subprocess.PIPE, env=env)
+        # set after starting instead of in a preexec_fn, which is not safe while other threads run and
+        # makes Popen fork the whole process; the engine starts its threads after this
+        if cores and hasattr(os, "sched_setaffinity"):
+            try:
+                os.sched_setaffinity(process.pid, cores)
+            except OSError as e:
+                logger.warning("Could not run the engine on cores %s: %s" % (", ".join([str(core) for core in cores]), e))
+        output_thread = threading.Thread(target=self._logOutput, args=(process.stdout, ), daemon=True)
+        output_thread.start()
+
+        error = None
+        peak_rss = None
+        poll_interval = 0.01
+        while True:
+            if self._pollProcess(process, poll_interval):
+                break
+            poll_interval = min(poll_interval * 2, self._poll_interval)
+
+            (rss, high_water_mark) = _getProcessMemory(process.pid)
+            if high_water_mark is not None:
+                peak_rss = max(peak_rss or 0, high_water_mark)
+
+            if self._timeout and time.monotonic() - start_time > self._timeout:
+                error = "Engine did not finish within %g seconds" % self._timeout
+            elif self._max_rss and rss is not None and rss > self._max_rss:
+                error = "Engine used %d MB of memory, which is more than the limit of %d MB" % (rss / 2**20, self._max_rss / 2**20)
+            if error:
+                self._killProcess(process)
+                break
+
+        output_thread.join(timeout=1)
+        wall_time = time.monotonic() - start_time
+
+        return_code = process.returncode
+        if not error and return_code != 0:
+            error = "Engine exited with code %s" % return_code
+
+        return EngineResult(return_code=return_code, wall_time=wall_time, peak_rss=peak_rss, cores=cores, error=error)
+
+    # ru_maxrss from wait4 is not used for the peak memory use, because on Linux it includes the
+    # memory of this process at the moment the engine was started.
+    def _pollProcess(self, process, timeout):
+        try:
+            process.wait(timeout=timeout)
+            return True
+        except subprocess.TimeoutExpired:
+            return False
+
+    def _killProcess(self, process):
+        process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    def _logOutput(self, stream):
+        with stream:
+            for line in stream:
+                logger.debug(line)
+
+    # Lock as many free cores as requested (or a share of the cores), waiting until at least one is free
+    def _reserveCores(self):
+        if fcntl is None:
+            return []
+
+        if hasattr(os, "sched_getaffinity"):
+            available_cores = sorted(os.sched_getaffinity(0))
+        else:
+            available_cores = list(range(os.cpu_count() or 1))
+        if self._threads:
+            wanted_cores = min(self._threads, len(available_cores))
+        else:
+            wanted_cores = max(1, int(len(available_cores) * DEFAULT_CORE_SHARE))
+        # don't wait for other engines longer than this engine would be allowed to run
+        reserve_timeout = self._timeout if self._timeout else DEFAULT_RESERVE_TIMEOUT
+
+        start_time = time.monotonic()
+        while True:
+            lockable_cores = 0
+            for core in available_cores:
+                # lock files of other users in a shared temp folder can't be opened; their cores are skipped
+                try:
+                    lock_file = open(os.path.join(self._lock_folder, "beltengine-core-%d.lock" % core), "a")
+                except OSError:
+                    continue
+                lockable_cores += 1
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    lock_file.close()
+                    continue
+                self._core_locks.append((core, lock_file))
+                if len(self._core_locks) >= wanted_cores:
+                    break
+            if self._core_locks:
+                return [core for (core, lock_file) in self._core_locks]
+            if lockable_cores == 0:
+                logger.warning("The core lock files in %s can't be opened, running the engine without reservation" % self._lock_folder)
+                return []
+
+            if time.monotonic() - start_time > reserve_timeout:
+                logger.warning("No free cores to reserve, running the engine without reservation")
+                return []
+            time.sleep(self._poll_interval)
+
+    def _releaseCores(self):
+        for (core, lock_file) in self._core_locks:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+        self._core_locks = []
+
+
+# Returns the current and peak resident set size of a process in bytes, where supported
+def _getProcessMemory(pid):
+    if not sys.platform.startswith("linux"):
+        return (None, None)
+
+    rss = None
+    high_water_mark = None
+    try:
+        with open("/proc/%d/status" % pid) as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    high_water_mark = int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return (rss, high_water_mark)
@@ -0,0 +1,247 @@
+# Copyright (c) 2020 Autodrop3D and Aldo Hoeben / fieldOfView
+# BeltEngine is released under the terms of the AGPLv3 or higher.
+
+import re
+import math
+from typing import NamedTuple, Optional
+
+from .GcodePipeline import GcodeStage
+
+import logging
+logger = logging.getLogger("BeltEngine")
+
+# an arc replaces at least and at most this many segments
+MINIMUM_ARC_SEGMENTS = 3
+MAXIMUM_ARC_SEGMENTS = 64
+# nearly straight runs are left as they are
+MAXIMUM_ARC_RADIUS = 1000.0
+# the extrusion per mm of every segment may differ this much from that of the arc
+EXTRUSION_RATE_TOLERANCE = 0.05
+
+move_parameters_regex = re.compile(r"([XYZEF])(-?\d*\.?\d+)")
+
+_Segment = NamedTuple("_Segment", [
+    ("x", float),
+    ("y", float),
+    ("extrusion", float),
+    ("x_text", str),  # end point as written in the gcode
+    ("y_text", str),
+    ("e_text", str),
+    ("feedrate_text", Optional[str]),
+    ("line", str)
+])
+
+# Replaces runs of short extruding G1 segments that lie on a circle with G2/G3 arcs, which the
+# printer receives and plans as a single move. Only plain "G1 X Y E" lines without a comment are
+# fitted, so lines that were adjusted for the belt wall and G92 resets are kept as they are.
+# In absolute extrusion mode an arc ends at the E value of its last segment, in relative mode it
+# extrudes the sum of its segments, so the extruded amount does not change.
+class GcodeArcFitter(GcodeStage):
+    # tolerance is the maximum distance in mm between the arc and the segments it replaces
+    def __init__(self, tolerance = 0.01):
+        super().__init__("arc fitting")
+
+        self._tolerance = tolerance
+        self._statistics = None
+
+    def getStatistics(self):
+        return self._statistics
+
+    def processStream(self, gcode_lines):
+        statistics = {"lines_in": 0, "lines_out": 0, "bytes_in": 0, "bytes_out": 0, "arcs": 0, "segments": 0}
+        self._statistics = statistics
+
+        x = y = None
+        x_text = y_text = None
+        e = 0.0
+        relative_axes = False
+        relative_e = False
+
+        # start point and segments of the current run
+        start = None
+        segments = []
+
+        for line in gcode_lines:
+            statistics["lines_in"] += 1
+            statistics["bytes_in"] += len(line)
+
+            segment = None
+            if line.startswith("G1 ") and ";" not in line and x is not None and not relative_axes:
+                code = line.rstrip("\n")
+                parameters = move_parameters_regex.findall(code)
+                # every word of the line must be a parameter that is understood
+                if len(parameters) == len(code.split(" ")) - 1:
+                    parameters = dict(parameters)
+                    if "E" in parameters and ("X" in parameters or "Y" in parameters) and "Z" not in parameters:
+                        new_e = float(parameters["E"])
+                        extrusion = new_e if relative_e else new_e - e
+                        if extrusion > 0:
+                            segment = _Segment(
+                                float(parameters.get("X", x)), float(parameters.get("Y", y)), extrusion,
+                                parameters.get("X", x_text), parameters.get("Y", y_text), parameters["E"],
+                                parameters.get("F"), line
+                            )
+
+            if segment is not None:
+                # the feedrate can only be set at the start of an arc
+                if segment.feedrate_text is not None and segments:
+                    yield from self._flushRun(start, segments, relative_e, statistics)
+                    segments = []
+                if not segments:
+                    start = (x, y)
+
+                segments.append(segment)
+                while len(segments) >= MINIMUM_ARC_SEGMENTS and not self._fitArc(start, segments):
+                    if len(segments) > MINIMUM_ARC_SEGMENTS:
+                        # the run without the last segment was the longest arc
+                        yield self._countLine(self._formatArc(start, segments[:-1], relative_e, statistics), statistics)
+                        start = (segments[-2].x, segments[-2].y)
+                        segments = segments[-1:]
+                    else:
+                        yield self._countLine(segments[0].line, statistics)
+                        start = (segments[0].x, segments[0].y)
+                        segments = segments[1:]
+                if len(segments) >= MAXIMUM_ARC_SEGMENTS:
+                    yield self._countLine(self._formatArc(start, segments, relative_e, statistics), statistics)
+                    segments = []
+
+                (x, y, x_text, y_text) = (segment.x, segment.y, segment.x_text, segment.y_text)
+                e = e + segment.extrusion if relative_e else float(segment.e_text)
+                continue
+
+            if segments:
+                yield from self._flushRun(start, segments, relative_e, statistics)
+                segments = []
+
+            first_character = line[:1]
+            if first_character == "G":
+                code = line.partition(";")[0]
+                command = code.split(" ", 1)[0].strip()
+                if command in ("G0", "G1", "G2", "G3"):
+                    for (axis, value) in move_parameters_regex.findall(code):
+                        if axis == "X":
+                            x = x + float(value) if relative_axes and x is not None else float(value)
+                            x_text = value if not relative_axes else "%.3f" % x
+                        elif axis == "Y":
+                            y = y + float(value) if relative_axes and y is not None else float(value)
+                            y_text = value if not relative_axes else "%.3f" % y
+                        elif axis == "E":
+                            e = e + float(value) if relative_e else float(value)
+                elif command == "G92":
+                    parameters = dict(move_parameters_regex.findall(code))
+                    if "E" in parameters or not parameters:
+                        e = float(parameters.get("E", 0))
+                    if "X" in parameters:
+                        (x, x_text) = (float(parameters["X"]), parameters["X"])
+                    if "Y" in parameters:
+                        (y, y_text) = (float(parameters["Y"]), parameters["Y"])
+                elif command == "G28":
+                    # homed axes end up at a position that is not known here
+                    x = y = None
+                elif command == "G90":
+                    relative_axes = False
+                    relative_e = False
+                elif command == "G91":
+                    relative_axes = True
+                    relative_e = True
+            elif first_character == "M":
+                if line.startswith("M82"):
+                    relative_e = False
+                elif line.startswith("M83"):
+                    relative_e = True
+
+            yield self._countLine(line, statistics)
+
+        if segments:
+            yield from self._flushRun(start, segments, relative_e, statistics)
+
+    def _flushRun(self, start, segments, relative_e, statistics):
+        if len(segments) >= MINIMUM_ARC_SEGMENTS:
+            # runs of this length are only kept if they fit an arc
+            yield self._countLine(self._formatArc(start, segments, relative_e, statistics), statistics)
+        else:
+            for segment in segments:
+                yield self._countLine(segment.line, statistics)
+
+    def _countLine(self, line, statistics):
+        statistics["lines_out"] += 1
+        statistics["bytes_out"] += len(line)
+        return line
+
+    # The center (cx, cy) and direction of the circle through the start point and the end points of
+    # the segments, or None if the segments don't follow that circle closely enough
+    def _fitArc(self, start, segments):
+        points = [start] + [(segment.x, segment.y) for segment in segments]
+        (x1, y1) = points[0]
+        (x2, y2) = points[len(points) // 2]
+        (x3, y3) = points[-1]
+
+        determinant = 2 * (x1 * (y2 - y3) + x2 * (y3 - y1) + x3 * (y1 - y2))
+        if abs(determinant) < 1e-9:
+            return None
+        center_x = ((x1 * x1 + y1 * y1) * (y2 - y3) + (x2 * x2 + y2 * y2) * (y3 - y1) + (x3 * x3 + y3 * y3) * (y1 - y2)) / determinant
+        center_y = ((x1 * x1 + y1 * y1) * (x3 - x2) + (x2 * x2 + y2 * y2) * (x1 - x3) + (x3 * x3 + y3 * y3) * (x2 - x1)) / determinant
+        radius = math.hypot(x1 - center_x, y1 - center_y)
+        if radius > MAXIMUM_ARC_RADIUS:
+            return None
+
+        total_length = 0.0
+        total_extrusion = 0.0
+        total_angle = 0.0
+        clockwise = None
+        for (index, segment) in enumerate(segments):
+            (start_x, start_y) = points[index]
+            # the end point and the middle of the segment must both be close to the arc
+            if abs(math.hypot(segment.x - center_x, segment.y - center_y) - radius) > self._tolerance:
+                return None
+            if abs(math.hypot((start_x + segment.x) / 2 - center_x, (start_y + segment.y) / 2 - center_y) - radius) > self._tolerance:
+                return None
+
+            cross = (start_x - center_x) * (segment.y - center_y) - (start_y - center_y) * (segment.x - center_x)
+            dot = (start_x - center_x) * (segment.x - center_x) + (start_y - center_y) * (segment.y - center_y)
+            if cross == 0 or (clockwise is not None and clockwise != (cross < 0)):
+                return None
+            clockwise = cross < 0
+            total_angle += abs(math.atan2(cross, dot))
+
+            total_length += math.hypot(segment.x - start_x, segment.y - start_y)
+            total_extrusion += segment.extrusion
+
+        if total_angle >= 2 * math.pi - 1e-3 or total_length == 0:
+            return None
+
+        # the extrusion is spread evenly over the arc, so the segments must already be extruded evenly
+        extrusion_rate = total_extrusion / total_length
+        for (index, segment) in enumerate(segments):
+            (start_x, start_y) = points[index]
+            length = math.hypot(segment.x - start_x, segment.y - start_y)
+            if abs(segment.extrusion - length * extrusion_rate) > length * extrusion_rate * EXTRUSION_RATE_TOLERANCE:
+                return None
+
+        return (center_x, center_y, clockwise)
+
+    def _formatArc(self, start, segments, relative_e, statistics):
+        (center_x, center_y, clockwise) = self._fitArc(start, segments)
+        statistics["arcs"] += 1
+        statistics["segments"] += len(segments)
+
+        end = segments[-1]
+        if relative_e:
+            e_text = "%.5f" % sum([segment.extrusion for segment in segments])
+        else:
+            e_text = end.e_text
+        return "G%d%s X%s Y%s I%.3f J%.3f E%s\n" % (
+            2 if clockwise else 3,
+            " F%s" % segments[0].feedrate_text if segments[0].feedrate_text is not None else "",
+            end.x_text, end.y_text, center_x - start[0], center_y - start[1], e_text
+        )
+
+    def finishGcodeFile(self, file_path):
+        statistics = self._statistics
+        if statistics is None:
+            return
+        logger.info("Arc fitting replaced %d segments with %d arcs: %d fewer lines (%.1f%%), %d fewer bytes (%.1f%%)" % (
+            statistics["segments"], statistics["arcs"],
+            statistics["lines_in"] - statistics["lines_out"], 100 * (1 - statistics["lines_out"] / max(1, statistics["lines_in"])),
+            statistics["bytes_in"] - statistics["bytes_out"], 100 * (1 - statistics["bytes_out"] / max(1, statistics["bytes_in"]))
+        ))
@@ -0,0 +1,125 @@
+# Copyright (c) 2020 Autodrop3D and Aldo Hoeben / fieldOfView
+# BeltEngine is released under the terms of the AGPLv3 or higher.
+
+import os
+import json
+import mmap
+
+import logging
+logger = logging.getLogger("BeltEngine")
+
+def getLayerIndexFilePath(gcode_file_path):
+    return os.path.abspath(gcode_file_path) + ".index.json"
+
+class GcodeLayerIndex():
+    INDEX_VERSION = 1
+
+    def __init__(self):
+        # [layer_number, byte offset of the ;LAYER: line]
+        self._layers = []
+        # [byte offset, layer_number, "TYPE" or "MESH", name]
+        self._sections = []
+        self._file_size = 0
+
+        self._layer_number = -1
+        self._layer_lookup = None
+
+    # Record the byte offset of a line that is about to be written. Lines are expected to
+    # start with their marker, but may contain more than one line of gcode.
+    def addLine(self, line, offset):
+        if not line.startswith(";"):
+            return
+        if line.startswith(";LAYER:"):
+            self._layer_number = int(line[7:])
+            self._layers.append([self._layer_number, offset])
+            self._layer_lookup = None
+        elif line.startswith(";TYPE:") or line.startswith(";MESH:"):
+            self._sections.append([offset, self._layer_number, line[1:5], line[6:].strip()])
+
+    def setFileSize(self, file_size):
+        self._file_size = file_size
+
+    def getLayerNumbers(self):
+        return [layer[0] for layer in self._layers]
+
+    def getLayerOffset(self, layer_number):
+        return self.getLayerRange(layer_number)[0]
+
+    # Get the byte range [start, end) of a layer in the gcode file
+    def getLayerRange(self, layer_number):
+        if self._layer_lookup is None:
+            self._layer_lookup = {layer[0]: position for position, layer in enumerate(self._layers)}
+        if layer_number not in self._layer_lookup:
+            raise KeyError("Layer %d is not in the gcode file" % layer_number)
+
+        position = self._layer_lookup[layer_number]
+        start = self._layers[position][1]
+        if position + 1 < len(self._layers):
+            end = self._layers[position + 1][1]
+        else:
+            end = self._file_size
+        return (start, end)
+
+    def getSections(self, layer_number = None):
+        if layer_number is None:
+            return self._sections
+        return [section for section in self._sections if section[1] == layer_number]
+
+    # Open the gcode file with the file pointer positioned at the start of a layer
+    def openAtLayer(self, gcode_file_path, layer_number):
+        file_pointer = open(os.path.abspath(gcode_file_path), "rb")
+        file_pointer.seek(self.getLayerOffset(layer_number))
+        return file_pointer
+
+    # Read the gcode of a single layer without reading the rest of the file
+    def readLayer(self, gcode_file_path, layer_number):
+        (start, end) = self.getLayerRange(layer_number)
+        with open(os.path.abspath(gcode_file_path), "rb") as file_pointer:
+            with mmap.mmap(file_pointer.fileno(), 0, access=mmap.ACCESS_READ) as gcode_map:
+                return gcode_map[start:end].decode()
+
+    def save(self, index_file_path):
+        data = {
+            "version": self.INDEX_VERSION,
+            "file_size": self._file_size,
+            "layers": self._layers,
+            "sections": self._sections
+        }
+        with open(os.path.abspath(index_file_path), "w") as file_pointer:
+            json.dump(data, file_pointer, separators=(",", ":"))
+
+    # Load the index for a gcode file, or return None if there is no up to date index
+    @classmethod
+    def load(cls, gcode_file_path, index_file_path = None):
+        if index_file_path is None:
+            index_file_path = getLayerIndexFilePath(gcode_file_path)
+        if not os.path.exists(index_file_path):
+            return None
+
+        with open(index_file_path) as file_pointer:
+            data = json.load(file_pointer)
+        if data.get("version") != cls.INDEX_VERSION:
+            logger.warning("Ignoring layer index with unsupported version: %s" % index_file_path)
+            return None
+        if data["file_size"] != os.path.getsize(gcode_file_path):
+            logger.warning("Ignoring outdated layer index: %s" % index_file_path)
+            return None
+
+        layer_index = cls()
+        layer_index._layers = data["layers"]
+        layer_index._sections = data["sections"]
+        layer_index._file_size = data["file_size"]
+        return layer_index
+
+    # Build an index by scanning a gcode file that was written without one
+    @classmethod
+    def fromGcodeFile(cls, gcode_file_path):
+        layer_index = cls()
+        offset = 0
+        with open(os.path.abspath(gcode_file_path), "rb") as file_pointer:
+            for line in file_pointer:
+                if line.startswith(b";"):
+                    layer_index.addLine(line.decode(errors="replace"), offset)
+                offset += len(line)
+        layer_index.setFileSize(offset)
+        return layer_index
@@ -0,0 +1,212 @@
+# Copyright (c) 2020 Autodrop3D and Aldo Hoeben / fieldOfView
+# BeltEngine is released under the terms of the AGPLv3 or higher.
+
+import math
+
+from .GcodePipeline import GcodeStage
+
+import logging
+logger = logging.getLogger("BeltEngine")
+
+# decimals that are written when the steps per mm of an axis are not known
+DEFAULT_DECIMALS = {"X": 3, "Y": 3, "Z": 3, "E": 5}
+MAXIMUM_DECIMALS = 5
+# the transfer time of the gcode is estimated for a serial connection with this baudrate and
+# 10 bits per byte (8N1)
+SERIAL_BAUDRATE = 115200
+
+# Makes the gcode smaller as it streams past. Numbers are rounded to the size of a motor step of
+# their axis, words that repeat the current position or feedrate are dropped, and optionally all
+# comments except the ;LAYER: markers are removed.
+# Relative moves carry their rounding error over to the next move, and so do absolute E values
+# over G92 resets, so the rounding errors do not add up.
+# A feedrate is only dropped when it is the last feedrate of any move and of the moves of the same
+# type, so it is redundant both for firmware that shares the feedrate between G0 and G1 and for
+# firmware that does not.
+class GcodeMinifier(GcodeStage):
+    # steps_per_mm is a dict with the steps per mm of the X, Y, Z and E axes
+    def __init__(self, steps_per_mm = None, strip_comments = False):
+        super().__init__("minify")
+
+        steps_per_mm = steps_per_mm or {}
+        self._decimals = {"F": 0}
+        for axis in "XYZE":
+            steps = steps_per_mm.get(axis)
+            if steps:
+                # enough decimals to address a single step
+                self._decimals[axis] = max(0, min(MAXIMUM_DECIMALS, math.ceil(math.log10(steps))))
+            else:
+                self._decimals[axis] = DEFAULT_DECIMALS[axis]
+        # arc centers are offsets along X and Y
+        self._decimals["I"] = self._decimals["X"]
+        self._decimals["J"] = self._decimals["Y"]
+        self._decimals["R"] = max(self._decimals["X"], self._decimals["Y"])
+
+        self._strip_comments = strip_comments
+        self._statistics = None
+
+    def getDecimals(self):
+        return self._decimals
+
+    def getStatistics(self):
+        return self._statistics
+
+    def processStream(self, gcode_lines):
+        statistics = {"lines_in": 0, "lines_out": 0, "bytes_in": 0, "bytes_out": 0}
+        self._statistics = statistics
+        decimals = self._decimals
+
+        # the positions as they were written, None when unknown
+        position = {"X": None, "Y": None, "Z": None, "E": None}
+        # rounding errors of relative moves that still have to be moved
+        carry = {"X": 0.0, "Y": 0.0, "Z": 0.0, "E": 0.0}
+        # in absolute extrusion mode E is written as the E of the input plus this offset, which
+        # takes the rounding error into account whenever E is reset
+        input_e = 0.0
+        e_offset = 0.0
+        relative_axes = False
+        relative_e = False
+        feedrate = None
+        # G0 -> feedrate, G1 -> feedrate (for G1, G2 and G3)
+        move_feedrates = {}
+
+        for line in gcode_lines:
+            statistics["lines_in"] += 1
+            statistics["bytes_in"] += len(line)
+
+            first_character = line[:1]
+            if first_character == ";" or not line.strip():
+                if self._strip_comments and not line.startswith(";LAYER:"):
+                    continue
+                statistics["lines_out"] += 1
+                statistics["bytes_out"] += len(line)
+                yield line
+                continue
+
+            (code, separator, comment) = line.rstrip("\n").partition(";")
+            words = code.split()
+            command = words[0] if words else ""
+            new_words = None
+
+            if command in ("G0", "G1", "G2", "G3"):
+                is_arc = command in ("G2", "G3")
+                move_type = "G0" if command == "G0" else "G1"
+                new_words = [command]
+                for word in words[1:]:
+                    letter = word[:1]
+                    if letter not in decimals:
+                        new_words.append(word)
+                        continue
+                    try:
+                        value = float(word[1:])
+                    except ValueError:
+                        new_words.append(word)
+                        continue
+
+                    if letter == "F":
+                        value = round(value)
+                        if value == feedrate and value == move_feedrates.get(move_type):
+                            continue
+                        feedrate = move_feedrates[move_type] = value
+                    elif letter in "IJR":
+                        value = round(value, decimals[letter])
+                    elif relative_e if letter == "E" else relative_axes:
+                        value += carry[letter]
+                        rounded = round(value, decimals[letter])
+                        carry[letter] = value - rounded
+                        value = rounded
+                        if position[letter] is not None:
+                            position[letter] = round(position[letter] + value, decimals[letter])
+                        if value == 0 and not is_arc:
+                            continue
+                    else:
+                        if letter == "E":
+                            input_e = value
+                            value += e_offset
+                        value = round(value, decimals[letter])
+                        # arcs without X or Y end where they start, so those are always written
+                        if value == position[letter] and not (is_arc and letter in "XY"):
+                            continue
+                        position[letter] = value
+                    new_words.append(letter + self._formatNumber(value, decimals[letter]))
+
+                if len(new_words) == 1 and not is_arc:
+                    # nothing is left to move or set
+                    new_words = []
+
+            elif command == "G92":
+                new_words = [command]
+                for word in words[1:]:
+                    letter = word[:1]
+                    if letter not in position:
+                        new_words.append(word)
+                        continue
+                    try:
+                        value = float(word[1:])
+                    except ValueError:
+                        new_words.append(word)
+                        continue
+                    rounded = round(value, decimals[letter])
+                    if letter == "E" and not relative_e:
+                        # the written E values are off by the rounding error so far; the next E
+                        # values make up for that, so the error does not add up over many resets
+                        error = position["E"] - input_e - e_offset if position["E"] is not None else 0.0
+                        e_offset = rounded - value - error
+                        input_e = value
+                    position[letter] = rounded
+                    new_words.append(letter + self._formatNumber(rounded, decimals[letter]))
+                if len(words) == 1:
+                    position = {"X": 0.0, "Y": 0.0, "Z": 0.0, "E": 0.0}
+                    input_e = e_offset = 0.0
+
+            elif command == "G28":
+                # homed axes end up at a position that is not known here
+                position = {"X": None, "Y": None, "Z": None, "E": position["E"]}
+            elif command in ("G90", "G91"):
+                relative_axes = relative_e = command == "G91"
+                position = {"X": None, "Y": None, "Z": None, "E": None}
+                e_offset = 0.0
+            elif command in ("M82", "M83"):
+                relative_e = command == "M83"
+                position["E"] = None
+                e_offset = 0.0
+
+            if new_words is None and not (self._strip_comments and separator):
+                # lines that are not changed are passed on as they are
+                statistics["lines_out"] += 1
+                statistics["bytes_out"] += len(line)
+                yield line
+                continue
+
+            new_code = " ".join(new_words) if new_words is not None else code.strip()
+            if separator and not self._strip_comments:
+                new_line = (new_code + " " if new_code else "") + separator + comment + "\n"
+            elif new_code:
+                new_line = new_code + "\n"
+            else:
+                continue
+
+            statistics["lines_out"] += 1
+            statistics["bytes_out"] += len(new_line)
+            yield new_line
+
+    def _formatNumber(self, value, decimals):
+        text = "%.*f" % (decimals, value)
+        if "." in text:
+            text = text.rstrip("0").rstrip(".")
+        if text == "-0":
+            text = "0"
+        return text
+
+    def finishGcodeFile(self, file_path):
+        statistics = self._statistics
+        if statistics is None:
+            return
+        transfer_time_in = statistics["bytes_in"] * 10 / SERIAL_BAUDRATE
+        transfer_time_out = statistics["bytes_out"] * 10 / SERIAL_BAUDRATE
+        logger.info("Minifying removed %d lines (%.1f%%) and %d bytes (%.1f%%); sending the gcode at %d baud takes %dm%02ds instead of %dm%02ds" % (
+            statistics["lines_in"] - statistics["lines_out"], 100 * (1 - statistics["lines_out"] / max(1, statistics["lines_in"])),
+            statistics["bytes_in"] - statistics["bytes_out"], 100 * (1 - statistics["bytes_out"] / max(1, statistics["bytes_in"])),
+            SERIAL_BAUDRATE,
+            transfer_time_out // 60, transfer_time_out % 60, transfer_time_in // 60, transfer_time_in % 60
+        ))
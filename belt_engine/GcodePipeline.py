@@ -0,0 +1,141 @@
+# Copyright (c) 2020 Autodrop3D and Aldo Hoeben / fieldOfView
+# BeltEngine is released under the terms of the AGPLv3 or higher.
+
+import os
+import time
+
+from .GcodeLayerIndex import GcodeLayerIndex
+
+import logging
+logger = logging.getLogger("BeltEngine")
+
+# Base class for a post-processing stage. A stage transforms a stream of gcode lines into
+# another stream of gcode lines, one line per item.
+class GcodeStage():
+    def __init__(self, name):
+        self._name = name
+
+    def getName(self):
+        return self._name
+
+    # The first stage of a pipeline receives the list of lines of the file,
+    # later stages receive the output of the previous stage as an iterator.
+    def processStream(self, gcode_lines):
+        return iter(gcode_lines)
+
+    # Called after the output of the pipeline has been written to the file
+    def finishGcodeFile(self, file_path):
+        pass
+
+# Runs all registered stages over a gcode file with a single read and a single write.
+class GcodePipeline():
+    # When streaming the file, lines are read while the output is written to a temporary file,
+    # instead of holding all lines of the file in memory.
+    def __init__(self, stream_file = False):
+        self._stream_file = stream_file
+        self._stages = []
+        self._timings = {}
+        self._timed_stages = []
+
+    def addStage(self, stage):
+        self._stages.append(stage)
+
+    def getStages(self):
+        return self._stages
+
+    def getTimings(self):
+        return self._timings
+
+    def processGcodeFile(self, file_path, layer_index_file_path = None):
+        self._timings = {}
+        layer_index = GcodeLayerIndex() if layer_index_file_path else None
+
+        if self._stream_file:
+            start_time = time.monotonic()
+            temp_file_path = os.path.abspath(file_path) + ".tmp"
+            with open(os.path.abspath(file_path), "r") as file_pointer:
+                self._writeGcodeFile(temp_file_path, self.processGcode(file_pointer), layer_index)
+            os.replace(temp_file_path, os.path.abspath(file_path))
+        else:
+            start_time = time.monotonic()
+            gcode_lines = self._openGcodeFile(file_path)
+            self._timings["read"] = time.monotonic() - start_time
+
+            start_time = time.monotonic()
+            self._writeGcodeFile(file_path, self.processGcode(gcode_lines), layer_index)
+
+        if layer_index:
+            layer_index.save(layer_index_file_path)
+        write_time = time.monotonic() - start_time
+
+        for stage in self._stages:
+            stage.finishGcodeFile(file_path)
+
+        # the stages ran while the lines were being written
+        for timed_stage in self._timed_stages:
+            self._timings[timed_stage.getName()] = timed_stage.getOwnTime()
+            write_time -= timed_stage.getOwnTime()
+        self._timings["write"] = write_time
+
+        for name, duration in self._timings.items():
+            logger.debug("Post processing %s took %.3fs" % (name, duration))
+
+    # Chain the stages; nothing is processed until the returned iterator is consumed
+    def processGcode(self, gcode_lines):
+        gcode_stream = gcode_lines
+        self._timed_stages = []
+        for stage in self._stages:
+            upstream = self._timed_stages[-1] if self._timed_stages else None
+            gcode_stream = _TimedIterator(stage.processStream(gcode_stream), stage.getName(), upstream)
+            self._timed_stages.append(gcode_stream)
+        return iter(gcode_stream)
+
+    def _openGcodeFile(self, file_path):
+        file_pointer = open(os.path.abspath(file_path), "r")
+        gcode_lines = file_pointer.readlines()
+        file_pointer.close()
+        return gcode_lines
+
+    def _writeGcodeFile(self, file_path, gcode_lines, layer_index = None):
+        file_pointer = open(os.path.abspath(file_path), "w")
+        if layer_index is None:
+            file_pointer.writelines(gcode_lines)
+        else:
+            # keep track of byte offsets as the lines are written; text mode translates newlines
+            extra_newline_length = len(os.linesep) - 1
+            offset = 0
+            for line in gcode_lines:
+                layer_index.addLine(line, offset)
+                file_pointer.write(line)
+                offset += len(line.encode(file_pointer.encoding)) + line.count("\n") * extra_newline_length
+            layer_index.setFileSize(offset)
+        file_pointer.close()
+
+
+# Measures the time spent producing the lines of a stage, excluding the time spent in the
+# stages before it.
+class _TimedIterator():
+    def __init__(self, iterator, name, upstream):
+        self._iterator = iterator
+        self._name = name
+        self._upstream = upstream
+        self._total_time = 0
+
+    def getName(self):
+        return self._name
+
+    def getTotalTime(self):
+        return self._total_time
+
+    def getOwnTime(self):
+        return self._total_time - (self._upstream.getTotalTime() if self._upstream else 0)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start_time = time.monotonic()
+        try:
+            return next(self._iterator)
+        finally:
+            self._total_time += time.monotonic() - start_time
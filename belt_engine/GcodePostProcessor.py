@@ -3,109 +3,197 @@
 
 import os
 import re
+import concurrent.futures
+
+from .GcodePipeline import GcodeStage, GcodePipeline
 
 import logging
 logger = logging.getLogger("BeltEngine")
 
-class GcodePostProcessor():
+speed_regex = re.compile(r" F\d*\.?\d*")
+extrude_regex = re.compile(r" E-?\d*\.?\d*")
+move_parameters_regex = re.compile(r"([YEF]-?\d*\.?\d+)")
+
+# (layer_number, y, last_y, e, last_e, f) at the start of the file
+INITIAL_BELT_WALL_STATE = (-1, None, None, None, None, None)
+
+# files smaller than this are not worth starting worker processes for
+MINIMUM_PARALLEL_LINES = 200000
+CHUNKS_PER_JOB = 4
+STREAM_BATCH_SIZE = 10000
+
+# Adjusts the speed and flow of walls that touch the belt
+class GcodePostProcessor(GcodeStage):
     def __init__(self,
                 belt_wall_enable = False,
                 belt_wall_flow = 100,
                 belt_wall_speed = 30,
-                wall_line_width_0 = 0.4
+                wall_line_width_0 = 0.4,
+                jobs = 1
         ):
+        super().__init__("belt wall")
 
         self._belt_wall_enable = belt_wall_enable
         self._belt_wall_flow = belt_wall_flow / 100
         self._belt_wall_speed = belt_wall_speed * 60
         self._minimum_y = wall_line_width_0 * 0.6 #  0.5 would be non-tolerant
-
-    def processGcodeFile(self, file_path):
-        gcode_lines = self._openGcodeFile(file_path)
-        gcode_lines = self.processGcode(gcode_lines)
-        self._writeGcodeFile(file_path, gcode_lines)
-
-    def _openGcodeFile(self, file_path):
-        file_pointer = open(os.path.abspath(file_path), "r")
-        gcode_lines = file_pointer.readlines()
-        file_pointer.close()
-        return gcode_lines
-
-    def _writeGcodeFile(self, file_path, gcode_lines):
-        file_pointer = open(os.path.abspath(file_path), "w")
-        file_pointer.writelines(gcode_lines)
-        file_pointer.close()
+        self._jobs = jobs
+
+    def processGcodeFile(self, file_path, layer_index_file_path = None):
+        pipeline = GcodePipeline()
+        pipeline.addStage(self)
+        pipeline.processGcodeFile(file_path, layer_index_file_path)
+
+    # A list of lines can be split into chunks for parallel processing, so the belt wall
+    # adjustment is most efficient as the first stage of a pipeline. Other streams are
+    # processed in batches of lines.
+    def processStream(self, gcode_lines):
+        if isinstance(gcode_lines, list):
+            yield from self._splitLines(self.processGcode(gcode_lines))
+            return
+
+        state = INITIAL_BELT_WALL_STATE
+        for batch in _batched(gcode_lines, STREAM_BATCH_SIZE):
+            if self._belt_wall_enable:
+                (state, _) = self._adjustBeltWalls(batch, state)
+            yield from self._splitLines(batch)
+
+    def _splitLines(self, gcode_lines):
+        for line in gcode_lines:
+            if line.find("\n") < len(line) - 1:
+                # adjusted lines may have been expanded into multiple lines
+                yield from line.splitlines(True)
+            else:
+                yield line
 
     def processGcode(self, gcode_lines):
         # adjust walls that touch the belt
         if self._belt_wall_enable:
-            y = None
-            last_y = None
-            e = None
-            last_e = None
-            f = None
-
-            speed_regex = re.compile(r" F\d*\.?\d*")
-            extrude_regex = re.compile(r" E-?\d*\.?\d*")
-            move_parameters_regex = re.compile(r"([YEF]-?\d*\.?\d+)")
-
-            #for layer_number, layer in enumerate(gcode_list):
-            #    if layer_number < 2 or layer_number > len(gcode_list) - 1:
-            #        # gcode_list[0]: curaengine header
-            #        # gcode_list[1]: start gcode
-            #        # gcode_list[2] - gcode_list[n-1]: layers
-            #        # gcode_list[n]: end gcode
-            #        continue
-
-            layer_number = -1
-            for line_number, line in enumerate(gcode_lines):
-                if line.startswith(";LAYER:"):
-                    layer_number = int(line[7:])
-                if layer_number < 1:
-                    continue
-
-                line_has_e = False
-                line_has_axis = False
-
-                gcode_command = line.split(' ', 1)[0]
-                if gcode_command not in ["G0", "G1", "G92"]:
-                    continue
-
-                result = re.findall(move_parameters_regex, line)
-                if not result:
-                    continue
-
-                for match in result:
-                    parameter = match[:1]
-                    value = float(match[1:])
-                    if parameter == "Y":
-                        y = value
-                        line_has_axis = True
-                    elif parameter == "E":
-                        e = value
-                        line_has_e = True
-                    elif parameter == "F":
-                        f = value
-                    elif parameter in "XZ":
-                        line_has_axis = True
-
-                if gcode_command != "G92" and line_has_axis and line_has_e and f is not None and y is not None and y <= self._minimum_y and last_y is not None and last_y <= self._minimum_y:
-                    if f > self._belt_wall_speed:
-                        # Remove pre-existing move speed and add our own
-                        line = re.sub(speed_regex, r"", line)
-
-                    if self._belt_wall_flow != 1.0 and last_y is not None:
-                        new_e = last_e + (e - last_e) * self._belt_wall_flow
-                        line = re.sub(extrude_regex, " E%f" % new_e, line)
-                        line = line.strip() + " ; Adjusted E for belt wall\nG92 E%f ; Reset E to pre-compensated value\n" % e
-
-                    if f > self._belt_wall_speed:
-                        g_type = int(line[1:2])
-                        line = "G%d F%d ; Belt wall speed\n%s\nG%d F%d ; Restored speed\n" % (g_type, self._belt_wall_speed, line.strip(), g_type, f)
-
-                    gcode_lines[line_number] = line
-
-                last_y = y
-                last_e = e
-
-        return gcode_lines
\ No newline at end of file
+            if self._jobs > 1 and len(gcode_lines) >= MINIMUM_PARALLEL_LINES:
+                return self._processGcodeParallel(gcode_lines)
+
+            self._adjustBeltWalls(gcode_lines, INITIAL_BELT_WALL_STATE)
+
+        return gcode_lines
+
+    # Processes chunks of layers in parallel. Every chunk is processed without knowing the state
+    # at the end of the previous chunk. The lines up to the point where the chunk has established
+    # its own state are processed again in order, using the state of the previous chunk.
+    def _processGcodeParallel(self, gcode_lines):
+        chunk_size = len(gcode_lines) / (self._jobs * CHUNKS_PER_JOB)
+        chunk_starts = [0]
+        for line_number, line in enumerate(gcode_lines):
+            if line_number - chunk_starts[-1] >= chunk_size and line.startswith(";LAYER:"):
+                chunk_starts.append(line_number)
+        chunk_ends = chunk_starts[1:] + [len(gcode_lines)]
+
+        logger.debug("Post processing %d lines of gcode in %d chunks" % (len(gcode_lines), len(chunk_starts)))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self._jobs) as executor:
+            chunk_results = list(executor.map(_adjustBeltWallsInChunk,
+                [self] * len(chunk_starts),
+                [gcode_lines[start:end] for start, end in zip(chunk_starts, chunk_ends)]
+            ))
+
+        processed_lines = []
+        state = INITIAL_BELT_WALL_STATE
+        for start, (settled_lines, settled_line_number, chunk_state) in zip(chunk_starts, chunk_results):
+            unsettled_lines = gcode_lines[start:start + settled_line_number]
+            (state, _) = self._adjustBeltWalls(unsettled_lines, state)
+            if settled_lines:
+                state = chunk_state
+
+            processed_lines.extend(unsettled_lines)
+            processed_lines.extend(settled_lines)
+
+        return processed_lines
+
+    # Adjusts the lines in place, starting from the state (layer_number, y, last_y, e, last_e, f).
+    # Returns the state after the last line and the number of the first line whose adjustment
+    # no longer depends on the state that was passed in. A speculative pass only adjusts lines
+    # from that line onwards.
+    def _adjustBeltWalls(self, gcode_lines, state, speculative = False):
+        (layer_number, y, last_y, e, last_e, f) = state
+        settled_line_number = None
+
+        #for layer_number, layer in enumerate(gcode_list):
+        #    if layer_number < 2 or layer_number > len(gcode_list) - 1:
+        #        # gcode_list[0]: curaengine header
+        #        # gcode_list[1]: start gcode
+        #        # gcode_list[2] - gcode_list[n-1]: layers
+        #        # gcode_list[n]: end gcode
+        #        continue
+
+        for line_number, line in enumerate(gcode_lines):
+            if line.startswith(";LAYER:"):
+                layer_number = int(line[7:])
+            if layer_number < 1:
+                continue
+
+            line_has_e = False
+            line_has_axis = False
+
+            gcode_command = line.split(' ', 1)[0]
+            if gcode_command not in ["G0", "G1", "G92"]:
+                continue
+
+            result = re.findall(move_parameters_regex, line)
+            if not result:
+                continue
+
+            for match in result:
+                parameter = match[:1]
+                value = float(match[1:])
+                if parameter == "Y":
+                    y = value
+                    line_has_axis = True
+                elif parameter == "E":
+                    e = value
+                    line_has_e = True
+                elif parameter == "F":
+                    f = value
+                elif parameter in "XZ":
+                    line_has_axis = True
+
+            can_adjust = not speculative or settled_line_number is not None
+            if can_adjust and gcode_command != "G92" and line_has_axis and line_has_e and f is not None and y is not None and y <= self._minimum_y and last_y is not None and last_y <= self._minimum_y:
+                if f > self._belt_wall_speed:
+                    # Remove pre-existing move speed and add our own
+                    line = re.sub(speed_regex, r"", line)
+
+                if self._belt_wall_flow != 1.0 and last_y is not None:
+                    new_e = last_e + (e - last_e) * self._belt_wall_flow
+                    line = re.sub(extrude_regex, " E%f" % new_e, line)
+                    line = line.strip() + " ; Adjusted E for belt wall\nG92 E%f ; Reset E to pre-compensated value\n" % e
+
+                if f > self._belt_wall_speed:
+                    g_type = int(line[1:2])
+                    line = "G%d F%d ; Belt wall speed\n%s\nG%d F%d ; Restored speed\n" % (g_type, self._belt_wall_speed, line.strip(), g_type, f)
+
+                gcode_lines[line_number] = line
+
+            last_y = y
+            last_e = e
+
+            if settled_line_number is None and y is not None and e is not None and f is not None:
+                settled_line_number = line_number + 1
+
+        return ((layer_number, y, last_y, e, last_e, f), settled_line_number)
+
+
+# Runs in a worker process; returns the settled part of the chunk, where it starts and the
+# state at the end of the chunk.
+def _adjustBeltWallsInChunk(post_processor, gcode_lines):
+    (state, settled_line_number) = post_processor._adjustBeltWalls(gcode_lines, INITIAL_BELT_WALL_STATE, speculative=True)
+    if settled_line_number is None:
+        settled_line_number = len(gcode_lines)
+    return (gcode_lines[settled_line_number:], settled_line_number, state)
+
+def _batched(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
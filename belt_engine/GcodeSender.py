@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020 Autodrop3D and Aldo Hoeben / fieldOfView
+# BeltEngine is released under the terms of the AGPLv3 or higher.
+
+import os
+import sys
+import gzip
+import time
+import queue
+import select
+import argparse
+import threading
+from collections import OrderedDict, deque
+from typing import NamedTuple, Optional
+
+try:
+    import termios
+    import tty
+except ImportError:
+    termios = None
+
+from .GcodeLayerIndex import GcodeLayerIndex
+
+import logging
+logger = logging.getLogger("BeltEngine")
+
+# size of the serial receive buffer of the printer; Marlin uses 128 bytes by default
+DEFAULT_RX_BUFFER_SIZE = 128
+# number of lines that are read ahead from the gcode file
+DEFAULT_LOOKAHEAD = 1000
+# number of sent lines that are kept to answer resend requests
+HISTORY_SIZE = 1000
+# seconds to wait for the printer to start after the port is opened, which resets most printers
+DEFAULT_STARTUP_TIMEOUT = 5
+# seconds without input after which the printer is done printing its startup messages
+STARTUP_QUIET_TIME = 0.5
+# seconds between progress messages
+PROGRESS_INTERVAL = 60
+# seconds without a response from the printer after which a warning is logged
+RESPONSE_WARNING_TIME = 120
+
+SendResult = NamedTuple("SendResult", [
+    ("lines", int),  # lines of gcode that were sent, without resent lines
+    ("bytes", int),  # bytes written to the port, including line numbers, checksums and resent lines
+    ("wall_time", float),
+    ("resends", int),
+    ("buffer_underruns", int),  # times the printer had acknowledged every line sent to it before the print was done
+    ("lookahead_underruns", int),  # times the printer had room for a line that had not been read from the file yet
+    ("average_buffer_fill", float),  # average fraction of the receive buffer of the printer in use
+    ("error", Optional[str])
+])
+
+# Streams gcode to a printer over a serial port. Lines are numbered and checksummed, and are sent as
+# long as they fit in the receive buffer of the printer: every "ok" frees the bytes of the oldest line
+# that was not acknowledged yet (character counting), so the printer always has lines to parse
+# instead of waiting for the next line after every "ok". A thread reads the gcode file ahead of the
+# printer, so reading and decompressing the file does not hold up the serial connection.
+class GcodeSender():
+    def __init__(self,
+                port,
+                baudrate = 115200,
+                rx_buffer_size = DEFAULT_RX_BUFFER_SIZE,
+                lookahead = DEFAULT_LOOKAHEAD,
+                startup_timeout = DEFAULT_STARTUP_TIMEOUT
+        ):
+
+        if termios is None:
+            raise OSError("Serial ports are not supported on this platform")
+        speed = getattr(termios, "B%d" % baudrate, None)
+        if speed is None:
+            raise ValueError("Unsupported baudrate: %d" % baudrate)
+
+        self._rx_buffer_size = rx_buffer_size
+        self._lookahead = lookahead
+        self._startup_timeout = startup_timeout
+
+        self._read_buffer = b""
+        self._stop_reading = threading.Event()
+
+        self._fd = os.open(port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            tty.setraw(self._fd)
+            attributes = termios.tcgetattr(self._fd)
+            attributes[2] |= termios.CLOCAL | termios.CREAD
+            attributes[4] = attributes[5] = speed
+            termios.tcsetattr(self._fd, termios.TCSANOW, attributes)
+            termios.tcflush(self._fd, termios.TCIOFLUSH)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    # Send the lines of gcode (with or without comments) and return a SendResult
+    def send(self, gcode_lines):
+        start_time = time.monotonic()
+        lookahead = queue.Queue(maxsize=self._lookahead)
+        self._stop_reading.clear()
+        reader_thread = threading.Thread(target=self._readAhead, args=(gcode_lines, lookahead), daemon=True)
+        reader_thread.start()
+
+        # buffer_fill_time is the integral of the bytes in the receive buffer of the printer over time
+        statistics = {"lines": 0, "bytes": 0, "resends": 0, "buffer_underruns": 0, "lookahead_underruns": 0, "buffer_fill_time": 0.0}
+        error = None
+        try:
+            self._waitForStartup()
+            # the statistics are about sending the gcode, without the time it took to start
+            start_time = time.monotonic()
+            error = self._sendLoop(lookahead, statistics)
+        except OSError as e:
+            error = "Serial port error: %s" % e
+        finally:
+            self._stop_reading.set()
+
+        wall_time = time.monotonic() - start_time
+        return SendResult(
+            lines=statistics["lines"],
+            bytes=statistics["bytes"],
+            wall_time=wall_time,
+            resends=statistics["resends"],
+            buffer_underruns=statistics["buffer_underruns"],
+            lookahead_underruns=statistics["lookahead_underruns"],
+            average_buffer_fill=statistics["buffer_fill_time"] / (wall_time * self._rx_buffer_size) if wall_time > 0 else 0,
+            error=error
+        )
+
+    def _sendLoop(self, lookahead, statistics):
+        # (line number, data) of the lines that were sent but not acknowledged
+        pending = deque()
+        pending_bytes = 0
+        # line number -> data of the last lines that were sent
+        history = OrderedDict()
+        resend_queue = deque()
+        # resend requests for lines the printer discarded after it asked for a resend
+        last_resend_number = None
+        ignored_resends = 0
+
+        # start numbering lines at 0, so resend requests refer to the lines of this print
+        next_line = (0, self._formatLine(0, "M110 N0"))
+        line_number = 1
+        is_reading = True
+        is_lookahead_empty = False
+        layer = None
+
+        start_time = time.monotonic()
+        last_time = start_time
+        last_response_time = last_time
+        last_progress_time = last_time
+
+        while True:
+            # send lines as long as they fit in the receive buffer of the printer
+            while True:
+                if next_line is None and resend_queue:
+                    next_line = resend_queue.popleft()
+                while next_line is None and is_reading:
+                    try:
+                        # only wait for the file if the printer has nothing else to do
+                        (item_type, value) = lookahead.get(timeout=0.1) if not pending else lookahead.get_nowait()
+                    except queue.Empty:
+                        if not is_lookahead_empty:
+                            statistics["lookahead_underruns"] += 1
+                            is_lookahead_empty = True
+                        if pending:
+                            break
+                        continue
+                    is_lookahead_empty = False
+                    if item_type == "gcode":
+                        next_line = (line_number, self._formatLine(line_number, value))
+                        line_number += 1
+                        statistics["lines"] += 1
+                    elif item_type == "layer":
+                        layer = value
+                    elif item_type == "error":
+                        return "Could not read the gcode: %s" % value
+                    else:
+                        is_reading = False
+
+                # a line that is longer than the buffer is sent when the buffer is empty
+                if next_line is None or (pending and pending_bytes + len(next_line[1]) > self._rx_buffer_size):
+                    break
+                self._write(next_line[1])
+                statistics["bytes"] += len(next_line[1])
+                pending.append(next_line)
+                pending_bytes += len(next_line[1])
+                history[next_line[0]] = next_line[1]
+                if len(history) > HISTORY_SIZE:
+                    history.popitem(last=False)
+                next_line = None
+
+            if not pending and next_line is None and not resend_queue and not is_reading:
+                break
+
+            now = time.monotonic()
+            statistics["buffer_fill_time"] += pending_bytes * (now - last_time)
+            last_time = now
+            if now - last_progress_time > PROGRESS_INTERVAL:
+                logger.info("Layer %s, sent %d lines (%.0f lines/s)" % (layer, statistics["lines"], statistics["lines"] / (now - start_time)))
+                last_progress_time = now
+            if now - last_response_time > RESPONSE_WARNING_TIME:
+                logger.warning("The printer has not responded for %d seconds" % (now - last_response_time))
+                last_response_time = now
+
+            for response in self._readResponses(0.1):
+                last_response_time = time.monotonic()
+                lower_response = response.lower()
+                if response.startswith("ok"):
+                    if pending:
+                        (acknowledged_number, acknowledged_data) = pending.popleft()
+                        pending_bytes -= len(acknowledged_data)
+                        if not pending and (is_reading or resend_queue):
+                            statistics["buffer_underruns"] += 1
+                elif lower_response.startswith("resend:") or lower_response.startswith("rs "):
+                    try:
+                        resend_number = int(response.split(":" if ":" in response else " ", 1)[1].strip().lstrip("N"))
+                    except (IndexError, ValueError):
+                        logger.warning("Could not parse resend request: %s" % response)
+                        continue
+                    if ignored_resends > 0 and resend_number == last_resend_number:
+                        ignored_resends -= 1
+                        continue
+                    if resend_number not in history:
+                        return "The printer asked to resend line %d, which is no longer available" % resend_number
+                    logger.debug("Resending from line %d" % resend_number)
+                    statistics["resends"] += 1
+
+                    # the printer discards the lines after the one it asks for, each with a resend
+                    # request and an ok of its own, so they stay in its receive buffer until then
+                    last_resend_number = resend_number
+                    ignored_resends = len([number for (number, data) in pending if number is not None and number > resend_number])
+                    pending = deque([(None, data) for (number, data) in pending])
+                    resend_queue = deque([(number, data) for (number, data) in history.items() if number >= resend_number])
+                    if next_line is not None and next_line[0] not in history:
+                        resend_queue.append(next_line)
+                    next_line = None
+                elif response.startswith("!!") or "halted" in lower_response:
+                    return "The printer stopped: %s" % response
+                elif response.startswith("Error:") and "Last Line" not in response:
+                    # errors about line numbers and checksums are followed by a resend request
+                    logger.warning("Printer: %s" % response)
+                else:
+                    logger.debug("Printer: %s" % response)
+
+        return None
+
+    # Read the gcode into the lookahead queue as ("gcode", command), ("layer", layer number),
+    # ("error", message) and finally ("end", None)
+    def _readAhead(self, gcode_lines, lookahead):
+        try:
+            for line in gcode_lines:
+                if line.startswith(";LAYER:"):
+                    item = ("layer", line[7:].strip())
+                else:
+                    code = line.split(";", 1)[0].strip()
+                    if not code:
+                        continue
+                    item = ("gcode", code)
+                if not self._putItem(lookahead, item):
+                    return
+        except Exception as e:
+            self._putItem(lookahead, ("error", str(e)))
+            return
+        self._putItem(lookahead, ("end", None))
+
+    def _putItem(self, lookahead, item):
+        while not self._stop_reading.is_set():
+            try:
+                lookahead.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # Most printers reset when the port is opened; wait until they have printed their startup
+    # messages, or until the timeout if they don't report that they have started
+    def _waitForStartup(self):
+        start_time = time.monotonic()
+        started = False
+        while time.monotonic() - start_time < self._startup_timeout:
+            responses = self._readResponses(STARTUP_QUIET_TIME)
+            for response in responses:
+                logger.debug("Printer: %s" % response)
+                if response.startswith("start"):
+                    started = True
+            if started and not responses:
+                break
+
+    def _formatLine(self, line_number, command):
+        data = ("N%d %s" % (line_number, command)).encode()
+        checksum = 0
+        for character in data:
+            checksum ^= character
+        return data + b"*%d\n" % checksum
+
+    def _write(self, data):
+        while data:
+            select.select([], [self._fd], [])
+            try:
+                written = os.write(self._fd, data)
+            except BlockingIOError:
+                continue
+            data = data[written:]
+
+    # The complete lines received within the timeout
+    def _readResponses(self, timeout):
+        (readable, writable, exceptional) = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            self._read_buffer += os.read(self._fd, 4096)
+        except BlockingIOError:
+            return []
+
+        lines = self._read_buffer.split(b"\n")
+        self._read_buffer = lines.pop()
+        return [line.decode(errors="replace").strip() for line in lines if line.strip()]
+
+# Open a gcode file, which may be gzip compressed, for reading as binary lines
+def openGcodeFile(file_path):
+    if file_path.endswith(".gz"):
+        return gzip.open(file_path, "rb")
+    return open(file_path, "rb")
+
+# The lines of a gcode file as text. When resuming at a layer, the gcode before that layer is
+# replaced by gcode that restores the state of the printer at the start of the layer. That state can
+# be set anywhere before the layer, so the lines before it are still read, but they are not kept.
+# The layer index is used to check that the layer exists and where it starts, if there is one.
+def readGcodeFile(file_path, resume_layer = None):
+    layer_offset = None
+    if resume_layer is not None and not file_path.endswith(".gz"):
+        layer_index = GcodeLayerIndex.load(file_path)
+        if layer_index:
+            layer_offset = layer_index.getLayerOffset(resume_layer)
+
+    file_pointer = openGcodeFile(file_path)
+    try:
+        first_lines = []
+        if resume_layer is not None:
+            layer_marker = (";LAYER:%d" % resume_layer).encode()
+            printer_state = _PrinterState()
+            offset = 0
+            for line in file_pointer:
+                if layer_offset is not None and offset >= layer_offset:
+                    if offset > layer_offset or line.strip() != layer_marker:
+                        raise KeyError("The layer index does not match the gcode file at layer %d" % resume_layer)
+                    break
+                if layer_offset is None and line.strip() == layer_marker:
+                    break
+                printer_state.processLine(line.decode(errors="replace"))
+                offset += len(line)
+            else:
+                raise KeyError("Layer %d is not in the gcode file" % resume_layer)
+            first_lines = printer_state.getResumeGcode(resume_layer) + [line.decode(errors="replace")]
+    except Exception:
+        file_pointer.close()
+        raise
+    return _iterateLines(file_pointer, first_lines)
+
+def _iterateLines(file_pointer, first_lines):
+    with file_pointer:
+        yield from first_lines
+        for line in file_pointer:
+            yield line.decode(errors="replace")
+
+# Gcode that restores the state of the printer at the end of the gcode lines, see _PrinterState
+def getResumeGcode(gcode_lines, layer_number):
+    printer_state = _PrinterState()
+    for line in gcode_lines:
+        printer_state.processLine(line)
+    return printer_state.getResumeGcode(layer_number)
+
+# Keeps track of the temperatures, fan speed, positioning modes, active tool, feedrate and E position
+# of the printer while reading gcode
+class _PrinterState():
+    def __init__(self):
+        self._relative_axes = False
+        self._relative_e = False
+        self._e = 0.0
+        self._feedrate = None
+        self._tool = None
+        self._hotend_temperatures = OrderedDict()
+        self._bed_temperature = None
+        self._fan_speed = None
+
+    def processLine(self, line):
+        # only moves, G92, G90/G91, M-codes and tool changes change the state
+        if line[:1] not in ("G", "M", "T"):
+            return
+        words = line.split(";", 1)[0].split()
+        if not words:
+            return
+        command = words[0]
+        parameters = {word[0]: word[1:] for word in words[1:]}
+
+        if command in ("G0", "G1", "G2", "G3"):
+            if "E" in parameters:
+                self._e = self._e + float(parameters["E"]) if self._relative_e else float(parameters["E"])
+            if "F" in parameters:
+                self._feedrate = parameters["F"]
+        elif command == "G92":
+            if "E" in parameters:
+                self._e = float(parameters["E"])
+            elif len(words) == 1:
+                self._e = 0.0
+        elif command in ("G90", "G91"):
+            self._relative_axes = self._relative_e = command == "G91"
+        elif command in ("M82", "M83"):
+            self._relative_e = command == "M83"
+        elif command in ("M104", "M109"):
+            temperature = parameters.get("S", parameters.get("R"))
+            if temperature is not None:
+                self._hotend_temperatures[parameters.get("T", self._tool or "0")] = temperature
+        elif command in ("M140", "M190"):
+            temperature = parameters.get("S", parameters.get("R"))
+            if temperature is not None:
+                self._bed_temperature = temperature
+        elif command == "M106":
+            self._fan_speed = parameters.get("S", "255")
+        elif command == "M107":
+            self._fan_speed = "0"
+        elif command[0] == "T" and command[1:].isdigit():
+            self._tool = command[1:]
+
+    # The axes are not moved, so the printer has to be at a known position before the print is resumed
+    def getResumeGcode(self, layer_number):
+        resume_gcode = [";Resuming at layer %d\n" % layer_number]
+        if self._bed_temperature is not None:
+            resume_gcode.append("M140 S%s\n" % self._bed_temperature)
+        for (extruder, temperature) in self._hotend_temperatures.items():
+            resume_gcode.append("M104 T%s S%s\n" % (extruder, temperature))
+        if self._bed_temperature is not None:
+            resume_gcode.append("M190 S%s\n" % self._bed_temperature)
+        for (extruder, temperature) in self._hotend_temperatures.items():
+            resume_gcode.append("M109 T%s S%s\n" % (extruder, temperature))
+        resume_gcode.append("G91\n" if self._relative_axes else "G90\n")
+        resume_gcode.append("M83\n" if self._relative_e else "M82\n")
+        if self._tool is not None:
+            resume_gcode.append("T%s\n" % self._tool)
+        if self._fan_speed is not None:
+            resume_gcode.append("M106 S%s\n" % self._fan_speed)
+        if not self._relative_e:
+            resume_gcode.append("G92 E%.5f\n" % self._e)
+        if self._feedrate is not None:
+            resume_gcode.append("G1 F%s\n" % self._feedrate)
+        return resume_gcode
+
+def main():
+    # the log output is set up by BeltEngine
+    from . import BeltEngine
+
+    parser = argparse.ArgumentParser(description="Stream gcode to a printer over a serial port.")
+    parser.add_argument("-v", action="store_true", help="show verbose messages")
+    parser.add_argument("--port", type=str, required=True, help="serial port of the printer, eg /dev/ttyUSB0")
+    parser.add_argument("--baudrate", type=int, default=115200, help="baudrate of the serial port (default 115200)")
+    parser.add_argument("--rx-buffer-size", type=int, default=DEFAULT_RX_BUFFER_SIZE, help="size of the serial receive buffer of the printer in bytes (default %d)" % DEFAULT_RX_BUFFER_SIZE)
+    parser.add_argument("--lookahead", type=int, default=DEFAULT_LOOKAHEAD, help="number of lines to read ahead from the gcode file (default %d)" % DEFAULT_LOOKAHEAD)
+    parser.add_argument("--startup-timeout", type=float, default=DEFAULT_STARTUP_TIMEOUT, help="seconds to wait for the printer to start after the port is opened (default %d)" % DEFAULT_STARTUP_TIMEOUT)
+    parser.add_argument("--resume-layer", type=int, help="start printing at this layer, after restoring the temperatures and E position")
+    parser.add_argument("gcode", type=str, help="gcode file to print, may be gzip compressed")
+
+    known_args = vars(parser.parse_args())
+    logger.setLevel(logging.DEBUG if known_args["v"] else logging.INFO)
+
+    if not os.path.exists(known_args["gcode"]):
+        logger.error("Gcode file not found: %s" % known_args["gcode"])
+        return 1
+    try:
+        gcode_lines = readGcodeFile(known_args["gcode"], known_args["resume_layer"])
+    except (KeyError, OSError) as e:
+        logger.error("Could not read the gcode: %s" % str(e).strip("'\""))
+        return 1
+    if known_args["resume_layer"] is not None:
+        logger.info("Resuming at layer %d" % known_args["resume_layer"])
+
+    try:
+        sender = GcodeSender(
+            known_args["port"],
+            baudrate=known_args["baudrate"],
+            rx_buffer_size=known_args["rx_buffer_size"],
+            lookahead=known_args["lookahead"],
+            startup_timeout=known_args["startup_timeout"]
+        )
+    except (OSError, ValueError) as e:
+        logger.error("Could not open %s: %s" % (known_args["port"], e))
+        return 1
+
+    try:
+        result = sender.send(gcode_lines)
+    finally:
+        sender.close()
+
+    logger.info("Sent %d lines and %d bytes in %dm%02ds (%.0f lines/s, %.0f bytes/s)" % (
+        result.lines, result.bytes, result.wall_time // 60, result.wall_time % 60,
+        result.lines / max(result.wall_time, 1e-6), result.bytes / max(result.wall_time, 1e-6)
+    ))
+    logger.info("The receive buffer of the printer was %.0f%% full on average and ran empty %d times; the gcode file was not read in time %d times; %d resend requests" % (
+        100 * result.average_buffer_fill, result.buffer_underruns, result.lookahead_underruns, result.resends
+    ))
+    if result.error:
+        logger.error("Printing failed: %s" % result.error)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,325 @@
+# Copyright (c) 2020 Autodrop3D and Aldo Hoeben / fieldOfView
+# BeltEngine is released under the terms of the AGPLv3 or higher.
+
+import os
+import re
+import json
+import math
+
+import numpy
+
+from .GcodePipeline import GcodeStage
+
+import logging
+logger = logging.getLogger("BeltEngine")
+
+def getStatisticsFilePath(gcode_file_path):
+    return os.path.abspath(gcode_file_path) + ".stats.json"
+
+# header lines that CuraEngine fills in for the pretransformed meshes, and the lines that are added
+HEADER_KEYS = [";Filament used:", ";MINX:", ";MINY:", ";MINZ:", ";MAXX:", ";MAXY:", ";MAXZ:"]
+BELT_HEADER_KEYS = [";BELT_MIN:", ";BELT_MAX:"]
+
+# header lines are padded to this length, so they can be overwritten once the values are known
+HEADER_LINE_LENGTH = 48
+# the header is never longer than this
+MAXIMUM_HEADER_LINES = 200
+# number of extruded points that are collected before their bounds are computed
+POINTS_PER_BATCH = 65536
+# arcs are cut into segments that are at most this far from the arc to find their bounds
+ARC_BOUNDS_TOLERANCE = 0.001
+MAXIMUM_ARC_SEGMENTS = 1000
+
+move_parameters_regex = re.compile(r"([XYZEFIJR])(-?\d*\.?\d+)")
+
+# Collects statistics of the gcode as it streams past: bounds of the extruded moves in machine
+# coordinates and (for belt printers) in the coordinates of the model on the belt, the amount
+# of extruded filament, a move time estimate per layer and a histogram of the feedrates.
+# The time estimate uses the feedrates only and ignores acceleration. Arcs (G2/G3) are taken to be
+# in the XY plane (G17), which is the only plane CuraEngine and the arc fitter use.
+# After the file has been written, the placeholders in the header are overwritten with the results.
+class GcodeStatistics(GcodeStage):
+    # gcode_to_belt_matrix is a 4x4 matrix (nested lists) that transforms gcode coordinates
+    # to coordinates on the belt: x across the belt, y above the belt and z along the belt
+    def __init__(self, gcode_to_belt_matrix = None, statistics_file_path = None):
+        super().__init__("statistics")
+
+        self._gcode_to_belt_matrix = gcode_to_belt_matrix
+        self._statistics_file_path = statistics_file_path
+        self._statistics = None
+
+    def getStatistics(self):
+        return self._statistics
+
+    def processStream(self, gcode_lines):
+        x = y = z = e = 0.0
+        f = 0.0
+        relative_axes = False
+        relative_e = False
+
+        extruded = 0.0
+        # coordinates of the extruded moves, reduced to bounds in batches
+        extrusion_points = []
+        bounds = None
+
+        layer_number = None
+        layer_time = 0.0
+        layer_times = []
+        total_time = 0.0
+        # feedrate in mm/min -> [moves, distance, time]
+        feedrates = {}
+
+        in_header = True
+        header_line_number = 0
+        start_recorded = False
+
+        for line in gcode_lines:
+            if in_header:
+                header_line_number += 1
+                if line.startswith(";LAYER") or header_line_number > MAXIMUM_HEADER_LINES:
+                    in_header = False
+                elif line.startswith(";"):
+                    for key in HEADER_KEYS:
+                        if line.startswith(key):
+                            line = self._padHeaderLine(line.rstrip("\n"))
+                            if key == ";MAXZ:" and self._gcode_to_belt_matrix is not None:
+                                yield line
+                                yield self._padHeaderLine(BELT_HEADER_KEYS[0])
+                                line = self._padHeaderLine(BELT_HEADER_KEYS[1])
+                            break
+
+            first_character = line[:1]
+            if first_character == "G":
+                code = line.partition(";")[0]
+                command = code.split(" ", 1)[0].strip()
+
+                if command in ("G0", "G1", "G2", "G3"):
+                    new_x, new_y, new_z, new_e = x, y, z, e
+                    arc_parameters = {}
+                    for (axis, value) in move_parameters_regex.findall(code):
+                        value = float(value)
+                        if axis == "X":
+                            new_x = x + value if relative_axes else value
+                        elif axis == "Y":
+                            new_y = y + value if relative_axes else value
+                        elif axis == "Z":
+                            new_z = z + value if relative_axes else value
+                        elif axis == "E":
+                            new_e = e + value if relative_e else value
+                        elif axis == "F":
+                            f = value
+                        else:
+                            arc_parameters[axis] = value
+
+                    arc_points = None
+                    if command == "G0" or command == "G1":
+                        distance = math.sqrt((new_x - x) ** 2 + (new_y - y) ** 2 + (new_z - z) ** 2)
+                    else:
+                        (distance, arc_points) = self._getArc((x, y, z), (new_x, new_y, new_z), arc_parameters, command == "G2")
+                    extrusion = new_e - e
+                    if distance == 0:
+                        distance = abs(extrusion)
+                    if distance > 0 and f > 0:
+                        move_time = distance * 60 / f
+                        layer_time += move_time
+                        feedrate_stats = feedrates.get(f)
+                        if feedrate_stats is None:
+                            feedrate_stats = feedrates[f] = [0, 0.0, 0.0]
+                        feedrate_stats[0] += 1
+                        feedrate_stats[1] += distance
+                        feedrate_stats[2] += move_time
+
+                    if extrusion > 0 and (new_x != x or new_y != y or new_z != z or arc_points):
+                        if not start_recorded:
+                            extrusion_points.extend((x, y, z))
+                        if arc_points:
+                            extrusion_points.extend(arc_points)
+                        extrusion_points.extend((new_x, new_y, new_z))
+                        if len(extrusion_points) >= POINTS_PER_BATCH * 3:
+                            bounds = self._updateBounds(bounds, extrusion_points)
+                            extrusion_points = []
+                        start_recorded = True
+                    else:
+                        start_recorded = False
+
+                    extruded += extrusion
+                    x, y, z, e = new_x, new_y, new_z, new_e
+
+                elif command == "G92":
+                    parameters = move_parameters_regex.findall(code)
+                    if not parameters:
+                        x = y = z = e = 0.0
+                    for (axis, value) in parameters:
+                        if axis == "E":
+                            e = float(value)
+                        elif axis == "X":
+                            x = float(value)
+                        elif axis == "Y":
+                            y = float(value)
+                        elif axis == "Z":
+                            z = float(value)
+                    start_recorded = False
+                elif command == "G90":
+                    relative_axes = False
+                    relative_e = False
+                elif command == "G91":
+                    relative_axes = True
+                    relative_e = True
+
+            elif first_character == "M":
+                if line.startswith("M82"):
+                    relative_e = False
+                elif line.startswith("M83"):
+                    relative_e = True
+
+            elif line.startswith(";LAYER:"):
+                if layer_number is not None:
+                    layer_times.append([layer_number, layer_time])
+                total_time += layer_time
+                layer_time = 0.0
+                try:
+                    layer_number = int(line[7:])
+                except ValueError:
+                    pass
+
+            yield line
+
+        if layer_number is not None:
+            layer_times.append([layer_number, layer_time])
+        total_time += layer_time
+
+        bounds = self._updateBounds(bounds, extrusion_points)
+
+        # feedrates in mm/s, rounded to 0.1mm/s
+        feedrate_histogram = {}
+        for (feedrate, stats) in feedrates.items():
+            histogram_stats = feedrate_histogram.setdefault(round(feedrate / 60, 1), [0, 0.0, 0.0])
+            for index, value in enumerate(stats):
+                histogram_stats[index] += value
+
+        self._statistics = {
+            "machine_bounds": {"min": bounds[0][0], "max": bounds[0][1]} if bounds else None,
+            "belt_bounds": {"min": bounds[1][0], "max": bounds[1][1]} if bounds and bounds[1] else None,
+            "extrusion": extruded,
+            "estimated_time": total_time,
+            "layer_times": layer_times,
+            "feedrate_histogram": [
+                {"feedrate": feedrate, "moves": stats[0], "distance": stats[1], "time": stats[2]}
+                for (feedrate, stats) in sorted(feedrate_histogram.items())
+            ]
+        }
+
+    # Returns the length of an arc from start to end, and the flattened points between them that
+    # are within ARC_BOUNDS_TOLERANCE of the arc. The center is given as I/J offsets from the start,
+    # or as a radius R, where a negative radius selects the arc of more than half a circle.
+    def _getArc(self, start, end, arc_parameters, clockwise):
+        (x, y, z) = start
+        (new_x, new_y, new_z) = end
+        if "I" in arc_parameters or "J" in arc_parameters:
+            center_x = x + arc_parameters.get("I", 0.0)
+            center_y = y + arc_parameters.get("J", 0.0)
+        elif arc_parameters.get("R") and (new_x != x or new_y != y):
+            # the center lies on the perpendicular bisector of the chord, like Marlin computes it
+            radius = arc_parameters["R"]
+            chord_x = new_x - x
+            chord_y = new_y - y
+            chord = math.hypot(chord_x, chord_y)
+            offset = math.sqrt(max(0.0, (radius - chord / 2) * (radius + chord / 2)))
+            if clockwise != (radius < 0):
+                offset = -offset
+            center_x = (x + new_x) / 2 - offset * chord_y / chord
+            center_y = (y + new_y) / 2 + offset * chord_x / chord
+        else:
+            return (math.sqrt((new_x - x) ** 2 + (new_y - y) ** 2 + (new_z - z) ** 2), None)
+
+        radius = math.hypot(x - center_x, y - center_y)
+        start_angle = math.atan2(y - center_y, x - center_x)
+        end_angle = math.atan2(new_y - center_y, new_x - center_x)
+        sweep = start_angle - end_angle if clockwise else end_angle - start_angle
+        # an arc that ends where it starts is a full circle
+        if sweep <= 0:
+            sweep += 2 * math.pi
+        length = math.hypot(radius * sweep, new_z - z)
+
+        if radius <= ARC_BOUNDS_TOLERANCE:
+            return (length, None)
+        segment_angle = 2 * math.acos(1 - ARC_BOUNDS_TOLERANCE / radius)
+        segments = min(MAXIMUM_ARC_SEGMENTS, max(1, math.ceil(sweep / segment_angle)))
+        direction = -1 if clockwise else 1
+        points = []
+        for segment in range(1, segments):
+            fraction = segment / segments
+            angle = start_angle + direction * sweep * fraction
+            points.extend((center_x + radius * math.cos(angle), center_y + radius * math.sin(angle), z + (new_z - z) * fraction))
+        return (length, points)
+
+    # Combine the bounds of a batch of points with the bounds so far:
+    # ([minimum, maximum] in machine coordinates, [minimum, maximum] on the belt or None)
+    def _updateBounds(self, bounds, flat_points):
+        if not flat_points:
+            return bounds
+        points = numpy.array(flat_points).reshape(-1, 3)
+        point_sets = [points]
+        if self._gcode_to_belt_matrix is not None:
+            matrix = numpy.array(self._gcode_to_belt_matrix)
+            point_sets.append(points.dot(matrix[:3, :3].T) + matrix[:3, 3])
+
+        new_bounds = []
+        for set_index, point_set in enumerate(point_sets):
+            minimum = point_set.min(axis=0)
+            maximum = point_set.max(axis=0)
+            if bounds:
+                minimum = numpy.minimum(minimum, bounds[set_index][0])
+                maximum = numpy.maximum(maximum, bounds[set_index][1])
+            new_bounds.append([minimum.tolist(), maximum.tolist()])
+        if len(new_bounds) < 2:
+            new_bounds.append(None)
+        return new_bounds
+
+    # Overwrite the placeholders in the header and write the statistics file
+    def finishGcodeFile(self, file_path):
+        if self._statistics is None:
+            return
+
+        header_values = self._getHeaderValues()
+        with open(os.path.abspath(file_path), "r+b") as file_pointer:
+            for _ in range(MAXIMUM_HEADER_LINES):
+                offset = file_pointer.tell()
+                line = file_pointer.readline()
+                if not line or line.startswith(b";LAYER"):
+                    break
+                key = line[:line.find(b":") + 1].decode(errors="replace")
+                if key not in header_values:
+                    continue
+
+                new_line = self._padHeaderLine(key + header_values[key]).encode()
+                if len(new_line) != len(line.rstrip(b"\r\n")) + 1 or line.rstrip(b"\r\n")[-1:] != b" ":
+                    logger.warning("Could not update header line %s" % line.decode(errors="replace").strip())
+                    continue
+                file_pointer.seek(offset)
+                file_pointer.write(new_line[:-1])
+                file_pointer.seek(offset + len(line))
+
+        if self._statistics_file_path:
+            with open(self._statistics_file_path, "w") as file_pointer:
+                json.dump(self._statistics, file_pointer, indent=1)
+
+        logger.info("Estimated print time %dm%02ds, %.2fm of filament" % (
+            self._statistics["estimated_time"] // 60, self._statistics["estimated_time"] % 60, self._statistics["extrusion"] / 1000
+        ))
+
+    def _getHeaderValues(self):
+        header_values = {";Filament used:": " %.5fm" % (self._statistics["extrusion"] / 1000)}
+        bounds = self._statistics["machine_bounds"]
+        if bounds:
+            for axis, name in enumerate("XYZ"):
+                header_values[";MIN%s:" % name] = "%.3f" % bounds["min"][axis]
+                header_values[";MAX%s:" % name] = "%.3f" % bounds["max"][axis]
+        belt_bounds = self._statistics["belt_bounds"]
+        if belt_bounds:
+            header_values[";BELT_MIN:"] = ",".join(["%.3f" % value for value in belt_bounds["min"]])
+            header_values[";BELT_MAX:"] = ",".join(["%.3f" % value for value in belt_bounds["max"]])
+        return header_values
+
+    def _padHeaderLine(self, line):
+        return line.ljust(HEADER_LINE_LENGTH - 1) + "\n"
@@ -0,0 +1,372 @@
+# Copyright (c) 2020 Autodrop3D and Aldo Hoeben / fieldOfView
+# BeltEngine is released under the terms of the AGPLv3 or higher.
+
+import os
+import re
+import math
+import tempfile
+from typing import NamedTuple, Optional
+
+import trimesh
+
+import logging
+logger = logging.getLogger("BeltEngine")
+
+# Layer numbers where a range starts its slice are a multiple of this, so patterns that alternate
+# per layer (infill and skin angles, combined infill layers) continue across the ranges
+LAYER_PATTERN_PERIOD = 12
+# ;TIME: and ;LAYER_COUNT: are padded to this length, so they can be overwritten after stitching
+HEADER_LINE_LENGTH = 32
+
+LayerRange = NamedTuple("LayerRange", [
+    ("first_layer", int),  # layer number of the first layer CuraEngine slices for this range
+    ("start_layer", int),  # first layer that is used
+    ("end_layer", Optional[int]),  # first layer that is not used, None for the last range
+    ("z_offset", float),  # added to the Z coordinates of the gcode
+    ("mesh_file_paths", dict)  # stage -> cut mesh file; empty if the range has no geometry
+])
+
+move_parameters_regex = re.compile(r"([EF])(-?\d*\.?\d+)")
+z_parameter_regex = re.compile(r" Z(-?\d*\.?\d+)")
+
+# Splits the meshes of a slice into ranges of layers that are sliced by separate CuraEngine
+# processes, and stitches the gcode of those processes back together.
+#
+# All ranges use the layers of a single run: layer n is sliced at the same height and printed at
+# lh0 + n * lh. Every range except the first is sliced with a layer_height_0 of layer_height and
+# starts some layers below the layers it is used for, so top and bottom skins see the layers
+# around them. Those extra layers are dropped again while stitching.
+class LayerRangeSlicer():
+    def __init__(self,
+                range_count,
+                layer_height_0,
+                layer_height,
+                overlap_layers = 2,
+                remove_empty_first_layers = True,
+                retraction_speed = 25
+        ):
+
+        self._range_count = range_count
+        # CuraEngine computes the layer heights in whole micrometers
+        self._layer_height_0 = round(layer_height_0 * 1000) / 1000
+        self._layer_height = round(layer_height * 1000) / 1000
+        self._overlap_layers = overlap_layers
+        self._remove_empty_first_layers = remove_empty_first_layers
+        self._retraction_speed = retraction_speed
+
+        self._ranges = []
+        self._temp_file_paths = []
+
+        # state of the stitched gcode
+        self._next_layer_number = 0
+        self._elapsed_time = 0.0
+        self._header_offsets = {}
+
+    def getRanges(self):
+        return self._ranges
+
+    # Cut the meshes in mesh_file_paths (stage -> file) into layer ranges. Returns the ranges,
+    # or an empty list if the meshes don't have enough layers to split.
+    def splitMeshes(self, mesh_file_paths):
+        meshes = {stage: trimesh.load(file_path) for (stage, file_path) in mesh_file_paths.items()}
+        z_minimum = min([mesh.bounds[0][2] for mesh in meshes.values()])
+        z_maximum = max([mesh.bounds[1][2] for mesh in meshes.values()])
+
+        layer_height_0 = self._layer_height_0
+        layer_height = self._layer_height
+
+        # CuraEngine removes the empty layers below the meshes and prints the first remaining layer
+        # at layer_height_0. The meshes are moved down by the same number of layers instead, so the
+        # layer numbers of the ranges don't depend on which layers CuraEngine considers empty.
+        removed_layers = 0
+        if self._remove_empty_first_layers:
+            removed_layers = max(0, math.floor((z_minimum - layer_height_0 / 2) / layer_height) + 1)
+        z_shift = removed_layers * layer_height
+
+        # layer n > 0 is sliced at lh0 + (n - 0.5) * lh
+        layer_count = max(1, math.ceil((z_maximum - z_shift - layer_height_0 + layer_height / 2) / layer_height))
+
+        minimum_range_layers = 2 * (self._overlap_layers + LAYER_PATTERN_PERIOD)
+        range_count = min(self._range_count, layer_count // minimum_range_layers)
+        if range_count < 2:
+            logger.info("Model has %d layers, which is too few to slice in separate ranges" % layer_count)
+            return []
+
+        self._ranges = []
+        for range_index in range(range_count):
+            start_layer = round(range_index * layer_count / range_count)
+            end_layer = round((range_index + 1) * layer_count / range_count) if range_index < range_count - 1 else None
+
+            if range_index == 0:
+                first_layer = 0
+                z_offset = 0.0
+                z_bottom = 0.0
+            else:
+                first_layer = (start_layer - self._overlap_layers) // LAYER_PATTERN_PERIOD * LAYER_PATTERN_PERIOD
+                # bottom of the first layer of the range
+                z_offset = z_bottom = layer_height_0 + (first_layer - 1) * layer_height
+            # top of the last layer that is sliced for the range
+            z_top = layer_height_0 + (end_layer + self._overlap_layers - 1) * layer_height if end_layer is not None else None
+
+            range_mesh_file_paths = {}
+            for (stage, mesh) in meshes.items():
+                range_mesh = self._cutMesh(mesh, z_shift + z_bottom, z_shift + z_top if z_top is not None else None)
+                if range_mesh is None:
+                    continue
+                range_mesh.apply_translation([0, 0, -(z_shift + z_bottom)])
+
+                (file_descriptor, range_mesh_file_path) = tempfile.mkstemp(suffix=".stl")
+                os.close(file_descriptor)
+                self._temp_file_paths.append(range_mesh_file_path)
+                range_mesh.export(range_mesh_file_path)
+                range_mesh_file_paths[stage] = range_mesh_file_path
+
+            self._ranges.append(LayerRange(first_layer, start_layer, end_layer, z_offset, range_mesh_file_paths))
+
+        logger.info("Split %d layers into ranges starting at layers %s" % (
+            layer_count, ", ".join([str(layer_range.start_layer) for layer_range in self._ranges])
+        ))
+        return self._ranges
+
+    # The part of a mesh between two heights, or None if nothing is left
+    def _cutMesh(self, mesh, z_bottom, z_top):
+        bounds = mesh.bounds
+        if bounds[1][2] <= z_bottom or (z_top is not None and bounds[0][2] >= z_top):
+            return None
+
+        # the cuts are halfway between the heights at which layers are sliced, so the cut faces
+        # don't need to be capped
+        if bounds[0][2] < z_bottom:
+            mesh = trimesh.intersections.slice_mesh_plane(mesh, plane_normal=[0, 0, 1], plane_origin=[0, 0, z_bottom])
+        else:
+            mesh = mesh.copy()
+        if z_top is not None and bounds[1][2] > z_top:
+            mesh = trimesh.intersections.slice_mesh_plane(mesh, plane_normal=[0, 0, -1], plane_origin=[0, 0, z_top])
+        if len(mesh.faces) == 0:
+            return None
+        return mesh
+
+    # Settings that differ from the single run for a range
+    def getRangeEngineSettings(self, range_index):
+        engine_settings = {"remove_empty_first_layers": "false"}
+        if range_index > 0:
+            # the first layers of the range are dropped, the layers that are used are regular layers
+            engine_settings.update({
+                "layer_height_0": self._layer_height,
+                "speed_slowdown_layers": 0,
+                "cool_fan_full_layer": 1
+            })
+        return engine_settings
+
+    def removeTemporaryFiles(self):
+        for file_path in self._temp_file_paths:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        self._temp_file_paths = []
+
+    # Combine the gcode files of the ranges (None for a range without geometry) into one file
+    def stitchGcode(self, range_gcode_file_paths, output_file_path):
+        self._next_layer_number = 0
+        self._elapsed_time = 0.0
+        self._header_offsets = {}
+
+        with open(output_file_path, "wb") as output_file:
+            previous_state = None
+            for (layer_range, gcode_file_path) in zip(self._ranges, range_gcode_file_paths):
+                if gcode_file_path is None:
+                    continue
+                previous_state = self._stitchRange(output_file, layer_range, gcode_file_path, previous_state)
+
+            header_values = {";TIME:": "%d" % self._elapsed_time, ";LAYER_COUNT:": "%d" % self._next_layer_number}
+            for (key, offset) in self._header_offsets.items():
+                output_file.seek(offset)
+                output_file.write(self._padHeaderLine(key + header_values[key]).encode())
+
+        logger.info("Stitched %d layers from %d ranges" % (self._next_layer_number, len(self._ranges)))
+
+    # Copy the layers a range is used for to the output. Returns the extrusion state at the end of
+    # the copied layers.
+    def _stitchRange(self, output_file, layer_range, gcode_file_path, previous_state):
+        state = _ExtrusionState()
+        is_first = previous_state is None
+        is_last = layer_range.end_layer is None
+
+        in_layers = False
+        copying = False
+        # lines after the end of a layer; the end gcode if no layer follows
+        pending_lines = []
+        layer_end_state = None
+        range_elapsed_time = 0.0
+        start_elapsed_time = 0.0
+
+        with open(gcode_file_path) as gcode_file:
+            for line in gcode_file:
+                if line.startswith(";LAYER:"):
+                    in_layers = True
+                    layer_number = layer_range.first_layer + int(line[7:])
+                    if layer_number < layer_range.start_layer:
+                        continue
+                    if layer_range.end_layer is not None and layer_number >= layer_range.end_layer:
+                        break
+
+                    self._writeLines(output_file, pending_lines)
+                    pending_lines = []
+                    if not copying:
+                        copying = True
+                        start_elapsed_time = range_elapsed_time
+                        if not is_first:
+                            self._writeTransition(output_file, previous_state, state)
+                    while self._next_layer_number < layer_number:
+                        self._writeLines(output_file, [";LAYER:%d\n" % self._next_layer_number])
+                        self._next_layer_number += 1
+                    self._writeLines(output_file, [";LAYER:%d\n" % layer_number])
+                    self._next_layer_number = layer_number + 1
+                    continue
+
+                state.processLine(line)
+
+                if not in_layers:
+                    if is_first:
+                        for key in [";TIME:", ";LAYER_COUNT:"]:
+                            if line.startswith(key):
+                                self._header_offsets[key] = output_file.tell()
+                                line = self._padHeaderLine(line.rstrip("\n"))
+                        self._writeLines(output_file, [line])
+                    continue
+
+                if line.startswith(";TIME_ELAPSED:"):
+                    range_elapsed_time = float(line[14:])
+                    if copying:
+                        self._writeLines(output_file, pending_lines)
+                        pending_lines = [";TIME_ELAPSED:%f\n" % (self._elapsed_time + range_elapsed_time - start_elapsed_time)]
+                        layer_end_state = state.copy()
+                    continue
+
+                if not copying:
+                    continue
+
+                if line[:1] == "G" and layer_range.z_offset and " Z" in line:
+                    line = z_parameter_regex.sub(lambda match: " Z%.3f" % (float(match.group(1)) + layer_range.z_offset), line)
+
+                if pending_lines:
+                    pending_lines.append(line)
+                else:
+                    self._writeLines(output_file, [line])
+            else:
+                if not is_last and pending_lines:
+                    # drop the end gcode, but keep the end of the last layer
+                    pending_lines = pending_lines[:1]
+                    state = layer_end_state
+
+        self._writeLines(output_file, pending_lines)
+        self._elapsed_time += range_elapsed_time - start_elapsed_time
+        return state
+
+    # Bring the printer from the state at the end of the previous range to the state the next range
+    # expects at the start of its first layer
+    def _writeTransition(self, output_file, previous_state, state):
+        lines = []
+        for (key, line) in state.getTemperatureLines().items():
+            if previous_state.getTemperatureLines().get(key) != line:
+                lines.append(line.replace("M109", "M104", 1).replace("M190", "M140", 1))
+        if state.getFanLine() and state.getFanLine() != previous_state.getFanLine():
+            lines.append(state.getFanLine())
+
+        # the next range may expect the filament to be retracted when the previous range left it
+        # primed, or the other way around
+        retraction_move = previous_state.getRetraction() - state.getRetraction()
+        if state.isRelativeExtrusion():
+            if abs(retraction_move) > 1e-5:
+                lines.append("G1 F%g E%.5f\n" % (self._retraction_speed * 60, retraction_move))
+        else:
+            lines.append("G92 E%.5f\n" % (state.getE() - retraction_move))
+            if abs(retraction_move) > 1e-5:
+                lines.append("G1 F%g E%.5f\n" % (self._retraction_speed * 60, state.getE()))
+        if state.getFeedrate() and (abs(retraction_move) > 1e-5 or state.getFeedrate() != previous_state.getFeedrate()):
+            lines.append("G1 F%s\n" % state.getFeedrate())
+
+        self._writeLines(output_file, lines)
+
+    def _writeLines(self, output_file, lines):
+        for line in lines:
+            output_file.write(line.encode())
+
+    def _padHeaderLine(self, line):
+        return line.ljust(HEADER_LINE_LENGTH - 1) + "\n"
+
+
+# Keeps track of the extruder while reading gcode: the logical E value, how far the filament is
+# retracted, the feedrate and the last fan and temperature commands
+class _ExtrusionState():
+    def __init__(self):
+        self._e = 0.0
+        self._relative_extrusion = False
+        # filament position, which is not affected by G92, and the furthest it has been pushed
+        self._filament_position = 0.0
+        self._filament_maximum = 0.0
+        self._feedrate = None
+        self._fan_line = None
+        self._temperature_lines = {}
+
+    def copy(self):
+        state = _ExtrusionState()
+        state.__dict__.update(self.__dict__)
+        state._temperature_lines = dict(self._temperature_lines)
+        return state
+
+    def getE(self):
+        return self._e
+
+    def getRetraction(self):
+        return self._filament_maximum - self._filament_position
+
+    def isRelativeExtrusion(self):
+        return self._relative_extrusion
+
+    def getFeedrate(self):
+        return self._feedrate
+
+    def getFanLine(self):
+        return self._fan_line
+
+    def getTemperatureLines(self):
+        return self._temperature_lines
+
+    def processLine(self, line):
+        first_character = line[:1]
+        if first_character == "G":
+            code = line.partition(";")[0]
+            command = code.split(" ", 1)[0].strip()
+            if command in ("G0", "G1", "G2", "G3"):
+                for (parameter, value) in move_parameters_regex.findall(code):
+                    if parameter == "F":
+                        self._feedrate = value
+                        continue
+                    value = float(value)
+                    extrusion = value if self._relative_extrusion else value - self._e
+                    self._e += extrusion
+                    self._filament_position += extrusion
+                    self._filament_maximum = max(self._filament_maximum, self._filament_position)
+            elif command == "G92":
+                parameters = dict(move_parameters_regex.findall(code))
+                if "E" in parameters:
+                    self._e = float(parameters["E"])
+                elif code.strip() == "G92":
+                    self._e = 0.0
+            elif command == "G90":
+                self._relative_extrusion = False
+            elif command == "G91":
+                self._relative_extrusion = True
+        elif first_character == "M":
+            command = line.partition(";")[0].split(" ", 1)[0].strip()
+            if command == "M82":
+                self._relative_extrusion = False
+            elif command == "M83":
+                self._relative_extrusion = True
+            elif command in ("M106", "M107"):
+                self._fan_line = line
+            elif command in ("M104", "M109"):
+                tool = re.search(r" T(\d+)", line)
+                self._temperature_lines["T%s" % (tool.group(1) if tool else "")] = line
+            elif command in ("M140", "M190"):
+                self._temperature_lines["bed"] = line
@@ -0,0 +1,126 @@
+# Copyright (c) 2020 Autodrop3D and Aldo Hoeben / fieldOfView
+# BeltEngine is released under the terms of the AGPLv3 or higher.
+
+import numpy
+import trimesh
+import shapely
+
+import logging
+logger = logging.getLogger("BeltEngine")
+
+# Geometry of a mesh that is needed by more than one step of the mesh preparation. Everything is
+# computed on first use and kept when the mesh is translated, while trimesh clears its own cache
+# whenever the vertices change.
+class MeshAnalysis():
+    def __init__(self, tri_mesh):
+        self._tri_mesh = tri_mesh
+
+        self._face_normals = None
+        self._face_adjacency = None
+        self._component_labels = None
+        self._open_components = None
+        self._winding_consistent = None
+        self._component_volumes = None
+
+        # these change when the mesh is translated
+        self._bounds = None
+        self._footprint = None
+
+    def getMesh(self):
+        return self._tri_mesh
+
+    def getFaceNormals(self):
+        if self._face_normals is None:
+            self._face_normals = self._tri_mesh.face_normals
+        return self._face_normals
+
+    # (n, 2) indices of faces that share an edge
+    def getFaceAdjacency(self):
+        if self._face_adjacency is None:
+            self._face_adjacency = self._tri_mesh.face_adjacency
+        return self._face_adjacency
+
+    # The connected component of every face
+    def getComponentLabels(self):
+        if self._component_labels is None:
+            self._component_labels = trimesh.graph.connected_component_labels(self.getFaceAdjacency(), node_count=len(self._tri_mesh.faces))
+        return self._component_labels
+
+    def getComponentCount(self):
+        labels = self.getComponentLabels()
+        return int(labels.max()) + 1 if len(labels) else 0
+
+    def getBounds(self):
+        if self._bounds is None:
+            self._bounds = self._tri_mesh.bounds
+        return self._bounds
+
+    # Whether every edge that is shared by two faces is used in opposite directions
+    def isWindingConsistent(self):
+        if self._winding_consistent is None:
+            self._winding_consistent = self._tri_mesh.is_winding_consistent
+        return self._winding_consistent
+
+    def isWatertight(self):
+        return not self._getOpenComponents().any()
+
+    # The convex outline of the mesh seen along the y axis, which is the normal of the belt
+    def getFootprint(self):
+        if self._footprint is None:
+            to_2d = trimesh.geometry.plane_transform(origin=None, normal=[0,1,0])
+            projected_vertices = trimesh.transformations.transform_points(self._tri_mesh.vertices, to_2d)[:, :2]
+            self._footprint = shapely.geometry.MultiPoint(projected_vertices).convex_hull
+        return self._footprint
+
+    def translate(self, offset):
+        self._tri_mesh.apply_transform(trimesh.transformations.translation_matrix(offset))
+        self._bounds = None
+        self._footprint = None
+
+    # Rotate the mesh about its origin; the normals are rotated along instead of being recomputed
+    def rotate(self, rotation_matrix):
+        face_normals = self._face_normals
+        self._tri_mesh.apply_transform(rotation_matrix)
+        if face_normals is not None:
+            self._face_normals = face_normals.dot(numpy.array(rotation_matrix)[:3, :3].T)
+        self._bounds = None
+        self._footprint = None
+
+    # Fix the winding and orientation of the faces like trimesh does, but only if the faces are
+    # not consistently wound or a closed component has its normals pointing inwards.
+    # Returns True if the mesh was changed.
+    def fixNormals(self):
+        if self.isWindingConsistent():
+            closed_volumes = self._getComponentVolumes()[~self._getOpenComponents()]
+            if not (closed_volumes < 0).any():
+                logger.debug("Normals of mesh are consistent, skipping fix_normals")
+                return False
+
+        self._tri_mesh.fix_normals()
+
+        # only the faces have changed
+        self._face_normals = None
+        self._face_adjacency = None
+        self._winding_consistent = None
+        self._component_volumes = None
+        return True
+
+    # Components with an edge that is not shared by exactly two faces
+    def _getOpenComponents(self):
+        if self._open_components is None:
+            component_count = self.getComponentCount()
+            paired_edges = trimesh.grouping.group_rows(self._tri_mesh.edges_sorted, require_count=2)
+            is_paired_edge = numpy.zeros(len(self._tri_mesh.edges), dtype=bool)
+            is_paired_edge[paired_edges.flatten()] = True
+            open_faces = self._tri_mesh.edges_face[~is_paired_edge]
+            self._open_components = numpy.zeros(component_count, dtype=bool)
+            self._open_components[self.getComponentLabels()[open_faces]] = True
+        return self._open_components
+
+    # Signed volume of every component; only meaningful for closed components
+    def _getComponentVolumes(self):
+        if self._component_volumes is None:
+            triangles = self._tri_mesh.triangles
+            face_volumes = numpy.einsum("ij,ij->i", triangles[:, 0], numpy.cross(triangles[:, 1], triangles[:, 2])) / 6
+            self._component_volumes = numpy.bincount(self.getComponentLabels(), weights=face_volumes, minlength=self.getComponentCount())
+        return self._component_volumes
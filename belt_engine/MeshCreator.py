@@ -5,6 +5,9 @@ import numpy
 import trimesh
 import shapely
 import math
+import triangle
+
+from .MeshAnalysis import MeshAnalysis
 
 import logging
 logger = logging.getLogger("BeltEngine")
@@ -19,59 +22,64 @@ def isOnPi():
         pass
     return False
 
+# relative tolerance for edges to be on one line, and for the area of a triangulated outline
+STRAIGHT_TOLERANCE = 1e-6
+AREA_TOLERANCE = 1e-6
+
+# heights in the support height map are rounded to this, so hits on edges shared by two faces are equal
+HEIGHT_TOLERANCE = 1e-6
+# cell centers this close to the edge of a face (relative to its size) are inside the face
+BARYCENTRIC_TOLERANCE = 1e-9
+# number of face/cell pairs that are rasterized in one batch
+RASTER_BATCH_SIZE = 2 ** 20
+# the resolution of the support height map is lowered if the grid would have more cells
+MAXIMUM_GRID_CELLS = 2 ** 24
+
 def createSupportMesh(
         tri_mesh,
         support_angle = 50,
         filter_upwards_facing_faces = True,
         down_vector = numpy.array([0, -1, 0]),
         bottom_cut_off = 0,
-        minimum_island_area = 0
+        minimum_island_area = 0,
+        mesh_analysis = None,
+        merge_faces = True
     ):
+    if mesh_analysis is None:
+        mesh_analysis = MeshAnalysis(tri_mesh)
     mesh_vertices = tri_mesh.vertices
-    mesh_indices = tri_mesh.faces
-    cos_support_angle = math.cos(math.radians(90 - support_angle))
 
-    # get indices of faces that face down more than support_angle
-    cos_angle_between_normal_down = numpy.dot(tri_mesh.face_normals, down_vector)
-    faces_needing_support = numpy.argwhere(cos_angle_between_normal_down >= cos_support_angle).flatten()
-    # filter out faces that point upwards
-    if len(faces_needing_support) == 0 and filter_upwards_facing_faces:
-        faces_facing_down = numpy.argwhere(tri_mesh.face_normals[:,1] < 0)
-        faces_needing_support = numpy.intersect1d(faces_facing_down, faces_needing_support)
+    faces_needing_support = _getFacesNeedingSupport(tri_mesh, mesh_analysis, support_angle, filter_upwards_facing_faces, down_vector, bottom_cut_off)
     if len(faces_needing_support) == 0:
         logger.info("Mesh doesn't need support")
         return trimesh.Trimesh()
-    roof_indices = mesh_indices[faces_needing_support]
-
-    # filter out faces that are coplanar with the bottom
-    non_bottom_indices = numpy.where(numpy.any(mesh_vertices[roof_indices].take(1, axis=2) > bottom_cut_off, axis=1))[0].flatten()
-    roof_indices = roof_indices[non_bottom_indices]
-    if len(roof_indices) == 0:
-        logger.info("Mesh doesn't need support")
-        return trimesh.Trimesh()
+    roof_indices = tri_mesh.faces[faces_needing_support]
 
     roof = trimesh.base.Trimesh(vertices=mesh_vertices, faces=roof_indices)
     roof.remove_unreferenced_vertices()
     roof.process()
 
     if minimum_island_area > 0:
-        # filter out all islands that would result in small towers
-        scale_matrix = trimesh.transformations.scale_matrix(0, direction=[0,1,0])
-        roof_elements = roof.split(only_watertight=False)
-        roof = trimesh.base.Trimesh()
-        for roof_element in roof_elements:
-            xy_element = roof_element.copy()
-            xy_element.apply_transform(scale_matrix)
-            if xy_element.area >= minimum_island_area:
-                roof = roof + roof_element
+        # filter out all islands that would result in small towers; the area of a face
+        # projected onto the belt is its area scaled by the y component of its normal
+        roof_analysis = MeshAnalysis(roof)
+        projected_areas = roof.area_faces * numpy.abs(roof_analysis.getFaceNormals()[:,1])
+        island_labels = roof_analysis.getComponentLabels()
+        island_areas = numpy.bincount(island_labels, weights=projected_areas, minlength=roof_analysis.getComponentCount())
+        roof = trimesh.base.Trimesh(vertices=roof.vertices, faces=roof.faces[island_areas[island_labels] >= minimum_island_area], process=False)
+        roof.remove_unreferenced_vertices()
 
     num_roof_vertices = len(roof.vertices)
     if num_roof_vertices == 0:
         logger.info("All surfaces of the mesh that need support are smaller than the minimum_island_area")
         return trimesh.Trimesh()
 
-    connecting_faces = []
+    # directed edges of the roof, to wind the connecting faces the same way as the roof
+    roof_edges = roof.edges.astype(numpy.int64)
+    roof_edge_keys = roof_edges[:,0] * num_roof_vertices + roof_edges[:,1]
 
+    outlines = []
+    outline_edge_count = 0
     roof_outline = roof.outline()
     for entity in roof_outline.entities:
         entity_points = entity.points
@@ -79,27 +87,606 @@ def createSupportMesh(
 
         # numpy magic to find indices for each outline vertex
         outline_indices = numpy.where((roof.vertices==outline[:,None]).all(-1))[1]
+        outlines.append(outline_indices)
+        outline_edge_count += len(outline_indices) - 1
 
-        num_outline_vertices = len(outline)
-        for i in range(0, num_outline_vertices - 1):
-            connecting_faces.append([outline_indices[i], outline_indices[i + 1] + num_roof_vertices, outline_indices[i] + num_roof_vertices])
-            connecting_faces.append([outline_indices[i], outline_indices[i + 1], outline_indices[i + 1] + num_roof_vertices])
+    walls = [_createWallFaces(roof, outline_indices, roof_edge_keys, merge_straight_edges=merge_faces) for outline_indices in outlines]
+    if merge_faces:
+        (bottom_faces, unmerged_outlines) = _createBottomFaces(roof, [bottom_loop for (wall_faces, bottom_loop) in walls])
+        # the bottom of these outlines is the projection of the roof, which needs all outline vertices
+        for outline_number in unmerged_outlines:
+            walls[outline_number] = _createWallFaces(roof, outlines[outline_number], roof_edge_keys)
+    else:
+        # the projection of the roof
+        bottom_faces = roof.faces
+    connecting_faces = [numpy.zeros((0, 3), dtype=roof.faces.dtype)] + [wall_faces for (wall_faces, bottom_loop) in walls]
 
+    # the roof faces face down, so they are reversed to make the top of the support face up
     support_vertices = numpy.concatenate((roof.vertices, roof.vertices * [1,0,1]))
-    support_faces = numpy.concatenate((roof.faces, roof.faces + len(roof.vertices), connecting_faces))
+    support_faces = numpy.concatenate([roof.faces[:, ::-1], bottom_faces + len(roof.vertices)] + connecting_faces)
+    if merge_faces:
+        # without merging, the bottom is a copy of the roof and every outline edge has two wall triangles
+        unmerged_face_count = 2 * len(roof.faces) + 2 * outline_edge_count
+        logger.info("Support mesh has %d triangles instead of %d (%.0f%% fewer)" % (
+            len(support_faces), unmerged_face_count, 100 * (1 - len(support_faces) / unmerged_face_count)
+        ))
 
     support_mesh = trimesh.base.Trimesh(vertices=support_vertices, faces=support_faces)
-    support_mesh.fix_normals()
+    MeshAnalysis(support_mesh).fixNormals()
 
     return support_mesh
 
+# Indices of the faces that face down more than support_angle, without the faces that are coplanar
+# with the bottom
+def _getFacesNeedingSupport(tri_mesh, mesh_analysis, support_angle, filter_upwards_facing_faces, down_vector, bottom_cut_off):
+    face_normals = mesh_analysis.getFaceNormals()
+    cos_support_angle = math.cos(math.radians(90 - support_angle))
+
+    # get indices of faces that face down more than support_angle
+    cos_angle_between_normal_down = numpy.dot(face_normals, down_vector)
+    faces_needing_support = numpy.argwhere(cos_angle_between_normal_down >= cos_support_angle).flatten()
+    # filter out faces that point upwards
+    if len(faces_needing_support) == 0 and filter_upwards_facing_faces:
+        faces_facing_down = numpy.argwhere(face_normals[:,1] < 0)
+        faces_needing_support = numpy.intersect1d(faces_facing_down, faces_needing_support)
+    if len(faces_needing_support) == 0:
+        return faces_needing_support
+
+    # filter out faces that are coplanar with the bottom
+    roof_indices = tri_mesh.faces[faces_needing_support]
+    non_bottom_indices = numpy.where(numpy.any(tri_mesh.vertices[roof_indices].take(1, axis=2) > bottom_cut_off, axis=1))[0].flatten()
+    return faces_needing_support[non_bottom_indices]
+
+# Faces of the wall between an outline loop of the roof (outline_indices, closed) and its copy on the
+# belt, which has the roof vertex indices + the number of roof vertices. Returns the faces and the
+# vertices of the loop on the belt that the faces use, in order.
+# When merging straight edges, the quads of consecutive outline edges that lie on one straight line
+# are triangulated as a fan from the first bottom vertex. The top vertices are all kept, so the wall
+# still matches the roof, but the bottom vertices in between are left out.
+def _createWallFaces(roof, outline_indices, roof_edge_keys, merge_straight_edges = False):
+    num_roof_vertices = len(roof.vertices)
+    start_indices = outline_indices[:-1]
+    end_indices = outline_indices[1:]
+
+    # an outline edge may run in either direction relative to the roof face it belongs to
+    is_reversed_edge = ~numpy.isin(start_indices.astype(numpy.int64) * num_roof_vertices + end_indices, roof_edge_keys)
+
+    # a vertex is straight if the edges before and after it are on one line that does not run
+    # straight up; the projections of those edges onto the belt are on one line too then
+    edge_vectors = roof.vertices[end_indices] - roof.vertices[start_indices]
+    previous_edge_vectors = numpy.roll(edge_vectors, 1, axis=0)
+    edge_lengths = numpy.linalg.norm(edge_vectors, axis=1)
+    is_straight = (
+        (numpy.linalg.norm(numpy.cross(previous_edge_vectors, edge_vectors), axis=1) <= STRAIGHT_TOLERANCE * edge_lengths * numpy.roll(edge_lengths, 1)) &
+        (previous_edge_vectors[:, 0] * edge_vectors[:, 0] + previous_edge_vectors[:, 2] * edge_vectors[:, 2] > 0) &
+        (is_reversed_edge == numpy.roll(is_reversed_edge, 1))
+    )
+    if not merge_straight_edges or is_straight.all():
+        # two triangles for each outline edge, interleaved
+        entity_faces = numpy.stack((
+            numpy.column_stack((start_indices, end_indices + num_roof_vertices, start_indices + num_roof_vertices)),
+            numpy.column_stack((start_indices, end_indices, end_indices + num_roof_vertices))
+        ), axis=1).reshape(-1, 3)
+        is_reversed_face = numpy.repeat(is_reversed_edge, 2)
+        entity_faces[is_reversed_face] = entity_faces[is_reversed_face][:, ::-1]
+        return (entity_faces, start_indices)
+
+    # start the loop at a corner, so every run of straight edges starts at a corner
+    shift = numpy.argmin(is_straight)
+    top_indices = numpy.roll(start_indices, -shift)
+    is_straight = numpy.roll(is_straight, -shift)
+    is_reversed_edge = numpy.roll(is_reversed_edge, -shift)
+    edge_count = len(top_indices)
+    corners = numpy.flatnonzero(~is_straight)
+    closed_top_indices = numpy.append(top_indices, top_indices[0])
+
+    # the corner every edge starts its run from
+    run_starts = numpy.maximum.accumulate(numpy.where(is_straight, 0, numpy.arange(edge_count)))
+    fan_faces = numpy.column_stack((
+        closed_top_indices[:-1], closed_top_indices[1:], top_indices[run_starts] + num_roof_vertices
+    ))
+    # the triangle from the top of the last edge of a run down to both bottom corners
+    run_ends = numpy.append(corners[1:], edge_count)
+    closing_faces = numpy.column_stack((
+        closed_top_indices[run_ends], closed_top_indices[run_ends] + num_roof_vertices, top_indices[corners] + num_roof_vertices
+    ))
+
+    fan_faces[is_reversed_edge] = fan_faces[is_reversed_edge][:, ::-1]
+    is_reversed_run = is_reversed_edge[corners]
+    closing_faces[is_reversed_run] = closing_faces[is_reversed_run][:, ::-1]
+    return (numpy.concatenate((fan_faces, closing_faces)), top_indices[corners])
+
+# Triangulate the bottom of the support, which is the projection of the roof onto the belt, with the
+# vertices of its outline only. The bottom of every connected part of the roof is triangulated
+# separately; the projection of the roof faces is used if the outline does not enclose the same
+# area, for example because the roof overlaps itself when seen from above. Returns the faces and the
+# numbers of the loops that were not used for the bottom.
+def _createBottomFaces(roof, bottom_loops):
+    points = roof.vertices[:, [0, 2]]
+    triangles_2d = points[roof.faces]
+    projected_areas = numpy.abs(numpy.cross(triangles_2d[:, 1] - triangles_2d[:, 0], triangles_2d[:, 2] - triangles_2d[:, 0])) / 2
+
+    roof_analysis = MeshAnalysis(roof)
+    face_labels = roof_analysis.getComponentLabels()
+    component_areas = numpy.bincount(face_labels, weights=projected_areas, minlength=roof_analysis.getComponentCount())
+    vertex_labels = numpy.zeros(len(roof.vertices), dtype=numpy.int64)
+    vertex_labels[roof.faces] = face_labels[:, None]
+
+    component_loops = {}
+    for (loop_number, bottom_loop) in enumerate(bottom_loops):
+        component_loops.setdefault(vertex_labels[bottom_loop[0]], []).append(loop_number)
+
+    bottom_faces = [numpy.zeros((0, 3), dtype=roof.faces.dtype)]
+    unused_loops = []
+    for (component, loop_numbers) in component_loops.items():
+        faces = _triangulateOutline(points, [bottom_loops[loop_number] for loop_number in loop_numbers], component_areas[component])
+        if faces is None:
+            faces = roof.faces[face_labels == component]
+            unused_loops.extend(loop_numbers)
+        bottom_faces.append(faces)
+    bottom_faces = numpy.concatenate(bottom_faces)
+
+    # the bottom faces down, like the roof it is a copy of
+    triangles_2d = points[bottom_faces]
+    is_upside_down = numpy.cross(triangles_2d[:, 1] - triangles_2d[:, 0], triangles_2d[:, 2] - triangles_2d[:, 0]) < 0
+    bottom_faces[is_upside_down] = bottom_faces[is_upside_down][:, ::-1]
+    return (bottom_faces, unused_loops)
+
+# Constrained triangulation of the area inside the loops (vertex indices into points) without adding
+# vertices, or None if that area is not the expected area
+def _triangulateOutline(points, loops, expected_area):
+    polygons = [shapely.geometry.Polygon(points[loop]) for loop in loops if len(loop) >= 3]
+    if len(polygons) != len(loops) or not all([polygon.is_valid for polygon in polygons]):
+        return None
+
+    # loops inside an odd number of other loops are holes
+    depths = [
+        sum([1 for other in polygons if other is not polygon and other.contains(polygon.representative_point())])
+        for polygon in polygons
+    ]
+    area = sum([polygon.area if depth % 2 == 0 else -polygon.area for (polygon, depth) in zip(polygons, depths)])
+    if abs(area - expected_area) > AREA_TOLERANCE * max(expected_area, 1):
+        return None
+
+    hole_points = []
+    for (polygon, depth) in zip(polygons, depths):
+        if depth % 2 == 1:
+            # a point in the hole that is not on an island in the hole
+            hole = polygon
+            for (other, other_depth) in zip(polygons, depths):
+                if other_depth == depth + 1 and polygon.contains(other.representative_point()):
+                    hole = hole.difference(other)
+            hole_points.append(list(hole.representative_point().coords[0]))
+
+    vertex_indices = numpy.unique(numpy.concatenate(loops))
+    segments = []
+    for loop in loops:
+        local_loop = numpy.searchsorted(vertex_indices, loop)
+        segments.append(numpy.column_stack((local_loop, numpy.roll(local_loop, -1))))
+    segments = numpy.concatenate(segments)
+    triangle_input = {"vertices": points[vertex_indices], "segments": segments}
+    if hole_points:
+        triangle_input["holes"] = numpy.array(hole_points)
+    try:
+        result = triangle.triangulate(triangle_input, "pQ")
+    except Exception:
+        return None
+    if "triangles" not in result or len(result["vertices"]) != len(vertex_indices):
+        return None
+    faces = result["triangles"]
+
+    # the edges that are used by one triangle only must be the outline, or the bottom would not
+    # match the walls
+    edges = numpy.sort(numpy.concatenate((faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]])), axis=1)
+    (unique_edges, edge_counts) = numpy.unique(edges, axis=0, return_counts=True)
+    if not numpy.array_equal(unique_edges[edge_counts == 1], numpy.unique(numpy.sort(segments, axis=1), axis=0)):
+        return None
+
+    return vertex_indices[faces]
+
+# Creates support like createSupportMesh, but from a height map instead of the roof outline: the
+# model is rasterized along the down vector onto a grid of resolution x resolution mm cells on the
+# belt, and every cell gets columns from the faces that need support down to the first surface of
+# the model below them or the belt. The run time depends on the number of cells that the faces
+# cover rather than on the number of outline edges, and the support does not go through the model.
+# The columns are sheared along the down vector, so their top and bottom are horizontal and the
+# bottom of the columns that reach the belt is on the belt. The mesh is watertight: the edges of
+# neighbouring columns are split where they meet.
+def createHeightMapSupportMesh(
+        tri_mesh,
+        support_angle = 50,
+        filter_upwards_facing_faces = True,
+        down_vector = numpy.array([0, -1, 0]),
+        bottom_cut_off = 0,
+        minimum_island_area = 0,
+        mesh_analysis = None,
+        resolution = 0.5
+    ):
+    if mesh_analysis is None:
+        mesh_analysis = MeshAnalysis(tri_mesh)
+
+    faces_needing_support = _getFacesNeedingSupport(tri_mesh, mesh_analysis, support_angle, filter_upwards_facing_faces, down_vector, bottom_cut_off)
+    if len(faces_needing_support) == 0:
+        logger.info("Mesh doesn't need support")
+        return trimesh.Trimesh()
+
+    # project the vertices along the down vector onto the belt
+    down_vector = numpy.asarray(down_vector, dtype=numpy.float64)
+    shear = down_vector[[0, 2]] / down_vector[1]
+    heights = tri_mesh.vertices[:, 1]
+    belt_points = tri_mesh.vertices[:, [0, 2]] - heights[:, None] * shear
+
+    # the grid covers the faces that need support and is aligned to multiples of the resolution
+    roof_points = belt_points[tri_mesh.faces[faces_needing_support]].reshape(-1, 2)
+    grid_minimum = roof_points.min(axis=0)
+    grid_maximum = roof_points.max(axis=0)
+    grid_area = numpy.prod(grid_maximum - grid_minimum)
+    if grid_area / resolution ** 2 > MAXIMUM_GRID_CELLS:
+        requested_resolution = resolution
+        resolution = math.sqrt(grid_area / MAXIMUM_GRID_CELLS)
+        logger.warning("The support height map would have more than %d cells with a resolution of %.2fmm, using a resolution of %.2fmm instead" % (
+            MAXIMUM_GRID_CELLS, requested_resolution, resolution
+        ))
+    grid_origin = numpy.floor(grid_minimum / resolution) * resolution
+    grid_shape = numpy.maximum(numpy.ceil((grid_maximum - grid_origin) / resolution).astype(numpy.int64), 1)
+
+    is_support_face = numpy.zeros(len(tri_mesh.faces), dtype=bool)
+    is_support_face[faces_needing_support] = True
+    (hit_cells, hit_heights, hit_faces) = _rasterizeFaces(belt_points, heights, tri_mesh.faces, grid_origin, grid_shape, resolution)
+
+    # sort the hits of every cell from the top down. Hits on an edge between two faces are counted
+    # once, and where a face that faces down meets a face that faces up, the face down comes first
+    # so it does not start a column.
+    is_facing_down = mesh_analysis.getFaceNormals()[hit_faces].dot(down_vector) > 0
+    quantized_heights = numpy.round(hit_heights / HEIGHT_TOLERANCE).astype(numpy.int64)
+    order = numpy.lexsort((~is_facing_down, -quantized_heights, hit_cells))
+    (hit_cells, quantized_heights, hit_faces, is_facing_down) = (hit_cells[order], quantized_heights[order], hit_faces[order], is_facing_down[order])
+    is_duplicate = numpy.zeros(len(hit_cells), dtype=bool)
+    is_duplicate[1:] = (hit_cells[1:] == hit_cells[:-1]) & (quantized_heights[1:] == quantized_heights[:-1]) & (is_facing_down[1:] == is_facing_down[:-1])
+    hit_cells = hit_cells[~is_duplicate]
+    hit_heights = quantized_heights[~is_duplicate]
+    hit_faces = hit_faces[~is_duplicate]
+
+    # a column starts at every hit on a face that needs support and ends at the next hit below it
+    # in the same cell, or at the belt; heights are in multiples of HEIGHT_TOLERANCE from here on
+    is_last_hit = numpy.ones(len(hit_cells), dtype=bool)
+    is_last_hit[:-1] = hit_cells[1:] != hit_cells[:-1]
+    next_heights = numpy.append(hit_heights[1:], 0)
+    next_heights[is_last_hit] = 0
+    is_column = is_support_face[hit_faces] & (hit_heights > numpy.maximum(next_heights, 0))
+    column_cells = hit_cells[is_column]
+    column_tops = hit_heights[is_column]
+    column_bottoms = numpy.maximum(next_heights[is_column], 0)
+
+    # columns in a cell that touch are one column
+    is_continued = numpy.zeros(len(column_cells), dtype=bool)
+    is_continued[1:] = (column_cells[1:] == column_cells[:-1]) & (column_tops[1:] == column_bottoms[:-1])
+    column_starts = numpy.flatnonzero(~is_continued)
+    column_ends = numpy.append(column_starts[1:], len(column_cells)) - 1
+    (column_cells, column_tops, column_bottoms) = (column_cells[column_starts], column_tops[column_starts], column_bottoms[column_ends])
+
+    if minimum_island_area > 0 and len(column_cells) > 0:
+        # filter out groups of neighbouring cells that would result in small towers
+        support_cells = numpy.unique(column_cells)
+        is_support_cell = numpy.zeros(grid_shape[0] * grid_shape[1], dtype=bool)
+        is_support_cell[support_cells] = True
+        neighbour_edges = []
+        for offset in (1, grid_shape[1]):
+            neighbours = support_cells + offset
+            is_neighbour = neighbours < len(is_support_cell)
+            if offset == 1:
+                # no neighbour across the end of a row
+                is_neighbour &= (support_cells % grid_shape[1]) != grid_shape[1] - 1
+            is_neighbour[is_neighbour] &= is_support_cell[neighbours[is_neighbour]]
+            neighbour_edges.append(numpy.column_stack((support_cells[is_neighbour], neighbours[is_neighbour])))
+        cell_numbers = numpy.full(len(is_support_cell), -1, dtype=numpy.int64)
+        cell_numbers[support_cells] = numpy.arange(len(support_cells))
+        island_labels = trimesh.graph.connected_component_labels(cell_numbers[numpy.concatenate(neighbour_edges)], node_count=len(support_cells))
+        island_areas = numpy.bincount(island_labels) * resolution ** 2
+        is_large_cell = numpy.zeros(len(is_support_cell), dtype=bool)
+        is_large_cell[support_cells[island_areas[island_labels] >= minimum_island_area]] = True
+        is_large_column = is_large_cell[column_cells]
+        (column_cells, column_tops, column_bottoms) = (column_cells[is_large_column], column_tops[is_large_column], column_bottoms[is_large_column])
+
+    if len(column_cells) == 0:
+        logger.info("All surfaces of the mesh that need support are smaller than the minimum_island_area or supported by the mesh itself")
+        return trimesh.Trimesh()
+
+    logger.info("Support height map has %d columns in a %dx%d grid of %.2fmm" % (len(column_cells), grid_shape[0], grid_shape[1], resolution))
+    quads = _createColumnQuads(column_cells, column_bottoms, column_tops, grid_shape)
+    (grid_vertices, support_faces) = _triangulateQuads(quads)
+    (grid_vertices, support_faces) = _splitNonManifoldEdges(grid_vertices, support_faces)
+
+    # the vertices are in cell corners and heights, sheared back along the down vector
+    vertex_heights = grid_vertices[:, 1] * HEIGHT_TOLERANCE
+    support_vertices = numpy.column_stack((
+        grid_origin[0] + grid_vertices[:, 0] * resolution + vertex_heights * shear[0],
+        vertex_heights,
+        grid_origin[1] + grid_vertices[:, 2] * resolution + vertex_heights * shear[1]
+    ))
+
+    # processing would merge the vertices that were split to keep the mesh manifold
+    return trimesh.base.Trimesh(vertices=support_vertices, faces=support_faces, process=False)
+
+# The cells of the grid that each face covers and the height of the face in those cells, in batches
+# of face/cell pairs. Cells are numbered row by row; a cell is covered if its center is inside the
+# projected face or on its edge.
+def _rasterizeFaces(points, heights, faces, grid_origin, grid_shape, resolution):
+    triangles = points[faces]
+    cell_minimum = numpy.maximum(numpy.ceil((triangles.min(axis=1) - grid_origin) / resolution - 0.5), 0).astype(numpy.int64)
+    cell_maximum = numpy.minimum(numpy.floor((triangles.max(axis=1) - grid_origin) / resolution - 0.5), grid_shape - 1).astype(numpy.int64)
+    cell_counts = numpy.maximum(cell_maximum - cell_minimum + 1, 0)
+    pair_counts = cell_counts[:, 0] * cell_counts[:, 1]
+
+    # faces that are parallel to the down vector cover no area
+    double_areas = numpy.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    pair_counts[numpy.abs(double_areas) <= HEIGHT_TOLERANCE ** 2] = 0
+
+    hit_cells = []
+    hit_heights = []
+    hit_faces = []
+    face_ends = numpy.cumsum(pair_counts)
+    batch_start = 0
+    while batch_start < len(faces):
+        pairs_before_batch = face_ends[batch_start - 1] if batch_start > 0 else 0
+        # at least one face per batch
+        batch_end = max(batch_start + 1, numpy.searchsorted(face_ends, pairs_before_batch + RASTER_BATCH_SIZE, side="right"))
+        batch_faces = numpy.arange(batch_start, batch_end)
+        batch_counts = pair_counts[batch_faces]
+        pair_faces = numpy.repeat(batch_faces, batch_counts)
+        pair_offsets = numpy.arange(len(pair_faces)) - numpy.repeat(numpy.cumsum(batch_counts) - batch_counts, batch_counts)
+        pair_columns = cell_counts[pair_faces, 1]
+        pair_cells = cell_minimum[pair_faces] + numpy.column_stack((pair_offsets // pair_columns, pair_offsets % pair_columns))
+        batch_start = batch_end
+
+        # barycentric coordinates of the cell centers
+        centers = grid_origin + (pair_cells + 0.5) * resolution
+        pair_triangles = triangles[pair_faces]
+        edge_1 = pair_triangles[:, 1] - pair_triangles[:, 0]
+        edge_2 = pair_triangles[:, 2] - pair_triangles[:, 0]
+        offsets = centers - pair_triangles[:, 0]
+        pair_double_areas = double_areas[pair_faces]
+        weight_1 = numpy.cross(offsets, edge_2) / pair_double_areas
+        weight_2 = numpy.cross(edge_1, offsets) / pair_double_areas
+        weight_0 = 1 - weight_1 - weight_2
+        is_inside = (weight_0 >= -BARYCENTRIC_TOLERANCE) & (weight_1 >= -BARYCENTRIC_TOLERANCE) & (weight_2 >= -BARYCENTRIC_TOLERANCE)
+
+        face_heights = heights[faces[pair_faces[is_inside]]]
+        hit_heights.append(
+            weight_0[is_inside] * face_heights[:, 0] + weight_1[is_inside] * face_heights[:, 1] + weight_2[is_inside] * face_heights[:, 2]
+        )
+        hit_cells.append(pair_cells[is_inside, 0] * grid_shape[1] + pair_cells[is_inside, 1])
+        hit_faces.append(pair_faces[is_inside])
+
+    if not hit_cells:
+        return (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0), numpy.zeros(0, dtype=numpy.int64))
+    return (numpy.concatenate(hit_cells), numpy.concatenate(hit_heights), numpy.concatenate(hit_faces))
+
+# The outside of the columns as quads of (cell corner x, height, cell corner z) vertices, wound
+# counterclockwise seen from outside. Tops and bottoms of neighbouring cells at the same height, and
+# walls of neighbouring cells with the same heights, are merged into longer quads.
+def _createColumnQuads(column_cells, column_bottoms, column_tops, grid_shape):
+    (column_x, column_z) = numpy.divmod(column_cells, grid_shape[1])
+    quads = []
+
+    # tops face up and bottoms face down; runs of cells along x with the same height are merged
+    for (column_heights, is_top) in ((column_tops, True), (column_bottoms, False)):
+        ((run_z, run_height), run_start, run_end) = _mergeRuns([column_z, column_heights], column_x)
+        run_end = run_end + 1
+        corners = [(run_start, run_z), (run_start, run_z + 1), (run_end, run_z + 1), (run_end, run_z)]
+        if not is_top:
+            corners.reverse()
+        quads.append(numpy.stack([numpy.column_stack((x, run_height, z)) for (x, z) in corners], axis=1))
+
+    # walls on the lines between the cells; a side is the part of a line along one cell, numbered
+    # line * cells along the line + cell. Walls face away from the column they belong to.
+    for across_x in (True, False):
+        if across_x:
+            (cells_along_line, cell_positions, cell_lines) = (grid_shape[1], column_z, column_x)
+        else:
+            (cells_along_line, cell_positions, cell_lines) = (grid_shape[0], column_x, column_z)
+        (sides, bottoms, tops, is_facing_positive) = _getWallPieces(
+            (cell_lines + 1) * cells_along_line + cell_positions, cell_lines * cells_along_line + cell_positions, column_bottoms, column_tops
+        )
+        (side_lines, side_positions) = numpy.divmod(sides, cells_along_line)
+
+        for facing_positive in (True, False):
+            is_facing = is_facing_positive == facing_positive
+            ((line, bottom, top), run_start, run_end) = _mergeRuns([side_lines[is_facing], bottoms[is_facing], tops[is_facing]], side_positions[is_facing])
+            run_end = run_end + 1
+            if across_x:
+                corners = [(line, bottom, run_start), (line, top, run_start), (line, top, run_end), (line, bottom, run_end)]
+            else:
+                corners = [(run_start, bottom, line), (run_end, bottom, line), (run_end, top, line), (run_start, top, line)]
+            if not facing_positive:
+                corners.reverse()
+            quads.append(numpy.stack([numpy.column_stack(corner) for corner in corners], axis=1))
+
+    return numpy.concatenate(quads)
+
+# The parts of the sides of the cells where one of the two cells has a column and the other does
+# not. Every column is on the negative side of one side (sides_after) and on the positive side of
+# another (sides_before). Returns the sides, the bottoms and tops of the parts, and whether they
+# belong to a column on the negative side and so face in the positive direction.
+def _getWallPieces(sides_after, sides_before, bottoms, tops):
+    sides = numpy.concatenate((sides_after, sides_after, sides_before, sides_before))
+    heights = numpy.concatenate((bottoms, tops, bottoms, tops))
+    zeros = numpy.zeros(len(bottoms), dtype=numpy.int64)
+    ones = numpy.ones(len(bottoms), dtype=numpy.int64)
+    negative_changes = numpy.concatenate((ones, -ones, zeros, zeros))
+    positive_changes = numpy.concatenate((zeros, zeros, ones, -ones))
+
+    # walk up every side; every column adds 1 at its bottom and subtracts it at its top, so the
+    # counts are back to 0 at the end of every side
+    order = numpy.lexsort((heights, sides))
+    (sides, heights) = (sides[order], heights[order])
+    is_negative_filled = numpy.cumsum(negative_changes[order]) > 0
+    is_positive_filled = numpy.cumsum(positive_changes[order]) > 0
+
+    is_wall = (sides[:-1] == sides[1:]) & (heights[1:] > heights[:-1]) & (is_negative_filled[:-1] != is_positive_filled[:-1])
+    return (sides[:-1][is_wall], heights[:-1][is_wall], heights[1:][is_wall], is_negative_filled[:-1][is_wall])
+
+# Triangulate quads of (cell corner x, height, cell corner z) vertices without T-junctions: vertices
+# of other quads that are on an edge of a quad are inserted in that edge. A quad is fanned from a
+# corner that has no inserted vertices on either of its edges, or else from a new vertex in its
+# center. Returns the vertices (as floats, including the centers) and the faces.
+def _triangulateQuads(quads):
+    (vertices, corner_indices) = numpy.unique(quads.reshape(-1, 3), axis=0, return_inverse=True)
+    corner_indices = corner_indices.reshape(-1, 4)
+    vertex_count = len(vertices)
+
+    # edge k of a quad runs from corner k to corner k + 1; every edge is parallel to one axis
+    edge_starts = corner_indices.ravel()
+    edge_ends = corner_indices[:, [1, 2, 3, 0]].ravel()
+    edge_vectors = vertices[edge_ends] - vertices[edge_starts]
+    edge_axes = numpy.argmax(edge_vectors != 0, axis=1)
+    is_ascending = edge_vectors[numpy.arange(len(edge_vectors)), edge_axes] > 0
+
+    # the coordinates are numbered, so the vertices on a line parallel to an axis can be sorted by one
+    # key; the vertices on an edge are the vertices with keys between those of its ends
+    coordinate_numbers = []
+    coordinate_counts = []
+    for axis in range(3):
+        (values, numbers) = numpy.unique(vertices[:, axis], return_inverse=True)
+        coordinate_numbers.append(numbers.ravel().astype(numpy.int64))
+        coordinate_counts.append(len(values))
+    sorted_vertices = []
+    insert_lows = numpy.zeros(len(edge_starts), dtype=numpy.int64)
+    insert_highs = numpy.zeros(len(edge_starts), dtype=numpy.int64)
+    for axis in range(3):
+        (axis_1, axis_2) = [other_axis for other_axis in range(3) if other_axis != axis]
+        keys = (coordinate_numbers[axis_1] * coordinate_counts[axis_2] + coordinate_numbers[axis_2]) * coordinate_counts[axis] + coordinate_numbers[axis]
+        order = numpy.argsort(keys)
+        sorted_keys = keys[order]
+        is_axis_edge = edge_axes == axis
+        low_keys = numpy.minimum(keys[edge_starts[is_axis_edge]], keys[edge_ends[is_axis_edge]])
+        high_keys = numpy.maximum(keys[edge_starts[is_axis_edge]], keys[edge_ends[is_axis_edge]])
+        insert_lows[is_axis_edge] = numpy.searchsorted(sorted_keys, low_keys, side="right") + axis * vertex_count
+        insert_highs[is_axis_edge] = numpy.searchsorted(sorted_keys, high_keys, side="left") + axis * vertex_count
+        sorted_vertices.append(order)
+    sorted_vertices = numpy.concatenate(sorted_vertices)
+    insert_counts = insert_highs - insert_lows
+
+    # the segments of the edges between the inserted vertices, in the direction of the edges
+    segment_counts = insert_counts + 1
+    segment_edges = numpy.repeat(numpy.arange(len(edge_starts)), segment_counts)
+    segment_numbers = numpy.arange(len(segment_edges)) - numpy.repeat(numpy.cumsum(segment_counts) - segment_counts, segment_counts)
+    segment_points = []
+    for point_numbers in (segment_numbers, segment_numbers + 1):
+        # point 0 is the start of the edge, point n the n-th inserted vertex
+        sorted_indices = numpy.where(is_ascending[segment_edges], insert_lows[segment_edges] + point_numbers - 1, insert_highs[segment_edges] - point_numbers)
+        points = sorted_vertices[numpy.clip(sorted_indices, 0, len(sorted_vertices) - 1)]
+        points = numpy.where(point_numbers == 0, edge_starts[segment_edges], points)
+        points = numpy.where(point_numbers == segment_counts[segment_edges], edge_ends[segment_edges], points)
+        segment_points.append(points)
+    (segment_quads, segment_sides) = numpy.divmod(segment_edges, 4)
+
+    has_inserts = (insert_counts > 0).reshape(-1, 4)
+    is_free_corner = ~has_inserts & ~numpy.roll(has_inserts, 1, axis=1)
+    has_free_corner = is_free_corner.any(axis=1)
+    fan_corners = numpy.argmax(is_free_corner, axis=1)
+
+    # fan from the free corner over the segments of the two edges that don't touch it
+    is_fan_segment = has_free_corner[segment_quads] & (
+        ((segment_sides - fan_corners[segment_quads]) % 4 == 1) | ((segment_sides - fan_corners[segment_quads]) % 4 == 2)
+    )
+    fan_faces = numpy.column_stack((
+        corner_indices[segment_quads[is_fan_segment], fan_corners[segment_quads[is_fan_segment]]],
+        segment_points[0][is_fan_segment],
+        segment_points[1][is_fan_segment]
+    ))
+
+    # fan from the center over all segments
+    center_quads = numpy.flatnonzero(~has_free_corner)
+    center_indices = numpy.full(len(corner_indices), -1, dtype=numpy.int64)
+    center_indices[center_quads] = vertex_count + numpy.arange(len(center_quads))
+    is_center_segment = ~has_free_corner[segment_quads]
+    center_faces = numpy.column_stack((
+        center_indices[segment_quads[is_center_segment]],
+        segment_points[0][is_center_segment],
+        segment_points[1][is_center_segment]
+    ))
+
+    centers = vertices[corner_indices[center_quads]].mean(axis=1)
+    return (numpy.concatenate((vertices.astype(numpy.float64), centers)), numpy.concatenate((fan_faces, center_faces)))
+
+# Columns that only touch along an edge, like columns in diagonal cells or a column that ends where
+# the column next to it starts, share that edge with four faces. The faces of each column get their
+# own copies of the vertices there, so every edge is shared by exactly two faces. Of the four faces,
+# the two of one column are those where each face lies behind the other.
+def _splitNonManifoldEdges(vertices, faces):
+    edge_starts = faces.ravel()
+    edge_ends = faces[:, [1, 2, 0]].ravel()
+    edge_keys = numpy.minimum(edge_starts, edge_ends) * len(vertices) + numpy.maximum(edge_starts, edge_ends)
+    order = numpy.argsort(edge_keys, kind="stable")
+    sorted_keys = edge_keys[order]
+    group_starts = numpy.flatnonzero(numpy.append(True, sorted_keys[1:] != sorted_keys[:-1]))
+    group_counts = numpy.diff(numpy.append(group_starts, len(sorted_keys)))
+    if (group_counts == 2).all():
+        return (vertices, faces)
+
+    # pairs of face edges (face * 3 + edge) that belong to the same surface
+    pairs = [numpy.column_stack((order[group_starts[group_counts == 2]], order[group_starts[group_counts == 2] + 1]))]
+
+    shared_edges = order[group_starts[group_counts == 4][:, None] + numpy.arange(4)]
+    if len(shared_edges) > 0:
+        # the two edges that run from the lower vertex to the higher first
+        is_forward = edge_starts[shared_edges] < edge_ends[shared_edges]
+        shared_edges = numpy.take_along_axis(shared_edges, numpy.argsort(~is_forward, axis=1, kind="stable"), axis=1)
+
+        triangles = vertices[faces[shared_edges // 3]]
+        normals = numpy.cross(triangles[:, :, 1] - triangles[:, :, 0], triangles[:, :, 2] - triangles[:, :, 0])
+        # the direction in which a face extends away from the edge is towards its third vertex
+        edge_points = vertices[edge_starts[shared_edges]]
+        edge_directions = vertices[edge_ends[shared_edges]] - edge_points
+        third_points = vertices[faces[shared_edges // 3, (shared_edges % 3 + 2) % 3]]
+        extents = third_points - edge_points
+        extents -= edge_directions * ((extents * edge_directions).sum(axis=2) / (edge_directions ** 2).sum(axis=2))[:, :, None]
+
+        is_first_pairing = (normals[:, 0] * extents[:, 2]).sum(axis=1) < 0
+        pairs.append(numpy.where(is_first_pairing[:, None], shared_edges[:, [0, 2]], shared_edges[:, [0, 3]]))
+        pairs.append(numpy.where(is_first_pairing[:, None], shared_edges[:, [1, 3]], shared_edges[:, [1, 2]]))
+    pairs = numpy.concatenate(pairs)
+
+    # the corners (face * 3 + corner) of one vertex that are connected through a pair of edges are
+    # one vertex; the paired edges run in opposite directions
+    (face_1, edge_1) = numpy.divmod(pairs[:, 0], 3)
+    (face_2, edge_2) = numpy.divmod(pairs[:, 1], 3)
+    corner_links = numpy.concatenate((
+        numpy.column_stack((face_1 * 3 + edge_1, face_2 * 3 + (edge_2 + 1) % 3)),
+        numpy.column_stack((face_1 * 3 + (edge_1 + 1) % 3, face_2 * 3 + edge_2))
+    ))
+    corner_labels = trimesh.graph.connected_component_labels(corner_links, node_count=len(edge_starts))
+    (labels, first_corners) = numpy.unique(corner_labels, return_index=True)
+    logger.debug("Split %d edges where support columns touch" % len(shared_edges))
+    return (vertices[edge_starts[first_corners]], corner_labels.reshape(-1, 3))
+
+# Merge runs of consecutive positions that have the same keys. Returns the keys, first position and
+# last position of every run.
+def _mergeRuns(keys, positions):
+    order = numpy.lexsort([positions] + keys[::-1])
+    keys = [key[order] for key in keys]
+    positions = positions[order]
+    is_continued = numpy.zeros(len(positions), dtype=bool)
+    is_continued[1:] = positions[1:] == positions[:-1] + 1
+    for key in keys:
+        is_continued[1:] &= key[1:] == key[:-1]
+    run_starts = numpy.flatnonzero(~is_continued)
+    run_ends = numpy.append(run_starts[1:], len(positions)) - 1
+    return ([key[run_starts] for key in keys], positions[run_starts], positions[run_ends])
+
 def createRaftMesh(
         tri_mesh,
         raft_thickness=0.1,
-        raft_margin=0
+        raft_margin=0,
+        mesh_analysis = None
     ):
+    if mesh_analysis is None:
+        mesh_analysis = MeshAnalysis(tri_mesh)
 
-    raft_mesh_polygon = trimesh.path.polygons.projected(tri_mesh.convex_hull, [0,1,0])
+    # the projection of the convex hull is the 2d convex hull of the projected vertices, which
+    # is a lot cheaper to compute than the 3d hull and the union of its projected faces
+    raft_mesh_polygon = mesh_analysis.getFootprint()
     if raft_margin > 0:
         offset_raft_mesh_points = raft_mesh_polygon.exterior.parallel_offset(raft_margin, side="left", resolution=5)
         raft_mesh_polygon = shapely.geometry.Polygon(offset_raft_mesh_points)
@@ -37,4 +37,7 @@ class MeshPretransformer():
         self._pretransform_matrix = matrix
 
     def pretransformMesh(self, tri_mesh):
-        tri_mesh.apply_transform(self._pretransform_matrix)
\ No newline at end of file
+        tri_mesh.apply_transform(self._pretransform_matrix)
+
+    def getMatrix(self):
+        return self._pretransform_matrix
@@ -0,0 +1,147 @@
+# Copyright (c) 2020 Autodrop3D and Aldo Hoeben / fieldOfView
+# BeltEngine is released under the terms of the AGPLv3 or higher.
+
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+import numpy
+import shapely
+
+import logging
+logger = logging.getLogger("BeltEngine")
+
+# rotations that are evaluated first, evenly spread over a full turn
+COARSE_CANDIDATES = 72
+# the best rotations so far are refined by trying rotations halfway to their neighbours, for a
+# fixed number of passes so the same model always gets the same rotation; 5 passes refine the
+# coarse step of 5 degrees to 0.16 degrees
+REFINED_CANDIDATES = 4
+DEFAULT_REFINEMENTS = 5
+# number of face/rotation pairs that are scored in one batch
+BATCH_SIZE = 2 ** 22
+# weights of the scores, which are relative to the worst rotation of the first pass
+OVERHANG_WEIGHT = 1.0
+FOOTPRINT_WEIGHT = 0.25
+BELT_LENGTH_WEIGHT = 0.25
+# the unrotated model is kept unless the best rotation scores this much better
+MINIMUM_IMPROVEMENT = 0.01
+
+OrientationCandidate = NamedTuple("OrientationCandidate", [
+    ("angle", float),  # radians about the y axis
+    ("overhang_area", float),  # mm2 of faces that need support
+    ("footprint", float),  # mm2 of the rectangle the model takes on the belt
+    ("belt_length", float),  # mm of belt used by the print
+    ("width", float)  # mm across the belt
+])
+
+# Finds the rotation about the vertical (y) axis of a mesh in belt coordinates that needs the least
+# support and takes the least room on the belt. Rotations are scored in batches of numpy arrays:
+# - overhang area: the area of the faces that createSupportMesh would support, using the same down
+#   vector and support angle; faces at the bottom of the model are never supported
+# - footprint: the rectangle that the model takes on the belt; the area of the convex outline
+#   itself does not change when the model turns about the vertical axis
+# - belt length: the length of the model along the belt, including the slant of the layers
+# Rotations that make the model wider than the belt are rejected.
+class OrientationOptimizer():
+    def __init__(self, mesh_analysis, down_vector, support_angle = 50, bottom_cut_off = 0, gantry_angle = math.radians(45), machine_width = None, jobs = 1):
+        self._down_vector = numpy.array(down_vector, dtype=numpy.float64)
+        self._cos_support_angle = math.cos(math.radians(90 - support_angle))
+        self._machine_width = machine_width
+        self._jobs = max(1, jobs)
+
+        tri_mesh = mesh_analysis.getMesh()
+        vertices = tri_mesh.vertices
+        face_normals = mesh_analysis.getFaceNormals()
+        areas = tri_mesh.area_faces
+
+        # only the faces that face down enough for some rotation are scored; y does not change
+        # when the model turns, so neither does the bottom of the model
+        horizontal_length = numpy.hypot(face_normals[:, 0], face_normals[:, 2])
+        maximum_dot = face_normals[:, 1] * self._down_vector[1] + abs(self._down_vector[2]) * horizontal_length
+        minimum_y = vertices[:, 1].min()
+        is_bottom_face = numpy.all(vertices[tri_mesh.faces][:, :, 1] - minimum_y <= bottom_cut_off, axis=1)
+        candidate_faces = (maximum_dot >= self._cos_support_angle) & ~is_bottom_face
+
+        self._normals = face_normals[candidate_faces]
+        self._areas = areas[candidate_faces]
+
+        hull = shapely.geometry.MultiPoint(vertices[:, [0, 2]]).convex_hull
+        if hull.geom_type == "Polygon":
+            self._hull_points = numpy.array(hull.exterior.coords)
+        else:
+            self._hull_points = numpy.array(hull.coords)
+        # the top of a layer lands this much further along the belt than its bottom
+        self._layer_slant = (vertices[:, 1].max() - minimum_y) / math.tan(gantry_angle)
+
+        self._score_scale = None
+
+    # Evaluate the coarse rotations and refine the best of them in refinements passes. Returns the
+    # best candidate and the candidate without rotation.
+    def findBestRotation(self, refinements = DEFAULT_REFINEMENTS):
+        start_time = time.monotonic()
+        step = 2 * math.pi / COARSE_CANDIDATES
+        candidates = self._evaluate(numpy.arange(COARSE_CANDIDATES) * step)
+        unrotated = candidates[0]
+
+        # normalize the scores by the worst rotation, so they can be weighted without units
+        self._score_scale = [
+            max([candidate.overhang_area for candidate in candidates]) or 1,
+            max([candidate.footprint for candidate in candidates]) or 1,
+            max([candidate.belt_length for candidate in candidates]) or 1
+        ]
+
+        for _ in range(refinements):
+            step /= 2
+            best_candidates = sorted(candidates, key=self.getScore)[:REFINED_CANDIDATES]
+            angles = numpy.array([candidate.angle + offset for candidate in best_candidates for offset in (-step, step)])
+            candidates.extend(self._evaluate(numpy.mod(angles, 2 * math.pi)))
+
+        best_candidate = min(candidates, key=self.getScore)
+        if self.getScore(best_candidate) > self.getScore(unrotated) - MINIMUM_IMPROVEMENT:
+            best_candidate = unrotated
+
+        logger.info("Evaluated %d rotations in %.2fs" % (len(candidates), time.monotonic() - start_time))
+        return (best_candidate, unrotated)
+
+    # Lower is better
+    def getScore(self, candidate):
+        if self._machine_width and candidate.width > self._machine_width:
+            return math.inf
+        return (
+            OVERHANG_WEIGHT * candidate.overhang_area / self._score_scale[0] +
+            FOOTPRINT_WEIGHT * candidate.footprint / self._score_scale[1] +
+            BELT_LENGTH_WEIGHT * candidate.belt_length / self._score_scale[2]
+        )
+
+    # Score the rotations in batches, in parallel
+    def _evaluate(self, angles):
+        batch_length = max(1, BATCH_SIZE // max(1, len(self._normals)))
+        batches = [angles[index:index + batch_length] for index in range(0, len(angles), batch_length)]
+        if self._jobs > 1 and len(batches) > 1:
+            # numpy releases the GIL for the array operations
+            with ThreadPoolExecutor(max_workers=min(self._jobs, len(batches))) as executor:
+                results = list(executor.map(self._evaluateBatch, batches))
+        else:
+            results = [self._evaluateBatch(batch) for batch in batches]
+        return [candidate for result in results for candidate in result]
+
+    def _evaluateBatch(self, angles):
+        cos_angles = numpy.cos(angles)[:, None]
+        sin_angles = numpy.sin(angles)[:, None]
+
+        # a rotation about y leaves the y component of the normals as it is
+        rotated_normals_z = cos_angles * self._normals[:, 2] - sin_angles * self._normals[:, 0]
+        dots = self._normals[:, 1] * self._down_vector[1] + rotated_normals_z * self._down_vector[2]
+        overhang_areas = (dots >= self._cos_support_angle).dot(self._areas)
+
+        hull_x = cos_angles * self._hull_points[:, 0] + sin_angles * self._hull_points[:, 1]
+        hull_z = cos_angles * self._hull_points[:, 1] - sin_angles * self._hull_points[:, 0]
+        widths = hull_x.max(axis=1) - hull_x.min(axis=1)
+        lengths = hull_z.max(axis=1) - hull_z.min(axis=1)
+
+        return [
+            OrientationCandidate(float(angle), float(overhang_area), float(width * length), float(length + self._layer_slant), float(width))
+            for (angle, overhang_area, width, length) in zip(angles, overhang_areas, widths, lengths)
+        ]
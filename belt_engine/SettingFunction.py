@@ -13,7 +13,7 @@ import hashlib  # Imported here so it can be used easily by the setting function
 # noinspection PyUnresolvedReferences
 import uuid  # Imported here so it can be used easily by the setting functions.
 from types import CodeType
-from typing import Any, Callable, Dict, FrozenSet, NamedTuple, Optional, Set, TYPE_CHECKING
+from typing import Any, Callable, Dict, FrozenSet, Iterable, NamedTuple, Optional, Set, TYPE_CHECKING
 
 # noinspection PyUnresolvedReferences
 import math  # Imported here so it can be used easily by the setting functions.
@@ -37,10 +37,12 @@ class SettingFunction:
     If a setting's property is a static type, e.g. a string, an int, a float, etc., its value will just be interpreted
     as it is, but when it's a Python code (formula), the value needs to be evaluated via this class.
     """
-    def __init__(self, expression: str) -> None:
+    def __init__(self, expression: str, operator_names: Optional[Iterable[str]] = None) -> None:
         """Constructor.
 
         :param expression: The Python code this function should evaluate.
+        :param operator_names: Names of the operators that are passed when the function is called, which are not
+        settings.
         """
         super().__init__()
 
@@ -56,7 +58,7 @@ class SettingFunction:
         try:
             tree = ast.parse(self._code, "eval")
 
-            result = _SettingExpressionVisitor().visit(tree)
+            result = _SettingExpressionVisitor(operator_names).visit(tree)
             self._used_keys = frozenset(result.keys)
             self._used_values = frozenset(result.values)
 
@@ -72,8 +74,12 @@ class SettingFunction:
             #Logger.log("e", "Exception in function ({0}) for setting: {1}".format(str(e), self._code))
             pass
 
-    def __call__(self, settings_parser) -> Any:
+    def __call__(self, settings_parser, operators: Optional[Dict[str, Callable]] = None) -> Any:
         """Call the actual function to calculate the value.
+
+        :param settings_parser: The parser to read the values of the used settings from.
+        :param operators: Operators for this call only, on top of the registered operators. Passing the operators of a
+        parser with every call keeps parsers in other threads from using each other's operators.
         """
 
         if not self._valid:
@@ -91,6 +97,8 @@ class SettingFunction:
         g = {}  # type: Dict[str, Any]
         g.update(globals())
         g.update(self.__operators)
+        if operators:
+            g.update(operators)
 
         try:
             if self._compiled:
@@ -149,7 +157,9 @@ class SettingFunction:
 
     @classmethod
     def registerOperator(cls, name: str, operator: Callable) -> None:
-        """Expose a custom function to the code executed by SettingFunction
+        """Expose a custom function to the code executed by every SettingFunction
+
+        Operators that depend on a SettingsParser are passed with the call instead, see __call__.
 
         :param name: What identifier to use in the executed code.
         :param operator: A callable that implements the actual logic to execute.
@@ -174,10 +184,11 @@ class _SettingExpressionVisitor(ast.NodeVisitor):
     "used keys" and one set of "used values". "used keys" are setting keys (strings) that are used by the expression,
     whereas "used values" are actual variable references that are needed for the function to be executed.
     """
-    def __init__(self) -> None:
+    def __init__(self, operator_names: Optional[Iterable[str]] = None) -> None:
         super().__init__()
         self.values = set()  # type: Set[str]
         self.keys = set()  # type: Set[str]
+        self._operator_names = frozenset(operator_names or [])  # type: FrozenSet[str]
 
     def visit(self, node: ast.AST) -> _VisitResult:
         super().visit(node)
@@ -187,7 +198,7 @@ class _SettingExpressionVisitor(ast.NodeVisitor):
         if node.id in self._blacklist:
             raise IllegalMethodError(node.id)
 
-        if node.id not in self._knownNames and node.id not in dir(builtins):
+        if not self._isKnownName(node.id) and node.id not in dir(builtins):
             self.values.add(node.id)
             self.keys.add(node.id)
 
@@ -200,7 +211,7 @@ class _SettingExpressionVisitor(ast.NodeVisitor):
         raise IllegalMethodError("List Comprehension is not allowed")
 
     def visit_Attribute(self, node: ast.Attribute) -> None:
-        if node.attr not in self._knownNames:
+        if not self._isKnownName(node.attr):
             raise IllegalMethodError(node.attr)
         self.visit(node.value)  # Go a step deeper
 
@@ -230,7 +241,7 @@ class _SettingExpressionVisitor(ast.NodeVisitor):
         if node.s.startswith("_"):
             raise IllegalMethodError(node.s)
 
-        if node.s not in self._knownNames and node.s not in dir(builtins):  # type: ignore #AST uses getattr stuff, so ignore type of node.s.
+        if not self._isKnownName(node.s) and node.s not in dir(builtins):  # type: ignore #AST uses getattr stuff, so ignore type of node.s.
             self.keys.add(node.s)  # type: ignore
 
     def visit_Subscript(self, node: ast.Index):
@@ -253,9 +264,12 @@ class _SettingExpressionVisitor(ast.NodeVisitor):
             raise IllegalMethodError(node.value)
         if node.s.startswith("_"):
             raise IllegalMethodError(node.s)
-        if node.value not in self._knownNames and node.value not in dir(builtins):  # type: ignore #AST uses getattr stuff, so ignore type of node.value.
+        if not self._isKnownName(node.value) and node.value not in dir(builtins):  # type: ignore #AST uses getattr stuff, so ignore type of node.value.
             self.keys.add(node.value)  # type: ignore
 
+    def _isKnownName(self, name: str) -> bool:
+        return name in self._knownNames or name in self._operator_names
+
     _knownNames = {
         "math",
         "round",
@@ -15,12 +15,24 @@ import logging
 logger = logging.getLogger("BeltEngine")
 
 class SettingsParser():
-    def __init__(self, config_files=[], commandline_settings=[]):
-        self._definitions = OrderedDict()
-        definitions_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources", "definitions")
-        for entry in os.scandir(definitions_folder):
-            if entry.path.endswith(".def.json") and entry.is_file():
-                self._definitions[os.path.basename(entry.path)] = SettingsDefinitionFile(entry.path)
+    def __init__(self, config_files=[], commandline_settings=[], profiler=None, definitions=None):
+        # optional SettingsProfiler that measures the evaluation of formulas
+        self._profiler = profiler
+
+        # the definitions are never changed, so parsers can share them
+        self._definitions = definitions if definitions is not None else SettingsParser.loadDefinitions()
+
+        # the operators of this parser are passed to every formula it evaluates, so parsers in
+        # other threads never use them; formulas in the config files already use them
+        self._operators = OrderedDict([
+            ("extruderValue", self._getValueInExtruder),
+            ("extruderValues", self._getValuesInAllExtruders),
+            ("resolveOrValue", self._getResolveOrValue),
+            ("defaultExtruderPosition", self._getDefaultExtruderPosition)
+        ])
+        if self._profiler:
+            for name, operator in self._operators.items():
+                self._operators[name] = self._profiler.wrapOperator(name, operator)
 
         # parse config file and command-line settings
         if config_files == None:
@@ -48,10 +60,16 @@ class SettingsParser():
             for key, value in settings:
                 self.setSettingValue(key, value)
 
-        SettingFunction.registerOperator("extruderValue", self._getValueInExtruder)
-        SettingFunction.registerOperator("extruderValues", self._getValuesInAllExtruders)
-        SettingFunction.registerOperator("resolveOrValue", self._getResolveOrValue)
-        SettingFunction.registerOperator("defaultExtruderPosition", self._getDefaultExtruderPosition)
+
+    # Parse the definition files in the resources folder
+    @staticmethod
+    def loadDefinitions():
+        definitions = OrderedDict()
+        definitions_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources", "definitions")
+        for entry in os.scandir(definitions_folder):
+            if entry.path.endswith(".def.json") and entry.is_file():
+                definitions[os.path.basename(entry.path)] = SettingsDefinitionFile(entry.path)
+        return definitions
 
     def getDefinition(self, key):
         for definition_file in self._definitions:
@@ -79,6 +97,17 @@ class SettingsParser():
     def getNonDefaultValues(self):
         return self._data
 
+    # Get the values that differ from the default value in the definitions. After evaluateLeafValues
+    # the non-default values also contain every leaf value, most of which resolve to their default.
+    def getChangedValues(self):
+        changed_values = OrderedDict()
+        for key, value in self._data.items():
+            definition = self.getDefinition(key)
+            if definition and self._isDefaultValue(definition["default_value"], value):
+                continue
+            changed_values[key] = value
+        return changed_values
+
     def getSettingValue(self, key):
         if key in self._data:
             return self._data[key]
@@ -100,8 +129,22 @@ class SettingsParser():
         if str(definition["default_value"]) == value:
             if key in self._data:
                 del(self._data[key])
+        elif self._profiler:
+            with self._profiler.measure(key):
+                self._data[key] = self._evaluate(value)
         else:
-            self._data[key] = SettingFunction(value)(self)
+            self._data[key] = self._evaluate(value)
+
+    def _evaluate(self, value):
+        return SettingFunction(value, operator_names=self._operators.keys())(self, operators=self._operators)
+
+    def _isDefaultValue(self, default_value, value):
+        if str(default_value) == str(value):
+            return True
+        numeric_types = (int, float)
+        if isinstance(default_value, numeric_types) and isinstance(value, numeric_types) and not isinstance(default_value, bool) and not isinstance(value, bool):
+            return float(default_value) == float(value)
+        return False
 
     # Gets the default extruder position of the currently active machine.
     def _getDefaultExtruderPosition(self) -> str:
@@ -0,0 +1,77 @@
+# Copyright (c) 2020 Autodrop3D and Aldo Hoeben / fieldOfView
+# BeltEngine is released under the terms of the AGPLv3 or higher.
+
+import os
+import time
+import contextlib
+
+import logging
+logger = logging.getLogger("BeltEngine")
+
+# Records how often setting formulas and operators are evaluated and how long that takes.
+# Evaluations nest when a formula reads settings that still have to be evaluated themselves;
+# the time of an evaluation includes the time of everything it evaluated in turn.
+class SettingsProfiler():
+    def __init__(self):
+        # [name, start time, time spent in nested evaluations]
+        self._stack = []
+        # name -> [count, cumulative time, self time, maximum depth]
+        self._stats = {}
+        # names on the stack -> self time, for flame graphs
+        self._stack_times = {}
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        self._stack.append([name, time.perf_counter(), 0.0])
+        try:
+            yield
+        finally:
+            (name, start_time, nested_time) = self._stack[-1]
+            total_time = time.perf_counter() - start_time
+            stack_names = tuple(entry[0] for entry in self._stack)
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1][2] += total_time
+
+            stats = self._stats.setdefault(name, [0, 0.0, 0.0, 0])
+            stats[0] += 1
+            # don't count the time of recursive evaluations twice
+            if name not in stack_names[:-1]:
+                stats[1] += total_time
+            stats[2] += total_time - nested_time
+            stats[3] = max(stats[3], len(stack_names) - 1)
+
+            self._stack_times[stack_names] = self._stack_times.get(stack_names, 0.0) + total_time - nested_time
+
+    # Wrap a function that is exposed to setting formulas, so its calls are measured too
+    def wrapOperator(self, name, operator):
+        def measured_operator(*args, **kwargs):
+            with self.measure("%s()" % name):
+                return operator(*args, **kwargs)
+        return measured_operator
+
+    def getStats(self):
+        return self._stats
+
+    # [(name, count, cumulative time, self time, maximum depth)], most expensive first
+    def getRankedStats(self, sort_by = "cumulative"):
+        sort_column = {"count": 0, "cumulative": 1, "self": 2, "depth": 3}[sort_by]
+        ranked = sorted(self._stats.items(), key=lambda item: item[1][sort_column], reverse=True)
+        return [(name, stats[0], stats[1], stats[2], stats[3]) for (name, stats) in ranked]
+
+    def logReport(self, limit = 25, sort_by = "cumulative"):
+        ranked_stats = self.getRankedStats(sort_by)
+        total_time = sum([stack_time for stack_time in self._stack_times.values()])
+        logger.info("Evaluated %d settings and operators %d times in %.1fms" % (
+            len(ranked_stats), sum([stats[1] for stats in ranked_stats]), total_time * 1000
+        ))
+        logger.info("%-40s %8s %12s %10s %6s" % ("setting", "count", "cumulative", "self", "depth"))
+        for (name, count, cumulative_time, self_time, depth) in ranked_stats[:limit]:
+            logger.info("%-40s %8d %10.2fms %8.2fms %6d" % (name, count, cumulative_time * 1000, self_time * 1000, depth))
+
+    # Write the evaluation stacks in the folded format of flamegraph.pl and speedscope,
+    # with the self time of every stack in microseconds
+    def writeFoldedStacks(self, file_path):
+        with open(os.path.abspath(file_path), "w") as file_pointer:
+            for stack_names, stack_time in self._stack_times.items():
+                file_pointer.write("%s %d\n" % (";".join(stack_names), round(stack_time * 1000000)))
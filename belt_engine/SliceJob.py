@@ -0,0 +1,454 @@
+# Copyright (c) 2020 Autodrop3D and Aldo Hoeben / fieldOfView
+# BeltEngine is released under the terms of the AGPLv3 or higher.
+
+import os
+import math
+import time
+import gc
+
+from collections import OrderedDict
+
+import numpy
+import trimesh
+
+from .SettingsParser import SettingsParser
+from .MeshCreator import createSupportMesh, createHeightMapSupportMesh, createRaftMesh
+from .MeshPretransformer import MeshPretransformer
+from .MeshAnalysis import MeshAnalysis
+from .OrientationOptimizer import OrientationOptimizer
+from .GcodePipeline import GcodePipeline
+from .GcodePostProcessor import GcodePostProcessor
+from .GcodeStatistics import GcodeStatistics
+from .GcodeArcFitter import GcodeArcFitter
+from .GcodeMinifier import GcodeMinifier
+from .LayerRangeSlicer import LayerRangeSlicer
+
+import logging
+logger = logging.getLogger("BeltEngine")
+
+def flipYZ(tri_mesh):
+    tri_mesh.vertices[:,[2,1]] = tri_mesh.vertices[:,[1,2]]
+
+# The settings of a single slice, and the stages that turn a model into gcode with them.
+# Every stage reports the inputs it depends on, so results can be reused when those did not change.
+class SliceJob():
+    def __init__(self, config_files, commandline_settings, settings_profiler = None, definitions = None):
+        self._settings_parser = SettingsParser(config_files, commandline_settings, profiler=settings_profiler, definitions=definitions)
+        settings = self._settings_parser.getNonDefaultValues()
+        logger.debug("Settings: %s" % ", ".join(["%s:%s" % (s, settings[s]) for s in settings]))
+
+        settings_parser = self._settings_parser
+
+        # get belt slicing settings
+        self._gantry_angle = math.radians(float(settings_parser.getSettingValue("blackbelt_gantry_angle")))
+
+        #if this is not set within the config it seems to default to 45 deg
+        self._raw_gantry_angle = float(settings_parser.getSettingValue("blackbelt_gantry_angle"))
+
+        logger.info("Gantry Angle: %s" % self._raw_gantry_angle)
+
+        #if its not set lets go with 90
+        if not self._raw_gantry_angle:
+            self._raw_gantry_angle = 90
+
+        self._raft = False
+        self._support_enable = False
+        self._belt_wall_enabled = False
+        self._mesh_pretransformer = None
+        self._orientation_refinements = None
+        self._orientation_jobs = 1
+
+        #this is the next area for specifics for belt
+
+        if self.isBelt():
+            self._raft = settings_parser.getSettingValue("blackbelt_raft")
+            self._raft_margin = settings_parser.getSettingValue("blackbelt_raft_margin")
+            self._raft_thickness = settings_parser.getSettingValue("blackbelt_raft_thickness")
+            self._raft_gap = settings_parser.getSettingValue("blackbelt_raft_gap")
+            self._raft_speed = settings_parser.getSettingValue("blackbelt_raft_speed")
+            self._raft_flow = settings_parser.getSettingValue("blackbelt_raft_flow") * math.sin(self._gantry_angle)
+
+            self._belt_wall_enabled = settings_parser.getSettingValue("blackbelt_belt_wall_enabled")
+            self._belt_wall_speed = settings_parser.getSettingValue("blackbelt_belt_wall_speed")
+            self._belt_wall_flow = settings_parser.getSettingValue("blackbelt_belt_wall_flow") * math.sin(self._gantry_angle)
+
+            self._support_enable = settings_parser.getSettingValue("support_enable")
+            self._support_gantry_angle_bias = math.radians(settings_parser.getSettingValue("blackbelt_support_gantry_angle_bias"))
+            self._support_minimum_island_area = settings_parser.getSettingValue("blackbelt_support_minimum_island_area")
+            self._support_merge_faces = settings_parser.getSettingValue("blackbelt_support_merge_faces")
+            self._support_engine = settings_parser.getSettingValue("blackbelt_support_engine")
+            self._support_heightmap_resolution = settings_parser.getSettingValue("blackbelt_support_heightmap_resolution")
+
+            self._machine_depth = settings_parser.getSettingValue("machine_depth")
+            self._machine_width = settings_parser.getSettingValue("machine_width")
+
+            settings_parser.setSettingValue("support_enable", "False")
+            settings_parser.setSettingValue("adhesion_type", "\"none\"")
+            for key in ["layer_height", "layer_height_0"]:
+                settings_parser.setSettingValue(key, str(settings_parser.getSettingValue(key) / math.sin(self._gantry_angle)))
+            for key in ["material_flow", "prime_tower_flow"]:
+                settings_parser.setSettingValue(key, str(settings_parser.getSettingValue(key) * math.sin(self._gantry_angle)))
+
+            self._mesh_pretransformer = MeshPretransformer(
+                gantry_angle=self._gantry_angle,
+                machine_depth=self._machine_depth
+            )
+
+        settings_parser.evaluateLeafValues()
+
+        self._arc_fitting = settings_parser.getSettingValue("blackbelt_arc_fitting")
+        self._arc_fitting_tolerance = settings_parser.getSettingValue("blackbelt_arc_fitting_tolerance")
+        self._minify = settings_parser.getSettingValue("blackbelt_gcode_minify")
+        self._minify_strip_comments = settings_parser.getSettingValue("blackbelt_gcode_minify_strip_comments")
+        self._steps_per_mm = OrderedDict([
+            (axis, settings_parser.getSettingValue("machine_steps_per_mm_%s" % axis.lower())) for axis in "XYZE"
+        ])
+
+        if self.isBelt():
+            self._support_angle = settings_parser.getSettingValue("support_angle")
+            self._wall_line_width_0 = settings_parser.getSettingValue("wall_line_width_0")
+
+    def getSettingsParser(self):
+        return self._settings_parser
+
+    def isBelt(self):
+        return self._raw_gantry_angle < 90
+
+    # Turn belt models about the vertical axis to the rotation that needs the least support and
+    # belt before the support is created, refining the best rotations in refinements passes
+    def setOrientationRefinements(self, refinements, jobs = 1):
+        self._orientation_refinements = refinements
+        self._orientation_jobs = jobs
+
+    # The direction in which support is needed, biased towards the gantry
+    def getSupportDownVector(self):
+        return [0, -math.cos(math.radians(self._support_gantry_angle_bias)), -math.sin(self._support_gantry_angle_bias)]
+
+    # The meshes that are sliced, in the order they are passed to CuraEngine
+    def getMeshStages(self):
+        mesh_stages = ["model"]
+        if self.isBelt():
+            if self._support_enable:
+                mesh_stages.append("support")
+            if self._raft:
+                mesh_stages.append("raft")
+        return mesh_stages
+
+    # The settings a stage reads, besides the output of the stages before it
+    def getStageInputs(self, stage):
+        if stage in ["model", "support", "raft"]:
+            if not self.isBelt():
+                return {}
+            inputs = {
+                "gantry_angle": self._raw_gantry_angle,
+                "machine_depth": self._machine_depth,
+                "raft_offset": self._raft_thickness + self._raft_gap if self._raft else 0
+            }
+            if self._orientation_refinements is not None:
+                inputs.update({
+                    "orientation_refinements": self._orientation_refinements,
+                    "support_angle": self._support_angle,
+                    "support_gantry_angle_bias": self._support_gantry_angle_bias,
+                    "wall_line_width_0": self._wall_line_width_0,
+                    "machine_width": self._machine_width
+                })
+            if stage == "support":
+                inputs.update({
+                    "support_angle": self._support_angle,
+                    "support_gantry_angle_bias": self._support_gantry_angle_bias,
+                    "support_minimum_island_area": self._support_minimum_island_area,
+                    "support_engine": self._support_engine,
+                    "wall_line_width_0": self._wall_line_width_0
+                })
+                if self._support_engine == "heightmap":
+                    inputs["support_heightmap_resolution"] = self._support_heightmap_resolution
+                else:
+                    inputs["support_merge_faces"] = self._support_merge_faces
+            elif stage == "raft":
+                inputs.update({
+                    "raft_thickness": self._raft_thickness,
+                    "raft_margin": self._raft_margin
+                })
+            return inputs
+        if stage == "engine":
+            return {
+                "settings": self.getEngineSettings(),
+                "mesh_settings": self.getMeshEngineArgs()
+            }
+        if stage == "postprocess":
+            inputs = {}
+            if self.isBelt():
+                inputs["gcode_to_belt_matrix"] = self.getGcodeToBeltMatrix()
+                if self._belt_wall_enabled:
+                    inputs.update({
+                        "belt_wall_speed": self._belt_wall_speed,
+                        "belt_wall_flow": self._belt_wall_flow,
+                        "wall_line_width_0": self._wall_line_width_0
+                    })
+            if self._arc_fitting:
+                inputs["arc_fitting_tolerance"] = self._arc_fitting_tolerance
+            if self._minify:
+                inputs.update({
+                    "steps_per_mm": self._steps_per_mm,
+                    "minify_strip_comments": self._minify_strip_comments
+                })
+            return inputs
+        raise KeyError("Unknown stage: %s" % stage)
+
+    def getEngineSettings(self):
+        engine_settings = OrderedDict()
+        for (key, value) in self._settings_parser.getChangedValues().items():
+            if not key.startswith("blackbelt_"):
+                engine_settings[key] = value
+        return engine_settings
+
+    # Per-mesh settings for the meshes that are not the model
+    def getMeshEngineArgs(self):
+        mesh_engine_args = {}
+        if self.isBelt():
+            if self._support_enable:
+                mesh_engine_args["support"] = ["-s", "support_mesh=true", "-s", "support_mesh_drop_down=false"]
+            if self._raft:
+                mesh_engine_args["raft"] = [
+                    "-s", "wall_line_count=99999999",
+                    "-s", "speed_wall_0=%f" % self._raft_speed,
+                    "-s", "speed_wall_x=%f" % self._raft_speed,
+                    "-s", "material_flow=%f" % self._raft_flow
+                ]
+        return mesh_engine_args
+
+    # Create the meshes of the stages in mesh_file_paths and export them to those paths. input_mesh
+    # can be a loaded copy of the model in mesh_file_path, which is changed.
+    def prepareMeshes(self, mesh_file_path, mesh_file_paths, preview = False, low_memory = False, input_mesh = None):
+        if input_mesh is None:
+            logger.info("Loading mesh %s" % mesh_file_path)
+            input_mesh = trimesh.load(mesh_file_path)
+
+        if not self.isBelt():
+            input_mesh.export(mesh_file_paths["model"])
+            return
+
+        #this is the next area for specifics for belt
+        flipYZ(input_mesh)
+        input_mesh.vertices[:,[2]] = -input_mesh.vertices[:,[2]]
+        if preview:
+            input_mesh.visual.vertex_colors = [[255,201,36,255]] * len(input_mesh.vertices)
+
+        # normals, adjacency etc. are computed once and shared by the support and raft meshes
+        mesh_analysis = MeshAnalysis(input_mesh)
+        if self._orientation_refinements is not None:
+            self._orientMesh(mesh_analysis)
+        input_bounds = mesh_analysis.getBounds()
+
+        logger.info("Moving mesh to the start of the belt")
+        mesh_analysis.translate([
+            (input_bounds[0][0] + input_bounds[1][0]) / -2,
+            -input_bounds[0][1],
+            -input_bounds[0][2]
+        ])
+
+        mesh_analysis.fixNormals()
+
+        support_mesh = None
+        if self._support_enable and ("support" in mesh_file_paths or preview):
+            logger.info("Create support mesh")
+
+            start_time = time.monotonic()
+            if self._support_engine == "heightmap":
+                support_mesh = createHeightMapSupportMesh(
+                    input_mesh,
+                    support_angle=self._support_angle,
+                    filter_upwards_facing_faces=True,
+                    down_vector=self.getSupportDownVector(),
+                    bottom_cut_off=self._wall_line_width_0,
+                    minimum_island_area=self._support_minimum_island_area,
+                    mesh_analysis=mesh_analysis,
+                    resolution=self._support_heightmap_resolution
+                )
+            else:
+                support_mesh = createSupportMesh(
+                    input_mesh,
+                    support_angle=self._support_angle,
+                    filter_upwards_facing_faces=True,
+                    down_vector=self.getSupportDownVector(),
+                    bottom_cut_off=self._wall_line_width_0,
+                    minimum_island_area=self._support_minimum_island_area,
+                    mesh_analysis=mesh_analysis,
+                    merge_faces=self._support_merge_faces
+                )
+            logger.info("Created support mesh with %d triangles from a mesh with %d triangles in %.2fs using the %s engine" % (
+                len(support_mesh.faces), len(input_mesh.faces), time.monotonic() - start_time, self._support_engine
+            ))
+            # CuraEngine can leave gaps in the support where the mesh is open
+            if len(support_mesh.faces) > 0 and not support_mesh.is_watertight:
+                logger.warning("The support mesh is not watertight")
+            if preview:
+                support_mesh.visual.vertex_colors = [[0,255,255,255]] * len(support_mesh.vertices)
+
+        raft_mesh = None
+        if self._raft:
+            if "raft" in mesh_file_paths or preview:
+                logger.info("Create raft mesh")
+                raft_mesh = createRaftMesh(
+                    input_mesh,
+                    raft_thickness=self._raft_thickness,
+                    raft_margin=self._raft_margin,
+                    mesh_analysis=mesh_analysis
+                )
+                if preview:
+                    raft_mesh.visual.vertex_colors = [[128,128,128,255]] * len(raft_mesh.vertices)
+
+            translation_for_raft = trimesh.transformations.translation_matrix([
+                0, self._raft_thickness + self._raft_gap, 0
+            ])
+            mesh_analysis.translate([0, self._raft_thickness + self._raft_gap, 0])
+            if support_mesh:
+                support_mesh.apply_transform(translation_for_raft)
+
+        if preview:
+            # adding meshes creates a new mesh, so the input mesh does not need to be copied
+            show_mesh = input_mesh
+            if support_mesh:
+                show_mesh = show_mesh + support_mesh
+            if raft_mesh:
+                show_mesh = show_mesh + raft_mesh
+
+            show_mesh.show(smooth=False, flags={"axis": True, "grid": True})
+            show_mesh = None
+
+        if low_memory:
+            # drop normals, adjacency, convex hull etc. that were computed for the support and raft meshes
+            input_mesh._cache.clear()
+            mesh_analysis = None
+            gc.collect()
+
+        meshes = OrderedDict([("model", input_mesh), ("support", support_mesh), ("raft", raft_mesh)])
+        input_mesh = support_mesh = raft_mesh = None
+        for stage in list(meshes.keys()):
+            if stage not in mesh_file_paths:
+                continue
+            logger.info("Creating temporary pretransformed %s mesh" % stage)
+            mesh = meshes.pop(stage) if low_memory else meshes[stage]
+            self._mesh_pretransformer.pretransformMesh(mesh)
+            flipYZ(mesh)
+            mesh.invert()
+            mesh.export(mesh_file_paths[stage])
+            if low_memory:
+                mesh = None
+                gc.collect()
+        #end of belt specifics
+
+    def _orientMesh(self, mesh_analysis):
+        # the normals must point outwards to tell which faces need support
+        mesh_analysis.fixNormals()
+
+        logger.info("Finding the best rotation of the mesh")
+        orientation_optimizer = OrientationOptimizer(
+            mesh_analysis,
+            self.getSupportDownVector(),
+            support_angle=self._support_angle,
+            bottom_cut_off=self._wall_line_width_0,
+            gantry_angle=self._gantry_angle,
+            machine_width=self._machine_width,
+            jobs=self._orientation_jobs
+        )
+        (best_candidate, unrotated) = orientation_optimizer.findBestRotation(self._orientation_refinements)
+        for (name, candidate) in [("Without rotation", unrotated), ("Rotated %.1f degrees" % math.degrees(best_candidate.angle), best_candidate)]:
+            logger.info("%s: %.0fmm2 overhang, %.0fmm2 footprint, %.1fmm belt length" % (
+                name, candidate.overhang_area, candidate.footprint, candidate.belt_length
+            ))
+        if best_candidate.angle == unrotated.angle:
+            return
+
+        # turn the model about its own center
+        center = mesh_analysis.getBounds().mean(axis=0)
+        mesh_analysis.rotate(trimesh.transformations.rotation_matrix(best_candidate.angle, [0, 1, 0], point=center))
+
+    # Arguments for CuraEngine to slice the meshes in mesh_file_paths with the settings file.
+    # Stages that are not in mesh_file_paths are left out.
+    def getEngineArgs(self, engine_path, settings_file_path, output_file_path, mesh_file_paths):
+        engine_args = [
+            engine_path,
+            "slice",
+            "-v",
+            "-j", os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources","definitions","fdmprinter.def.json"),
+            "-j", settings_file_path,
+            "-o", output_file_path,
+        ]
+        mesh_engine_args = self.getMeshEngineArgs()
+        for stage in self.getMeshStages():
+            if stage not in mesh_file_paths:
+                continue
+            engine_args.extend(["-l", mesh_file_paths[stage]])
+            engine_args.extend(mesh_engine_args.get(stage, []))
+        return engine_args
+
+    # Splits the slice into range_count ranges of layers that are sliced by separate CuraEngine processes.
+    # Returns None if the slice can't be split.
+    def createLayerRangeSlicer(self, range_count):
+        settings_parser = self._settings_parser
+        # CuraEngine prints a raft as layers below layer 0 and raises the model above it, which the
+        # ranges after the first can't reproduce; belt jobs have their own raft mesh instead
+        if settings_parser.getSettingValue("adhesion_type") == "raft":
+            logger.warning("Jobs with adhesion_type raft can't be sliced in layer ranges, slicing in a single process")
+            return None
+        return LayerRangeSlicer(
+            range_count,
+            layer_height_0=settings_parser.getSettingValue("layer_height_0"),
+            layer_height=settings_parser.getSettingValue("layer_height"),
+            # skins are detected by looking this many layers up and down
+            overlap_layers=max(settings_parser.getSettingValue("top_layers"), settings_parser.getSettingValue("bottom_layers")) + 1,
+            remove_empty_first_layers=settings_parser.getSettingValue("remove_empty_first_layers"),
+            retraction_speed=settings_parser.getSettingValue("retraction_speed")
+        )
+
+    # The transformation from gcode coordinates back to the coordinates of the model on the belt,
+    # undoing the pretransform, the swapped axes of the exported meshes and the offset CuraEngine
+    # adds for machines that don't have their origin in the center
+    def getGcodeToBeltMatrix(self):
+        if not self.isBelt():
+            return None
+
+        engine_offset = numpy.identity(4)
+        if not self._settings_parser.getSettingValue("machine_center_is_zero"):
+            engine_offset[0, 3] = self._settings_parser.getSettingValue("machine_width") / 2
+            engine_offset[1, 3] = self._settings_parser.getSettingValue("machine_depth") / 2
+        flip_yz = numpy.identity(4)[[0, 2, 1, 3]]
+
+        belt_to_gcode = engine_offset.dot(flip_yz).dot(self._mesh_pretransformer.getMatrix())
+        return numpy.linalg.inv(belt_to_gcode).tolist()
+
+    def createGcodePipeline(self, jobs = 1, low_memory = False, statistics_file_path = None):
+        gcode_pipeline = GcodePipeline(stream_file=low_memory)
+
+        if self.isBelt():
+            if self._belt_wall_enabled:
+                gcode_pipeline.addStage(GcodePostProcessor(
+                    belt_wall_enable=self._belt_wall_enabled,
+                    belt_wall_flow=self._belt_wall_flow,
+                    belt_wall_speed=self._belt_wall_speed,
+                    wall_line_width_0=self._wall_line_width_0,
+                    jobs=jobs
+                ))
+
+        # arcs are fitted after the belt wall has been adjusted, so the adjusted lines are left alone
+        if self._arc_fitting:
+            gcode_pipeline.addStage(GcodeArcFitter(tolerance=self._arc_fitting_tolerance))
+
+        # the header CuraEngine writes for the pretransformed meshes has no usable bounds, so
+        # the statistics of belt prints are always collected to correct it
+        if self.isBelt() or statistics_file_path:
+            gcode_pipeline.addStage(GcodeStatistics(
+                gcode_to_belt_matrix=self.getGcodeToBeltMatrix(),
+                statistics_file_path=statistics_file_path
+            ))
+
+        # the statistics are collected before the minifier runs; when it strips comments, the header
+        # lines they update are removed from the output
+        if self._minify:
+            gcode_pipeline.addStage(GcodeMinifier(
+                steps_per_mm=self._steps_per_mm,
+                strip_comments=self._minify_strip_comments
+            ))
+
+        return gcode_pipeline
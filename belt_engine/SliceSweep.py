@@ -0,0 +1,137 @@
+# Copyright (c) 2020 Autodrop3D and Aldo Hoeben / fieldOfView
+# BeltEngine is released under the terms of the AGPLv3 or higher.
+
+import os
+import csv
+import json
+import tempfile
+import itertools
+from collections import OrderedDict
+from typing import NamedTuple
+
+import trimesh
+
+from .SliceJob import SliceJob
+from .SettingsParser import SettingsParser
+
+import logging
+logger = logging.getLogger("BeltEngine")
+
+SweepVariant = NamedTuple("SweepVariant", [
+    ("overrides", OrderedDict),  # key -> value of the swept settings
+    ("slice_job", SliceJob)
+])
+
+# Slices one model with every combination of a set of setting values. The variants share the parsed
+# definitions, and every distinct mesh is prepared once for all variants that read the same values.
+class SliceSweep():
+    def __init__(self, config_files, commandline_settings, sweep_settings):
+        # [(key, [values])]
+        self._sweep_settings = sweep_settings
+
+        definitions = SettingsParser.loadDefinitions()
+        keys = [key for (key, values) in sweep_settings]
+        self._variants = []
+        for values in itertools.product(*[values for (key, values) in sweep_settings]):
+            overrides = OrderedDict(zip(keys, values))
+            variant_settings = list(commandline_settings or []) + [["%s=%s" % (key, value)] for (key, value) in overrides.items()]
+            self._variants.append(SweepVariant(overrides, SliceJob(config_files, variant_settings, definitions=definitions)))
+
+    # Parse --sweep arguments of the form key=value,value,... into [(key, [values])]
+    @staticmethod
+    def parseSweepArguments(sweep_arguments):
+        sweep_settings = []
+        for sweep_argument in sweep_arguments:
+            (key, separator, values) = sweep_argument.partition("=")
+            if not separator or not key.strip() or not values:
+                raise ValueError("Sweep values should be given as key=value,value,...: %s" % sweep_argument)
+            sweep_settings.append((key.strip(), [value.strip() for value in values.split(",")]))
+        return sweep_settings
+
+    def getVariants(self):
+        return self._variants
+
+    # output.gcode -> output-01.gcode, output-02.gcode, ...
+    def getOutputFilePath(self, output_file_path, variant_index):
+        (root, extension) = os.path.splitext(output_file_path)
+        return "%s-%0*d%s" % (root, len(str(len(self._variants))), variant_index + 1, extension)
+
+    def getSummaryFilePath(self, output_file_path):
+        return os.path.splitext(output_file_path)[0] + "-sweep.csv"
+
+    # Create the meshes of every variant that are not in the cache yet. The model is loaded once, and
+    # a mesh is only created for the first variant with its stage key.
+    def prepareMeshes(self, mesh_file_path, artifact_cache, variant_stage_keys, low_memory = False):
+        input_mesh = None
+        prepared_keys = set()
+        prepared_count = 0
+        for (variant, stage_keys) in zip(self._variants, variant_stage_keys):
+            missing_mesh_file_paths = OrderedDict()
+            for stage in variant.slice_job.getMeshStages():
+                stage_key = stage_keys[stage]
+                if stage_key in prepared_keys or os.path.exists(artifact_cache.getArtifactPath(stage_key, ".stl")):
+                    prepared_keys.add(stage_key)
+                    continue
+                (file_descriptor, missing_mesh_file_paths[stage]) = tempfile.mkstemp(suffix=".stl")
+                os.close(file_descriptor)
+            if not missing_mesh_file_paths:
+                continue
+
+            if input_mesh is None:
+                logger.info("Loading mesh %s" % mesh_file_path)
+                input_mesh = trimesh.load(mesh_file_path)
+            variant.slice_job.prepareMeshes(mesh_file_path, missing_mesh_file_paths, low_memory=low_memory, input_mesh=input_mesh.copy())
+            for (stage, stage_mesh_file_path) in missing_mesh_file_paths.items():
+                artifact_cache.store(stage_keys[stage], ".stl", stage_mesh_file_path)
+                os.remove(stage_mesh_file_path)
+                prepared_keys.add(stage_keys[stage])
+                prepared_count += 1
+
+        logger.info("Prepared %d meshes for %d variants, %d distinct meshes in total" % (
+            prepared_count, len(self._variants), len(prepared_keys)
+        ))
+
+    # results are (return code, seconds) per variant; the statistics are read from the files
+    # that are written next to the gcode
+    def getSummary(self, output_file_paths, statistics_file_paths, results):
+        summary = []
+        for (variant, output_file_path, statistics_file_path, result) in zip(self._variants, output_file_paths, statistics_file_paths, results):
+            (return_code, wall_time) = result
+            row = OrderedDict([("variant", len(summary) + 1)])
+            row.update(variant.overrides)
+            row["result"] = "ok" if return_code == 0 else "failed"
+            row["time"] = round(wall_time, 2)
+            row["estimated_print_time"] = None
+            row["filament"] = None
+            row["output"] = output_file_path
+            if return_code == 0 and os.path.exists(statistics_file_path):
+                with open(statistics_file_path) as file_pointer:
+                    statistics = json.load(file_pointer)
+                row["estimated_print_time"] = round(statistics["estimated_time"])
+                row["filament"] = round(statistics["extrusion"] / 1000, 3)
+            summary.append(row)
+        return summary
+
+    def logSummary(self, summary):
+        keys = [key for (key, values) in self._sweep_settings]
+        widths = [max(len(key), max([len(str(row[key])) for row in summary])) for key in keys]
+        logger.info("%4s  %s  %6s %8s %10s %10s  %s" % (
+            "#", "  ".join([key.ljust(width) for (key, width) in zip(keys, widths)]), "result", "time", "print time", "filament", "output"
+        ))
+        for row in summary:
+            print_time = row["estimated_print_time"]
+            logger.info("%4d  %s  %6s %7.1fs %10s %10s  %s" % (
+                row["variant"],
+                "  ".join([str(row[key]).ljust(width) for (key, width) in zip(keys, widths)]),
+                row["result"],
+                row["time"],
+                "%dm%02ds" % (print_time // 60, print_time % 60) if print_time is not None else "-",
+                "%.3fm" % row["filament"] if row["filament"] is not None else "-",
+                row["output"]
+            ))
+
+    def writeSummary(self, file_path, summary):
+        with open(file_path, "w", newline="") as file_pointer:
+            writer = csv.DictWriter(file_pointer, fieldnames=list(summary[0].keys()))
+            writer.writeheader()
+            writer.writerows(summary)
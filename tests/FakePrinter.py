@@ -0,0 +1,102 @@
+# Copyright (c) 2020 Autodrop3D and Aldo Hoeben / fieldOfView
+# BeltEngine is released under the terms of the AGPLv3 or higher.
+
+import os
+import time
+import select
+import threading
+
+try:
+    import pty
+    import tty
+except ImportError:
+    pty = None
+
+# Stand-in for a Marlin printer on a pseudo terminal, to test the GcodeSender without a printer.
+# It checks the line numbers and checksums like Marlin does and answers "ok", or an error with a
+# "Resend:" request. Lines are processed one at a time after line_time seconds, and the bytes that
+# were received but not processed yet are counted, so tests can check that the sender never sends
+# more than fits in the receive buffer.
+class FakePrinter():
+    def __init__(self, rx_buffer_size = 128, line_time = 0.0002, error_lines = ()):
+        self._rx_buffer_size = rx_buffer_size
+        self._line_time = line_time
+        # line numbers that get a checksum error the first time they arrive in order
+        self._error_lines = set(error_lines)
+
+        (self._master_fd, self._slave_fd) = pty.openpty()
+        tty.setraw(self._master_fd)
+        self._port = os.ttyname(self._slave_fd)
+
+        # the commands that were accepted, without line numbers and checksums
+        self.commands = []
+        self.errors = 0
+        self.maximum_pending_bytes = 0
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def getPort(self):
+        return self._port
+
+    def start(self):
+        self._write("start\necho: fake printer\n")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+        os.close(self._master_fd)
+        os.close(self._slave_fd)
+
+    def isOverflowed(self):
+        return self.maximum_pending_bytes > self._rx_buffer_size
+
+    def _run(self):
+        read_buffer = b""
+        pending_bytes = 0
+        last_line_number = 0
+        while not self._stop.is_set():
+            (readable, writable, exceptional) = select.select([self._master_fd], [], [], 0.05)
+            if readable:
+                try:
+                    data = os.read(self._master_fd, 4096)
+                except OSError:
+                    return
+                read_buffer += data
+                pending_bytes += len(data)
+                self.maximum_pending_bytes = max(self.maximum_pending_bytes, pending_bytes)
+
+            while b"\n" in read_buffer:
+                (line, read_buffer) = read_buffer.split(b"\n", 1)
+                pending_bytes -= len(line) + 1
+                time.sleep(self._line_time)
+                last_line_number = self._processLine(line.decode(), last_line_number)
+
+    # Answer a line and return the number of the last line that was accepted
+    def _processLine(self, line, last_line_number):
+        (numbered_command, separator, checksum) = line.partition("*")
+        (number_word, command) = numbered_command.split(" ", 1)
+        line_number = int(number_word[1:])
+        expected_checksum = 0
+        for character in numbered_command.encode():
+            expected_checksum ^= character
+
+        if command.startswith("M110"):
+            self._write("ok\n")
+            return int(command.split("N", 1)[1]) if "N" in command else line_number
+        if line_number != last_line_number + 1:
+            self._write("Error:Line Number is not Last Line Number+1, Last Line: %d\nResend: %d\nok\n" % (last_line_number, last_line_number + 1))
+            return last_line_number
+        if int(checksum) != expected_checksum or line_number in self._error_lines:
+            self._error_lines.discard(line_number)
+            self.errors += 1
+            self._write("Error:checksum mismatch, Last Line: %d\nResend: %d\nok\n" % (last_line_number, last_line_number + 1))
+            return last_line_number
+
+        self.commands.append(command)
+        self._write("ok\n")
+        return line_number
+
+    def _write(self, text):
+        os.write(self._master_fd, text.encode())
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020 Autodrop3D and Aldo Hoeben / fieldOfView
+# BeltEngine is released under the terms of the AGPLv3 or higher.
+
+# Stand-in for CuraEngine that sleeps, allocates memory, reports its cores and exits with a given
+# code, to test the EngineSupervisor without slicing anything.
+
+import os
+import sys
+import time
+import argparse
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub engine for the EngineSupervisor tests.")
+    parser.add_argument("--sleep", type=float, default=0, help="seconds to sleep before exiting")
+    parser.add_argument("--allocate", type=int, default=0, help="MB of memory to allocate before sleeping")
+    parser.add_argument("--exit-code", type=int, default=0, help="exit status")
+    parser.add_argument("--affinity-file", help="file to write the cores the engine may run on to, after sleeping")
+    args = parser.parse_args()
+
+    print("threads: %s" % os.environ.get("OMP_NUM_THREADS"), flush=True)
+
+    # bytearray zeroes the memory, so it is resident
+    memory = bytearray(args.allocate * 2**20)
+    time.sleep(args.sleep)
+    del memory
+
+    if args.affinity_file:
+        with open(args.affinity_file, "w") as file_pointer:
+            file_pointer.write(" ".join([str(core) for core in sorted(os.sched_getaffinity(0))]))
+
+    return args.exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+# Copyright (c) 2020 Autodrop3D and Aldo Hoeben / fieldOfView
+# BeltEngine is released under the terms of the AGPLv3 or higher.
+
+import os
+import sys
+import time
+import tempfile
+import unittest
+
+from belt_engine.EngineSupervisor import EngineSupervisor
+
+STUB_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "StubEngine.py")
+
+class TestEngineSupervisor(unittest.TestCase):
+    def setUp(self):
+        self._lock_folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._lock_folder.cleanup()
+
+    def _run(self, stub_args, **kwargs):
+        supervisor = EngineSupervisor(lock_folder=self._lock_folder.name, poll_interval=0.05, **kwargs)
+        return supervisor.run([sys.executable, STUB_ENGINE] + stub_args)
+
+    def test_success(self):
+        result = self._run(["--sleep", "0.1"], threads=1)
+        self.assertEqual(result.return_code, 0)
+        self.assertIsNone(result.error)
+
+    def test_exitStatus(self):
+        result = self._run(["--exit-code", "3"], threads=1)
+        self.assertEqual(result.return_code, 3)
+        self.assertIn("exited with code 3", result.error)
+
+    def test_timeout(self):
+        start_time = time.monotonic()
+        result = self._run(["--sleep", "30"], threads=1, timeout=0.5)
+        self.assertLess(time.monotonic() - start_time, 10)
+        self.assertIn("did not finish within 0.5 seconds", result.error)
+        self.assertNotEqual(result.return_code, 0)
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "memory use is only measured on Linux")
+    def test_memoryLimit(self):
+        result = self._run(["--allocate", "200", "--sleep", "30"], threads=1, timeout=20, max_rss=100 * 2**20)
+        self.assertIn("memory", result.error)
+        self.assertNotEqual(result.return_code, 0)
+        self.assertGreater(result.peak_rss, 100 * 2**20)
+
+    @unittest.skipIf(sys.platform.startswith("win"), "cores are only reserved where fcntl is available")
+    def test_defaultCoreShare(self):
+        available_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        result = self._run([])
+        self.assertEqual(len(result.cores), max(1, available_cores // 2))
+
+    @unittest.skipIf(sys.platform.startswith("win"), "cores are only reserved where fcntl is available")
+    def test_unopenableLockFile(self):
+        # a lock file that can't be opened, like one of another user, is skipped instead of stopping the slice
+        available_cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+        os.mkdir(os.path.join(self._lock_folder.name, "beltengine-core-%d.lock" % available_cores[0]))
+        result = self._run([], threads=1)
+        self.assertIsNone(result.error)
+        self.assertNotIn(available_cores[0], result.cores)
+
+    @unittest.skipUnless(hasattr(os, "sched_setaffinity"), "the cores of a process can't be set on this platform")
+    def test_affinity(self):
+        affinity_file = os.path.join(self._lock_folder.name, "affinity.txt")
+        result = self._run(["--sleep", "0.2", "--affinity-file", affinity_file], threads=1)
+        self.assertIsNone(result.error)
+        with open(affinity_file) as file_pointer:
+            self.assertEqual([int(core) for core in file_pointer.read().split()], sorted(result.cores))
+
+if __name__ == "__main__":
+    unittest.main()
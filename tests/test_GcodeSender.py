@@ -0,0 +1,127 @@
+# Copyright (c) 2020 Autodrop3D and Aldo Hoeben / fieldOfView
+# BeltEngine is released under the terms of the AGPLv3 or higher.
+
+import os
+import json
+import logging
+import tempfile
+import unittest
+
+from belt_engine.GcodeSender import GcodeSender, readGcodeFile
+from belt_engine.GcodeLayerIndex import GcodeLayerIndex, getLayerIndexFilePath
+
+from tests.FakePrinter import FakePrinter, pty
+
+RX_BUFFER_SIZE = 128
+
+def createGcode(layer_count = 20, lines_per_layer = 100):
+    gcode = [";FLAVOR:Marlin\n", "M140 S60\n", "M104 S200\n", "M190 S60\n", "M109 S200\n", "M82 ;absolute extrusion mode\n", "G92 E0\n"]
+    e = 0.0
+    for layer_number in range(layer_count):
+        gcode.append(";LAYER:%d\n" % layer_number)
+        if layer_number == 1:
+            gcode.append("M106 S128\n")
+        for line_number in range(lines_per_layer):
+            e += 0.01
+            gcode.append("G1 F%d X%.3f Y%.3f E%.5f ;move\n" % (1200 + layer_number * 60, line_number % 50, layer_number + line_number / 100, e))
+        if layer_number == 10:
+            gcode.append("M104 S210\n")
+            gcode.append("G92 E0\n")
+            e = 0.0
+    gcode.append("M107\n")
+    return gcode
+
+# The commands the printer should receive for gcode lines
+def getCommands(gcode_lines):
+    return [line.split(";", 1)[0].strip() for line in gcode_lines if line.split(";", 1)[0].strip()]
+
+@unittest.skipIf(pty is None, "pseudo terminals are not available on this platform")
+class TestGcodeSender(unittest.TestCase):
+    def setUp(self):
+        logging.getLogger("BeltEngine").setLevel(logging.ERROR)
+
+    def _send(self, gcode_lines, **kwargs):
+        fake_printer = FakePrinter(rx_buffer_size=RX_BUFFER_SIZE, **kwargs)
+        fake_printer.start()
+        try:
+            sender = GcodeSender(fake_printer.getPort(), rx_buffer_size=RX_BUFFER_SIZE, startup_timeout=0.5)
+            try:
+                result = sender.send(iter(gcode_lines))
+            finally:
+                sender.close()
+        finally:
+            fake_printer.stop()
+        return (result, fake_printer)
+
+    def test_characterCounting(self):
+        gcode_lines = createGcode()
+        (result, fake_printer) = self._send(gcode_lines)
+
+        self.assertIsNone(result.error)
+        self.assertEqual(fake_printer.commands, getCommands(gcode_lines))
+        self.assertEqual(result.lines, len(fake_printer.commands))
+        self.assertEqual(result.resends, 0)
+        # the printer had more than one line in its buffer, but never more than fits
+        self.assertFalse(fake_printer.isOverflowed())
+        self.assertGreater(fake_printer.maximum_pending_bytes, max([len(line) for line in gcode_lines]) + 10)
+
+    def test_resend(self):
+        gcode_lines = createGcode()
+        error_lines = [10, 500, 501, 1500]
+        (result, fake_printer) = self._send(gcode_lines, error_lines=error_lines)
+
+        self.assertIsNone(result.error)
+        self.assertEqual(fake_printer.errors, len(error_lines))
+        self.assertEqual(result.resends, len(error_lines))
+        # every line arrives once and in order, without overflowing the buffer
+        self.assertEqual(fake_printer.commands, getCommands(gcode_lines))
+        self.assertFalse(fake_printer.isOverflowed())
+
+class TestReadGcodeFile(unittest.TestCase):
+    def setUp(self):
+        logging.getLogger("BeltEngine").setLevel(logging.ERROR)
+        self._folder = tempfile.TemporaryDirectory()
+        self._gcode_lines = createGcode()
+        self._file_path = os.path.join(self._folder.name, "test.gcode")
+        with open(self._file_path, "w") as file_pointer:
+            file_pointer.writelines(self._gcode_lines)
+
+    def tearDown(self):
+        self._folder.cleanup()
+
+    def test_resume(self):
+        lines = list(readGcodeFile(self._file_path, 12))
+        layer_start = self._gcode_lines.index(";LAYER:12\n")
+        # the state at the start of layer 12, followed by the layers from layer 12 on
+        self.assertEqual(lines[:10], [
+            ";Resuming at layer 12\n", "M140 S60\n", "M104 T0 S210\n", "M190 S60\n", "M109 T0 S210\n",
+            "G90\n", "M82\n", "M106 S128\n", "G92 E1.00000\n", "G1 F1860\n"
+        ])
+        self.assertEqual(lines[10:], self._gcode_lines[layer_start:])
+
+    def test_resumeWithIndex(self):
+        lines = list(readGcodeFile(self._file_path, 12))
+        GcodeLayerIndex.fromGcodeFile(self._file_path).save(getLayerIndexFilePath(self._file_path))
+        self.assertEqual(list(readGcodeFile(self._file_path, 12)), lines)
+
+        with self.assertRaises(KeyError):
+            readGcodeFile(self._file_path, 99)
+
+    def test_mismatchingIndex(self):
+        GcodeLayerIndex.fromGcodeFile(self._file_path).save(getLayerIndexFilePath(self._file_path))
+        with open(getLayerIndexFilePath(self._file_path)) as file_pointer:
+            data = json.load(file_pointer)
+        for layer in data["layers"]:
+            layer[1] += 1
+        with open(getLayerIndexFilePath(self._file_path), "w") as file_pointer:
+            json.dump(data, file_pointer)
+
+        with self.assertRaises(KeyError):
+            readGcodeFile(self._file_path, 12)
+
+    def test_missingLayer(self):
+        with self.assertRaises(KeyError):
+            readGcodeFile(self._file_path, 99)
+
+if __name__ == "__main__":
+    unittest.main()
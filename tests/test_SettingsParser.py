@@ -0,0 +1,65 @@
+# Copyright (c) 2020 Autodrop3D and Aldo Hoeben / fieldOfView
+# BeltEngine is released under the terms of the AGPLv3 or higher.
+
+import os
+import logging
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from belt_engine.SettingsParser import SettingsParser
+
+SETTINGS_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "belt_engine", "settings")
+
+# (-c config files, -s settings) of profiles that resolve to different values
+PROFILES = [
+    ([[os.path.join(SETTINGS_FOLDER, "CR30.cfg.ini")]], [["layer_height=0.2"]]),
+    ([[os.path.join(SETTINGS_FOLDER, "verttest.cfg.ini")]], [["layer_height=0.1"], ["infill_sparse_density=40"]]),
+    ([[os.path.join(SETTINGS_FOLDER, "CR30.cfg.ini")]], [["material_bed_temperature=70"], ["support_interface_line_width=0.6"]]),
+    ([[os.path.join(SETTINGS_FOLDER, "verttest.cfg.ini")]], [["speed_print=80"], ["top_thickness=2"]]),
+    ([[os.path.join(SETTINGS_FOLDER, "blackbelt.cfg.ini")]], [["material_bed_temperature=45"], ["layer_height=0.3"]])
+]
+# settings with formulas that use the extruderValue, extruderValues and resolveOrValue operators
+OPERATOR_SETTINGS = [
+    "infill_sparse_thickness",  # resolveOrValue('layer_height')
+    "material_bed_temperature_layer_0",  # resolveOrValue('material_bed_temperature')
+    "top_layers",  # resolveOrValue('layer_height')
+    "support_roof_line_width",  # extruderValue(support_roof_extruder_nr, ...)
+    "speed_support_roof"  # extruderValue(support_roof_extruder_nr, ...)
+]
+THREADS = 8
+ROUNDS = 5
+
+class TestSettingsParserThreads(unittest.TestCase):
+    def setUp(self):
+        logging.getLogger("BeltEngine").setLevel(logging.ERROR)
+        self._definitions = SettingsParser.loadDefinitions()
+
+    def _resolve(self, profile_index):
+        (config_files, commandline_settings) = PROFILES[profile_index]
+        settings_parser = SettingsParser(config_files, commandline_settings, definitions=self._definitions)
+        settings_parser.evaluateLeafValues()
+        values = {key: repr(value) for (key, value) in settings_parser.getNonDefaultValues().items()}
+        for key in OPERATOR_SETTINGS:
+            values["resolved:" + key] = repr(settings_parser.getSettingValue(key))
+        return values
+
+    def test_profilesDiffer(self):
+        # the profiles would not show interference if they resolved to the same values
+        serial_results = [self._resolve(index) for index in range(len(PROFILES))]
+        for key in ["resolved:infill_sparse_thickness", "resolved:material_bed_temperature_layer_0", "resolved:support_roof_line_width"]:
+            self.assertGreater(len(set([result[key] for result in serial_results])), 1, key)
+
+    def test_parallelProfiles(self):
+        serial_results = [self._resolve(index) for index in range(len(PROFILES))]
+
+        # every thread resolves the profiles in a different order, so parsers of different
+        # profiles are created and evaluated at the same time
+        profile_indices = [(thread + round_index) % len(PROFILES) for round_index in range(ROUNDS) for thread in range(THREADS)]
+        with ThreadPoolExecutor(max_workers=THREADS) as executor:
+            parallel_results = list(executor.map(self._resolve, profile_indices))
+
+        for (profile_index, result) in zip(profile_indices, parallel_results):
+            self.assertEqual(result, serial_results[profile_index], "profile %d" % profile_index)
+
+if __name__ == "__main__":
+    unittest.main()